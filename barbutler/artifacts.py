@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from os.path import exists, join
+
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+
+"""
+Bumped whenever the layout of the bundle changes, bundles of another
+version are ignored
+"""
+BUNDLE_VERSION = 1
+MANIFEST = "manifest.json"
+
+
+def text_hash(value:Any) -> str:
+    """
+    sha256 of anything JSON serializable, e.g. a list of anchor texts
+    """
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ArtifactBundle:
+    """
+    A directory of .npy arrays precomputed by `build.py artifacts`, with
+    a JSON manifest recording what they were built from: the model
+    names, the inference backend and hashes of the inputs.
+
+    Loading is reading the manifest and memory mapping the arrays, so it
+    takes a few milliseconds and nothing is executed, unlike a pickle.
+    Every value derived from the bundle checks the manifest against what
+    it would be built from now and is recomputed if anything differs.
+    """
+
+    def __init__(self, path:str):
+        self.path = path
+        self.manifest = None
+        self._lock = threading.Lock()
+
+
+    @property
+    def available(self) -> bool:
+        return exists(join(self.path, MANIFEST))
+
+
+    def load(self) -> Optional[Dict]:
+        """
+        reads the manifest, returns None if there is no bundle or it is
+        of another version
+        """
+        if self.manifest is None and self.available:
+            with self._lock:
+                if self.manifest is None:
+                    with open(join(self.path, MANIFEST), "r") as manifest_file:
+                        manifest = json.load(manifest_file)
+                    if manifest.get("version") == BUNDLE_VERSION:
+                        self.manifest = manifest
+        return self.manifest
+
+
+    def matches(self, name:str, **expected) -> bool:
+        """
+        whether the bundle has the array name, built from the same inputs
+        as expected (e.g. embedder="all-MiniLM-L6-v2")
+        """
+        manifest = self.load()
+        if manifest is None or name not in manifest["arrays"]:
+            return False
+        return all(manifest["arrays"][name].get(key) == value for key, value in expected.items())
+
+
+    def array(self, name:str) -> np.ndarray:
+        """
+        memory maps an array of the bundle. The map is copy-on-write, so
+        it can be handed to torch.from_numpy without copying while the
+        file on disk stays read only
+        """
+        return np.load(join(self.path, self.load()["arrays"][name]["file"]), mmap_mode="c")
+
+
+    def reset(self) -> None:
+        self.manifest = None
+
+
+
+def write_bundle(path:str, arrays:Dict[str, np.ndarray], inputs:Dict[str, Dict]) -> Dict:
+    """
+    Writes every array as a contiguous .npy file and then the manifest,
+    which lists each array with its shape, dtype, content hash and the
+    inputs it was built from. Files are named after their content hash
+    and the manifest is replaced last, so a bot that has the previous
+    bundle mapped keeps reading consistent data, and a bundle that is
+    being rebuilt is never read half written.
+    """
+    os.makedirs(path, exist_ok=True)
+    manifest = {"version": BUNDLE_VERSION, "created_at": time.time(), "arrays": {}}
+
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        content_hash = hashlib.sha256(array.tobytes()).hexdigest()
+        file_name = f"{name}-{content_hash[:12]}.npy"
+        np.save(join(path, file_name), array)
+        manifest["arrays"][name] = {
+            "file": file_name,
+            "shape": list(array.shape),
+            "dtype": str(array.dtype),
+            "sha256": content_hash,
+            **inputs[name],
+        }
+
+    tmp_path = join(path, MANIFEST + ".tmp")
+    with open(tmp_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(tmp_path, join(path, MANIFEST))
+    return manifest
@@ -0,0 +1,138 @@
+import logging
+from os.path import exists, join
+
+from typing import Any, Dict, List
+
+import torch
+from sentence_transformers import SentenceTransformer
+from transformers import AutoModelWithLMHead
+
+
+logger = logging.getLogger(__name__)
+
+"""
+Inference backends the models can be loaded with, see
+BARBUTLER_INFERENCE_BACKEND:
+   - torch: full precision PyTorch, the reference
+   - int8: PyTorch with the Linear layers dynamically quantized to int8
+   - onnx: ONNX Runtime sessions, needs `pip install optimum[onnxruntime]`
+"""
+BACKENDS = ["torch", "int8", "onnx"]
+
+
+def quantize(model:torch.nn.Module) -> torch.nn.Module:
+    """
+    Dynamically quantizes every Linear layer to int8. Weights are stored
+    in int8 and activations are quantized on the fly, which is where both
+    MiniLM and t5 spend most of their time on CPU.
+    """
+    model.eval()
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def onnx_dir(model_dir:str, name:str) -> str:
+    return join(model_dir, name.replace("/", "--") + "-onnx")
+
+
+def load_embedder(name:str, backend:str, model_dir:str) -> Any:
+    """
+    loads the sentence embedder with the given backend
+    """
+    if backend == "torch":
+        return SentenceTransformer(name)
+
+    if backend == "int8":
+        return quantize(SentenceTransformer(name, device="cpu"))
+
+    if backend == "onnx":
+        # sentence_transformers exports the model to ONNX itself on the
+        # first load, and reuses the export after it is saved
+        path = onnx_dir(model_dir, name)
+        if exists(path):
+            return SentenceTransformer(path, backend="onnx")
+        embedder = SentenceTransformer(name, backend="onnx")
+        embedder.save_pretrained(path)
+        return embedder
+
+    raise ValueError(f"unknown inference backend {backend}, expected one of {BACKENDS}")
+
+
+def load_emotion_model(name:str, backend:str, model_dir:str) -> Any:
+    """
+    loads the t5 emotion model with the given backend. All of them
+    support generate(), so extract_emotion_from_text doesn't change
+    """
+    if backend == "torch":
+        return AutoModelWithLMHead.from_pretrained(name)
+
+    if backend == "int8":
+        return quantize(AutoModelWithLMHead.from_pretrained(name))
+
+    if backend == "onnx":
+        try:
+            from optimum.onnxruntime import ORTModelForSeq2SeqLM
+        except ImportError as e:
+            raise ImportError("the onnx backend needs `pip install optimum[onnxruntime]`") from e
+
+        path = onnx_dir(model_dir, name)
+        if exists(path):
+            return ORTModelForSeq2SeqLM.from_pretrained(path)
+        model = ORTModelForSeq2SeqLM.from_pretrained(name, export=True)
+        model.save_pretrained(path)
+        return model
+
+    raise ValueError(f"unknown inference backend {backend}, expected one of {BACKENDS}")
+
+
+def compare_embedders(reference:Any, candidate:Any, vocabulary:List[str], queries:List[str], top_k:int=5) -> Dict:
+    """
+    Ranks the tasting note vocabulary for every query with both
+    embedders and reports how often the top note agrees and the average
+    overlap of the top_k notes
+    """
+    def rankings(embedder):
+        notes = embedder.encode(vocabulary, convert_to_tensor=True, normalize_embeddings=True)
+        emb = embedder.encode(queries, convert_to_tensor=True, normalize_embeddings=True)
+        return torch.topk(emb @ notes.T, top_k, dim=1).indices.tolist()
+
+    reference_ranks = rankings(reference)
+    candidate_ranks = rankings(candidate)
+
+    top1 = sum(r[0] == c[0] for r, c in zip(reference_ranks, candidate_ranks))
+    overlap = sum(len(set(r) & set(c)) / top_k for r, c in zip(reference_ranks, candidate_ranks))
+    return {
+        "queries": len(queries),
+        "top1_agreement": top1 / len(queries),
+        "topk_overlap": overlap / len(queries),
+    }
+
+
+def compare_labels(reference:List[str], candidate:List[str]) -> Dict:
+    """
+    agreement between the emotion labels of two backends
+    """
+    agree = sum(r == c for r, c in zip(reference, candidate))
+    return {
+        "overviews": len(reference),
+        "label_agreement": agree / len(reference) if reference else 0.0,
+        "disagreements": [(r, c) for r, c in zip(reference, candidate) if r != c],
+    }
+
+
+def compare_scores(reference:List[Dict[str, float]], candidate:List[Dict[str, float]]) -> Dict:
+    """
+    How far apart the emotion distributions of two backends are, as the
+    total variation distance per overview (half the summed absolute
+    differences, 0 for the same distribution and 1 for disjoint ones)
+    and the largest difference in the probability of a single label
+    """
+    distances, largest = [], 0.0
+    for r, c in zip(reference, candidate):
+        diffs = [abs(r[label] - c.get(label, 0.0)) for label in r]
+        distances.append(sum(diffs) / 2)
+        largest = max(largest, max(diffs, default=0.0))
+    return {
+        "mean_distance": sum(distances) / len(distances) if distances else 0.0,
+        "max_distance": max(distances, default=0.0),
+        "max_label_diff": largest,
+    }
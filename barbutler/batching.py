@@ -0,0 +1,91 @@
+import queue
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from typing import Any, Callable, List
+
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """
+    Collects items submitted from many threads and runs them through
+    batch_fn together. A worker thread waits for the first pending item,
+    then keeps collecting until either max_batch_size items are pending
+    or max_wait seconds have passed, and runs the whole batch at once.
+
+    batch_fn takes a list of items and must return a list of results in
+    the same order. Every caller gets a Future that resolves to its own
+    result (or to the exception raised by batch_fn).
+    """
+
+    def __init__(self, batch_fn:Callable[[List[Any]], List[Any]],
+            max_batch_size:int=8, max_wait:float=0.015, name:str="micro-batcher"):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.name = name
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+
+    def submit(self, item:Any) -> Future:
+        """
+        queues an item for the next batch, starting the worker thread on
+        first use
+        """
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                    self._thread.start()
+
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+
+    def __call__(self, item:Any) -> Any:
+        """
+        submits an item and blocks until its result is ready
+        """
+        return self.submit(item).result()
+
+
+    def _collect(self) -> list:
+        # block until there is at least one item to work on
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            items = [item for item, _ in batch]
+            futures = [future for _, future in batch]
+
+            try:
+                results = self.batch_fn(items)
+            except Exception as e:
+                logger.exception("%s batch of %d failed", self.name, len(items))
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            for future, result in zip(futures, results):
+                future.set_result(result)
@@ -0,0 +1,221 @@
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+from os.path import join, dirname, abspath
+
+from typing import Dict, List
+
+import httpx
+
+from bot_states import TASTE
+from loadtest import FakeUpdate, FakeContext
+
+import handlers
+import http_client
+import metrics
+import ratelimit
+import utils
+
+
+FIXTURES_PATH = join(dirname(abspath(__file__)), "..", "bench", "fixtures.json")
+
+
+def percentile(samples:List[float], q:float) -> float:
+    """
+    nearest rank percentile, q in [0, 100]
+    """
+    if len(samples) == 0:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def peak_rss_mb() -> float:
+    """
+    peak resident set size of this process so far. ru_maxrss is in
+    kilobytes on linux and bytes on macOS
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def install_stand_ins(fixtures:dict, api_latency:float, jitter:float, rng:random.Random) -> None:
+    """
+    Replaces TMDB and the whiskey API with a mock transport on the shared
+    HTTP client, and OpenAI with a stand-in answering from the recorded
+    completions. Every call sleeps for api_latency, +/- jitter percent,
+    drawn from the seeded rng so runs are reproducible.
+    """
+    def latency() -> float:
+        return api_latency * (1 + rng.uniform(-jitter, jitter))
+
+    async def upstream(request:httpx.Request) -> httpx.Response:
+        await asyncio.sleep(latency())
+        if request.url.host == "api.themoviedb.org":
+            movie = fixtures["tmdb"].get(utils.normalize_title(request.url.params.get("query", "")))
+            results = [movie] if movie is not None else []
+            return httpx.Response(200, json={"page": 1, "total_results": len(results), "results": results})
+        return httpx.Response(200, json=fixtures["whiskey"])
+
+    http_client._client = httpx.AsyncClient(transport=httpx.MockTransport(upstream))
+
+    @metrics.timed("openai")
+    async def create_completion(prompt:str, temperature:float, **kwargs) -> dict:
+        await asyncio.sleep(latency())
+        kind = "movie" if prompt.endswith("movie name:") else "taste"
+        text = prompt.rsplit("user: ", 1)[1].split("\n")[0]
+        completion = fixtures["completions"][kind].get(utils.normalize_reply(text), "")
+        return {
+            "choices": [{"text": completion}],
+            "usage": {"total_tokens": fixtures["completion_tokens"]},
+        }
+
+    utils.create_completion = create_completion
+
+
+def clear_caches() -> None:
+    """
+    so every request goes through the whole pipeline
+    """
+    utils.tmdb_cache.memory.clear()
+    utils.emotion_cache.memory.clear()
+    utils.gpt_cache.clear()
+    utils._classify_reply.cache_clear()
+
+
+async def run_phase(handler, messages:List[str], requests:int, concurrency:int,
+        reply_latency:float, keep_caches:bool, rng:random.Random) -> Dict:
+    """
+    Sends requests messages, drawn from messages with the seeded rng,
+    through a handler with at most concurrency in flight. Returns the
+    end to end latencies, throughput and per stage latencies.
+    """
+    metrics.registry.reset(keep_samples=True)
+    chosen = [rng.choice(messages) for _ in range(requests)]
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(text:str):
+        async with semaphore:
+            if not keep_caches:
+                clear_caches()
+            context = FakeContext()
+            context.user_data["prev_state"] = TASTE
+            start = time.perf_counter()
+            await handler(FakeUpdate(text, reply_latency), context)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(text) for text in chosen])
+    elapsed = time.perf_counter() - start
+
+    stages = {}
+    for stage, histogram in metrics.registry.histograms.items():
+        if histogram.count > 0 and not stage.startswith("handler."):
+            stages[stage] = summarize(histogram.samples)
+
+    return {
+        "requests": requests,
+        "throughput": requests / elapsed,
+        "latency": summarize(latencies),
+        "stages": stages,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def summarize(samples:List[float]) -> Dict:
+    return {
+        "count": len(samples),
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p95_ms": percentile(samples, 95) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+    }
+
+
+def print_report(report:Dict) -> None:
+    print(f"startup: {report['startup']['seconds']:.2f}s, peak rss {report['startup']['peak_rss_mb']:.0f} MB")
+    for phase, result in report["phases"].items():
+        latency = result["latency"]
+        print(f"\n{phase}: {result['throughput']:.1f} req/s, "
+              f"p50 {latency['p50_ms']:.1f} / p95 {latency['p95_ms']:.1f} / p99 {latency['p99_ms']:.1f} ms, "
+              f"peak rss {result['peak_rss_mb']:.0f} MB")
+        for stage, stats in sorted(result["stages"].items()):
+            print(f"    {stage:<26} n={stats['count']:<5} p50 {stats['p50_ms']:8.2f}  "
+                  f"p95 {stats['p95_ms']:8.2f}  p99 {stats['p99_ms']:8.2f} ms")
+
+
+async def bench(args:argparse.Namespace, fixtures:dict) -> Dict:
+    # separate generators, so the messages picked don't depend on how
+    # many latency draws happened before
+    rng = random.Random(args.seed)
+    install_stand_ins(fixtures, args.api_latency, args.jitter, random.Random(args.seed + 1))
+
+    report = {"config": vars(args), "phases": {}}
+
+    # model loading is part of what we want to catch regressions in
+    start = time.perf_counter()
+    utils.warm_up_models(include_emotion=True, background=False)
+    report["startup"] = {"seconds": time.perf_counter() - start, "peak_rss_mb": peak_rss_mb()}
+
+    phases = [
+        ("taste", handlers.rec_from_taste, fixtures["taste_messages"]),
+        ("movie", handlers.rec_from_movie, fixtures["movie_messages"]),
+        ("followup", handlers.followup, fixtures["followup_messages"]),
+    ]
+    for name, handler, messages in phases:
+        if args.phase and name not in args.phase:
+            continue
+        report["phases"][name] = await run_phase(handler, messages, args.requests,
+                args.concurrency, args.reply_latency, args.keep_caches, rng)
+
+    await http_client.close()
+    return report
+
+
+def main() -> None:
+    """
+    Offline benchmark of the recommendation pipeline. Telegram, OpenAI,
+    TMDB and the whiskey API are replaced by local stand-ins answering
+    from bench/fixtures.json with configurable latency, while the models
+    run for real. Reports latency percentiles, throughput and peak RSS
+    per handler, and latency percentiles per instrumented stage.
+    """
+    parser = argparse.ArgumentParser(description="benchmark the handlers with stubbed upstreams")
+    parser.add_argument("--fixtures", default=FIXTURES_PATH)
+    parser.add_argument("--requests", type=int, default=100, help="requests per phase")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds per upstream API call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="+/- fraction of api latency")
+    parser.add_argument("--reply-latency", type=float, default=0.0, help="seconds per telegram reply")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep-caches", action="store_true", help="don't clear caches between requests")
+    parser.add_argument("--phase", action="append", choices=["taste", "movie", "followup"])
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    with open(args.fixtures, "r") as fixtures_file:
+        fixtures = json.load(fixtures_file)
+
+    # make the models as deterministic as they can be on CPU
+    utils.torch.manual_seed(args.seed)
+    # nothing from a previous run should leak in through the disk caches
+    utils.tmdb_cache.disk = None
+    utils.emotion_cache.disk = None
+    # the upstreams are stand-ins, so there is no quota to protect
+    ratelimit.budgets.buckets.clear()
+
+    report = asyncio.run(bench(args, fixtures))
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,18 @@
+import os
 import logging
 from typing import Dict
 
-from constants import TELEGRAM_API_KEY
+from constants import (
+    TELEGRAM_API_KEY,
+    CONCURRENT_UPDATES,
+    METRICS_PORT,
+    WORKERS,
+    WEBHOOK_URL,
+    CACHE_DIR,
+    STATE_STORE,
+    STATE_FLUSH_INTERVAL,
+    STATE_SHARED,
+)
 from bot_states import (
     START,
     CHOOSING,
@@ -11,14 +22,20 @@ from bot_states import (
 )
 
 from telegram.ext import (
-    Updater,
+    Application,
     CommandHandler,
     MessageHandler,
-    Filters,
+    filters,
     ConversationHandler,
 )
 
 import handlers
+import http_client
+import metrics
+import persistence
+import utils
+import webhook
+import workers
 
 
 logging.basicConfig(
@@ -27,39 +44,95 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-updater = Updater(TELEGRAM_API_KEY, use_context=True)
-
-
-def main() -> None:
-    updater = Updater(TELEGRAM_API_KEY)
-    dispatcher = updater.dispatcher
-
-    conv_handler = ConversationHandler(
+def build_conversation_handler(persistent:bool=False) -> ConversationHandler:
+    return ConversationHandler(
         entry_points = [CommandHandler('start', handlers.start)] ,
         states={
             START: [
-                MessageHandler(Filters.text, handlers.start),
+                MessageHandler(filters.TEXT, handlers.start),
             ],
             CHOOSING: [
-                MessageHandler(Filters.text, handlers.choosing),
+                MessageHandler(filters.TEXT, handlers.choosing),
             ],
             MOVIE: [
-                MessageHandler(Filters.text, handlers.rec_from_movie),
+                MessageHandler(filters.TEXT, handlers.rec_from_movie),
             ],
             TASTE: [
-                MessageHandler(Filters.text, handlers.rec_from_taste),
+                MessageHandler(filters.TEXT, handlers.rec_from_taste),
             ],
             FOLLOWUP: [
-                MessageHandler(Filters.text, handlers.followup) ,
+                MessageHandler(filters.TEXT, handlers.followup) ,
             ],
         },
-        fallbacks=[MessageHandler(Filters.regex("^Done$"), handlers.done)],
+        fallbacks=[MessageHandler(filters.Regex("^Done$"), handlers.done)],
         name="whiskey_conversation",
+        persistent=persistent,
+    )
+
+
+async def post_shutdown(application:Application) -> None:
+    await http_client.close()
+
+
+def build_application(polling:bool=True, base_url:str=None) -> Application:
+    # handlers are async, so many conversations can be in flight at once
+    # while a slow MOVIE request waits on OpenAI, TMDB or the models. The
+    # updates of one chat are still handled in order, as the
+    # ConversationHandler requires
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_API_KEY)
+        .concurrent_updates(workers.ChatOrderedUpdateProcessor(CONCURRENT_UPDATES))
+        .post_shutdown(post_shutdown)
     )
+    # webhook and worker processes are handed their updates
+    if not polling:
+        builder = builder.updater(None)
+    # e.g. a local fake telegram server, see fake_telegram.py
+    if base_url:
+        builder = builder.base_url(base_url)
+
+    store = STATE_STORE or (os.path.join(CACHE_DIR, "state.sqlite") if CACHE_DIR else None)
+    if store:
+        state_persistence = persistence.StatePersistence(persistence.open_store(store),
+                update_interval=STATE_FLUSH_INTERVAL, shared=STATE_SHARED)
+        builder = builder.persistence(state_persistence)
+        metrics.registry.register_collector("state_store", state_persistence.stats)
+    application = builder.build()
+
+    # registered before the conversation so the admin commands work in
+    # any state
+    application.add_handler(CommandHandler("stats", handlers.stats))
+    application.add_handler(CommandHandler("reload_notes", handlers.reload_notes))
+    conversation = build_conversation_handler(persistent=bool(store))
+    application.add_handler(conversation)
+    if store and STATE_SHARED:
+        # load the chat's state before the conversation, save it after
+        for group, handler in state_persistence.shared_handlers(conversation).items():
+            application.add_handler(handler, group=group)
+    return application
+
+
+def main() -> None:
+    if WORKERS > 0:
+        workers.serve(build_application, WORKERS)
+        return
+
+    if WEBHOOK_URL:
+        if METRICS_PORT:
+            metrics.serve(METRICS_PORT)
+        webhook.serve(build_application)
+        return
+
+    application = build_application()
+
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
 
-    dispatcher.add_handler(conv_handler)
-    updater.start_polling ()
-    updater.idle()
+    # load the models in the background so that the bot can start
+    # answering /start and CHOOSING messages immediately
+    utils.warm_up_models()
+    application.run_polling()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,141 @@
+import json
+import asyncio
+import logging
+import argparse
+
+from bench import FIXTURES_PATH
+
+import backends
+import utils
+import http_client
+
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def whiskey_embeddings(args:argparse.Namespace) -> None:
+    """
+    embeds every whiskey in the local dataset for vector ranking
+    """
+    if not utils.whiskey_catalog.available:
+        logger.error("no whiskey dataset at %s", utils.whiskey_catalog.path)
+        return
+
+    embeddings = utils.build_whiskey_embeddings()
+    logger.info("wrote %s embeddings to %s", embeddings.shape, utils.whiskey_catalog.embeddings_path)
+
+
+def movie_index(args:argparse.Namespace) -> None:
+    """
+    builds the offline movie index from a TMDB daily id export
+    """
+    async def build():
+        try:
+            return await utils.build_movie_index(args.export, limit=args.limit)
+        finally:
+            await http_client.close()
+
+    written = asyncio.run(build())
+    logger.info("wrote %d movies to %s", written, utils.movie_index.path)
+
+
+def export_models(args:argparse.Namespace) -> None:
+    """
+    exports the embedder and the emotion model for a backend ahead of
+    time, so the bot doesn't export them on its first start
+    """
+    backends.load_embedder(utils.EMBEDDER_NAME, args.backend, utils.MODEL_DIR)
+    backends.load_emotion_model(utils.EMOTION_MODEL_NAME, args.backend, utils.MODEL_DIR)
+    logger.info("exported the %s models to %s", args.backend, utils.MODEL_DIR)
+
+
+def check_backend(args:argparse.Namespace) -> None:
+    """
+    Compares a backend against full precision torch on the benchmark
+    fixtures: the emotion labels and scores of the movie overviews, the
+    way BARBUTLER_EMOTION_SCORING classifies them, and the tasting
+    notes ranked for the taste messages and the emotion words. Run it
+    before switching BARBUTLER_INFERENCE_BACKEND.
+    """
+    with open(args.fixtures, "r") as fixtures_file:
+        fixtures = json.load(fixtures_file)
+
+    overviews = [movie["overview"] for movie in fixtures["tmdb"].values()]
+    queries = fixtures["taste_messages"] + utils.EMOTIONS
+    vocabulary = utils.tasting_note_index.ensure_loaded().notes
+
+    reference_model = backends.load_emotion_model(utils.EMOTION_MODEL_NAME, "torch", utils.MODEL_DIR)
+    candidate_model = backends.load_emotion_model(utils.EMOTION_MODEL_NAME, args.backend, utils.MODEL_DIR)
+    # through the same path as the bot, see BARBUTLER_EMOTION_SCORING
+    reference_emotions = utils.classify_emotions(overviews, reference_model)
+    candidate_emotions = utils.classify_emotions(overviews, candidate_model)
+    labels = backends.compare_labels([e["label"] for e in reference_emotions],
+            [e["label"] for e in candidate_emotions])
+
+    reference_embedder = backends.load_embedder(utils.EMBEDDER_NAME, "torch", utils.MODEL_DIR)
+    candidate_embedder = backends.load_embedder(utils.EMBEDDER_NAME, args.backend, utils.MODEL_DIR)
+    notes = backends.compare_embedders(reference_embedder, candidate_embedder, vocabulary, queries, top_k=args.top_k)
+
+    print(f"emotion labels: {labels['label_agreement']:.1%} of {labels['overviews']} overviews agree")
+    for reference, candidate in labels["disagreements"]:
+        print(f"    torch {reference} -> {args.backend} {candidate}")
+    if utils.EMOTION_SCORING != "generate":
+        scores = backends.compare_scores([e["scores"] for e in reference_emotions],
+                [e["scores"] for e in candidate_emotions])
+        print(f"emotion scores: total variation distance {scores['mean_distance']:.3f} on average, "
+              f"{scores['max_distance']:.3f} at most, largest label difference {scores['max_label_diff']:.3f}")
+    print(f"tasting notes: top 1 agrees for {notes['top1_agreement']:.1%} of {notes['queries']} queries, "
+          f"top {args.top_k} overlap {notes['topk_overlap']:.1%}")
+
+
+def artifacts(args:argparse.Namespace) -> None:
+    """
+    precomputes the tasting note embeddings, yes/no anchors and emotion
+    label ids the bot would otherwise compute on every start
+    """
+    manifest = utils.build_artifacts()
+    logger.info("wrote %s to %s", ", ".join(manifest["arrays"]), utils.artifact_bundle.path)
+
+
+def main() -> None:
+    """
+    Offline jobs that precompute data the bot loads at runtime
+    """
+    parser = argparse.ArgumentParser(description="build precomputed BarButler data")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("whiskey-embeddings",
+            help="embed the whiskey dataset for BARBUTLER_WHISKEY_RANKING=vector"
+        ).set_defaults(func=whiskey_embeddings)
+
+    subparsers.add_parser("artifacts",
+            help="precompute the tasting note, anchor and emotion label artifacts"
+        ).set_defaults(func=artifacts)
+
+    movie_parser = subparsers.add_parser("movie-index",
+            help="index popular movies from a TMDB export so MOVIE requests skip GPT-3 and TMDB")
+    movie_parser.add_argument("export", help="TMDB daily movie id export, e.g. movie_ids_05_15_2023.json.gz")
+    movie_parser.add_argument("--limit", type=int, default=5000, help="how many of the most popular movies to index")
+    movie_parser.set_defaults(func=movie_index)
+
+    export_parser = subparsers.add_parser("export-models",
+            help="export the models for BARBUTLER_INFERENCE_BACKEND ahead of time")
+    export_parser.add_argument("--backend", choices=backends.BACKENDS, default="onnx")
+    export_parser.set_defaults(func=export_models)
+
+    check_parser = subparsers.add_parser("check-backend",
+            help="compare an inference backend against full precision torch")
+    check_parser.add_argument("--backend", choices=backends.BACKENDS, default="int8")
+    check_parser.add_argument("--fixtures", default=FIXTURES_PATH)
+    check_parser.add_argument("--top-k", type=int, default=5)
+    check_parser.set_defaults(func=check_backend)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
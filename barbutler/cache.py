@@ -0,0 +1,253 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from typing import Any, Awaitable, Callable, Optional, Tuple
+
+
+"""
+Sentinel returned by the caches on a miss, since None can be a
+legitimately cached value
+"""
+MISSING = object()
+
+
+class TTLCache:
+    """
+    In-process LRU cache where every entry also expires after a time to
+    live. When the cache is full the least recently used entry is
+    evicted. Hits and misses are counted so the hit rate can be reported.
+    """
+
+    def __init__(self, maxsize:int=1024, ttl:float=24*60*60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, key:str, default:Any=MISSING) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            # mark as most recently used
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+
+    def set(self, key:str, value:Any, ttl:Optional[float]=None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+
+class SQLiteCache:
+    """
+    On-disk key value store with per entry expiry, so that cached values
+    survive a restart of the bot. Values are stored as JSON.
+
+    Expired entries are deleted when the cache is opened and then once
+    every purge_every writes, so the file doesn't keep growing with
+    entries nobody can read anymore.
+    """
+
+    def __init__(self, path:str, table:str="cache", ttl:float=7*24*60*60, purge_every:int=1000):
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self.hits = 0
+        self.misses = 0
+        self.purged = 0
+        self._writes = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.reopen()
+        self.purge_expired()
+
+
+    def reopen(self) -> None:
+        """
+        opens a new connection to the database. A connection must not be
+        used across a fork, so forked workers call this first
+        """
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+        self._conn.commit()
+
+
+    def get(self, key:str, default:Any=MISSING) -> Any:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ?",
+                (key,)).fetchone()
+
+            # wall clock time since the entries outlive the process
+            if row is None or row[1] < time.time():
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            return json.loads(row[0])
+
+
+    def set(self, key:str, value:Any, ttl:Optional[float]=None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time() + ttl))
+            self._conn.commit()
+
+            self._writes += 1
+            if self._writes % self.purge_every == 0:
+                self._purge()
+
+
+    def purge_expired(self) -> int:
+        """
+        deletes every expired entry, returns how many were removed
+        """
+        with self._lock:
+            return self._purge()
+
+
+    def _purge(self) -> int:
+        # callers hold self._lock
+        cursor = self._conn.execute(
+                f"DELETE FROM {self.table} WHERE expires_at < ?", (time.time(),))
+        self._conn.commit()
+        self.purged += cursor.rowcount
+        return cursor.rowcount
+
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "purged": self.purged,
+        }
+
+
+
+class TieredCache:
+    """
+    A TTLCache in front of an optional SQLiteCache. Reads check memory
+    first and then disk, promoting disk hits into memory. Writes go to
+    both.
+    """
+
+    def __init__(self, memory:TTLCache, disk:Optional[SQLiteCache]=None):
+        self.memory = memory
+        self.disk = disk
+
+
+    def get(self, key:str, default:Any=MISSING) -> Any:
+        value = self.memory.get(key)
+        if value is not MISSING:
+            return value
+
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not MISSING:
+                self.memory.set(key, value)
+                return value
+
+        return default
+
+
+    def set(self, key:str, value:Any, ttl:Optional[float]=None) -> None:
+        self.memory.set(key, value, ttl)
+        if self.disk is not None:
+            self.disk.set(key, value, ttl)
+
+
+    def stats(self) -> dict:
+        stats = {"memory": self.memory.stats()}
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats()
+
+        # a lookup only misses if it missed in every tier
+        misses = self.disk.misses if self.disk is not None else self.memory.misses
+        lookups = self.memory.hits + self.memory.misses
+        stats["hits"] = lookups - misses
+        stats["misses"] = misses
+        stats["hit_rate"] = (lookups - misses) / lookups if lookups else 0.0
+        return stats
+
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent async calls with the same key, so that only the
+    first caller actually does the work and everyone else waiting on the
+    same key shares its result.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._inflight = {}
+
+
+    async def do(self, key:str, fn:Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Returns fn()'s result and whether it was shared with a call
+        that was already in flight
+        """
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            # shield so a cancelled waiter doesn't cancel the shared call
+            return await asyncio.shield(task), True
+
+        task = asyncio.ensure_future(fn())
+        self._inflight[key] = task
+        try:
+            return await asyncio.shield(task), False
+        finally:
+            if self._inflight.get(key) is task:
+                del self._inflight[key]
@@ -5,6 +5,111 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 TMDB3_API_KEY = os.getenv("TMDB3_API_KEY")
 TMDB4_API_KEY = os.getenv("TMDB4_API_KEY")
 
+# directory for caches that should survive a restart. If unset, caches
+# only live in memory
+CACHE_DIR = os.getenv("BARBUTLER_CACHE_DIR")
+
+# how many movie overviews are run through the emotion model together,
+# and how long to wait for a batch to fill up
+EMOTION_BATCH_SIZE = int(os.getenv("BARBUTLER_EMOTION_BATCH_SIZE", "8"))
+EMOTION_BATCH_WAIT_MS = float(os.getenv("BARBUTLER_EMOTION_BATCH_WAIT_MS", "15"))
+
+# "logits" scores the six emotion labels with one decoder step, "generate"
+# decodes the label with model.generate like before. Overviews are
+# truncated to EMOTION_MAX_TOKENS tokens
+EMOTION_SCORING = os.getenv("BARBUTLER_EMOTION_SCORING", "logits")
+EMOTION_MAX_TOKENS = int(os.getenv("BARBUTLER_EMOTION_MAX_TOKENS", "256"))
+
+# whiskey-api dataset (CSV or JSON) used to recommend whiskies locally.
+# Defaults to whiskies.csv next to tasting_notes.txt
+WHISKEY_DATASET = os.getenv("BARBUTLER_WHISKEY_DATASET")
+
+# how local whiskies are ranked: "tags" for tag overlap, "vector" for
+# embedding similarity (needs `python3 barbutler/build.py whiskey-embeddings`)
+WHISKEY_RANKING = os.getenv("BARBUTLER_WHISKEY_RANKING", "tags")
+
+# cache for GPT-3 extractions of identical messages. Turning it on also
+# makes the completions deterministic (temperature 0)
+GPT_CACHE_ENABLED = os.getenv("BARBUTLER_GPT_CACHE", "1") == "1"
+GPT_CACHE_SIZE = int(os.getenv("BARBUTLER_GPT_CACHE_SIZE", "4096"))
+GPT_CACHE_TTL = float(os.getenv("BARBUTLER_GPT_CACHE_TTL", str(24*60*60)))
+
+# stream GPT-3 completions and stop reading at the end of the first line
+GPT_STREAMING = os.getenv("BARBUTLER_GPT_STREAMING", "0") == "1"
+
+# extract tasting notes with the local lexicon and embedder, and only
+# fall back to GPT-3 when they find nothing
+LOCAL_NOTE_EXTRACTION = os.getenv("BARBUTLER_LOCAL_NOTE_EXTRACTION", "1") == "1"
+
+# how the embedder and emotion model run: "torch" (full precision),
+# "int8" (dynamically quantized) or "onnx" (ONNX Runtime)
+INFERENCE_BACKEND = os.getenv("BARBUTLER_INFERENCE_BACKEND", "torch")
+
+# where `build.py artifacts` writes the precomputed embeddings and label
+# token ids. Defaults to artifacts/ next to tasting_notes.txt
+ARTIFACTS_DIR = os.getenv("BARBUTLER_ARTIFACTS_DIR")
+
+# threads that run model inference off the event loop. Also bounds how
+# many overviews can end up in one emotion batch
+INFERENCE_WORKERS = int(os.getenv("BARBUTLER_INFERENCE_WORKERS", "8"))
+
+# how many telegram updates are handled at the same time
+CONCURRENT_UPDATES = int(os.getenv("BARBUTLER_CONCURRENT_UPDATES", "64"))
+
+# where conversation states are persisted so a restart doesn't drop
+# them: a SQLite file or a redis:// url. Defaults to state.sqlite in
+# CACHE_DIR, and to no persistence if that isn't set either
+STATE_STORE = os.getenv("BARBUTLER_STATE_STORE")
+# seconds between writes of the changed conversation states
+STATE_FLUSH_INTERVAL = float(os.getenv("BARBUTLER_STATE_FLUSH_INTERVAL", "5"))
+# read the state of a chat from the store before each of its updates
+# and write it back right after, so instances that don't own the chat
+# can handle it, see persistence.StatePersistence
+STATE_SHARED = os.getenv("BARBUTLER_STATE_SHARED", "0") == "1"
+
+# worker processes forked from a parent that loads the models once, see
+# workers.py. 0 runs everything in a single process
+WORKERS = int(os.getenv("BARBUTLER_WORKERS", "0"))
+
+# every chat can send CHAT_REQUESTS_PER_MINUTE taste or movie requests
+# a minute, in bursts of up to CHAT_BURST. 0 turns the limit off
+CHAT_REQUESTS_PER_MINUTE = float(os.getenv("BARBUTLER_CHAT_REQUESTS_PER_MINUTE", "6"))
+CHAT_BURST = float(os.getenv("BARBUTLER_CHAT_BURST", "3"))
+
+# calls a minute to each upstream API, shared by all chats. 0 is unlimited
+OPENAI_PER_MINUTE = float(os.getenv("BARBUTLER_OPENAI_PER_MINUTE", "60"))
+TMDB_PER_MINUTE = float(os.getenv("BARBUTLER_TMDB_PER_MINUTE", "600"))
+WHISKEY_API_PER_MINUTE = float(os.getenv("BARBUTLER_WHISKEY_API_PER_MINUTE", "600"))
+
+# public url telegram posts updates to. If set, bot.py serves a webhook
+# on WEBHOOK_PORT instead of polling. WEBHOOK_SECRET is checked against
+# the X-Telegram-Bot-Api-Secret-Token header
+WEBHOOK_URL = os.getenv("BARBUTLER_WEBHOOK_URL")
+WEBHOOK_PORT = int(os.getenv("BARBUTLER_WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("BARBUTLER_WEBHOOK_SECRET")
+
+# webhook updates wait in a queue of at most UPDATE_QUEUE_SIZE updates
+# for one of UPDATE_WORKERS workers. Past BUSY_QUEUE_FRACTION of the
+# queue, MOVIE requests are answered with a busy message
+UPDATE_QUEUE_SIZE = int(os.getenv("BARBUTLER_UPDATE_QUEUE_SIZE", "256"))
+UPDATE_WORKERS = int(os.getenv("BARBUTLER_UPDATE_WORKERS", "32"))
+BUSY_QUEUE_FRACTION = float(os.getenv("BARBUTLER_BUSY_QUEUE_FRACTION", "0.75"))
+
+# offline index of popular movies (JSON lines) built by
+# `python3 barbutler/build.py movie-index`. Defaults to movies.jsonl next
+# to tasting_notes.txt
+MOVIE_INDEX = os.getenv("BARBUTLER_MOVIE_INDEX")
+
+# telegram user ids allowed to use /stats and /reload_notes, comma separated
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv("BARBUTLER_ADMIN_USER_IDS", "").split(",") if user_id.strip()}
+
+# port to serve Prometheus metrics on at /metrics, off if unset
+METRICS_PORT = int(os.getenv("BARBUTLER_METRICS_PORT", "0"))
+
+# timeouts in seconds for calls to TMDB and the whiskey API
+HTTP_CONNECT_TIMEOUT = float(os.getenv("BARBUTLER_HTTP_CONNECT_TIMEOUT", "3.05"))
+HTTP_READ_TIMEOUT = float(os.getenv("BARBUTLER_HTTP_READ_TIMEOUT", "10"))
+
 if __name__ == "__main__":
     print(os.environ)
     print(TELEGRAM_API_KEY)
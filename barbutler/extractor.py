@@ -0,0 +1,124 @@
+from typing import List, Tuple
+
+from note_extractor import tokenize
+
+
+class PromptTemplate:
+    """
+    Few-shot prompt for the GPT-3 Ada model. The examples are joined into
+    a prefix once, so a prompt is three strings concatenated:
+
+        user: <example message>
+        <label>: <example answer>
+
+        ...
+        user: <message>
+        <label>:
+
+    The answer is a single line, so completions are asked for at most
+    max_tokens tokens and stop at the first newline.
+    """
+
+    def __init__(self, label:str, examples:List[Tuple[str, str]], max_tokens:int):
+        self.label = label
+        self.max_tokens = max_tokens
+        self.stop = ["\n"]
+        self.prefix = "".join(f"\nuser: {message}\n{label}: {answer}\n" for message, answer in examples) + "\nuser: "
+        self.suffix = f"\n{label}:"
+
+
+    def render(self, text:str) -> str:
+        return self.prefix + text + self.suffix
+
+
+
+"""
+The model is not finetuned and is doing few-shot inferences, so every
+prompt starts with example entries
+"""
+TASTE = PromptTemplate("tasting notes", [
+    ("Hey I'm looking for a whiskey that's airy, light, and very fruity, what would you recommend?", "airy, light, fruity"),
+    ("I'm interested in a dense whiskey that is well balanced and citrusy", "dense, balanced, citrusy"),
+    ("You got any whiskey with heavy coffee and cigar flavors?", "coffee, cigar"),
+    ("what sweet whiskey would you recommend?", "sweet"),
+    ("Can you find me a malty whiskey with floral notes and smells a little bit like chocolate?", "malty, floral, chocolate"),
+    ("what is a whiskey that's mellow and has butterscotch flavors?", "mellow, butterscotch"),
+    ("Any idea what whiskey is smooth and apple flavored?", "smooth, apple"),
+    ("I'm trying to relax for the night, any suggestions for bourbon that's smokey, bitter, but also amber?", "smokey, bitter, amber"),
+], max_tokens=24)
+
+MOVIE = PromptTemplate("movie name", [
+    ("What's a good whiskey to pair with The Conjuring series?", "The Conjuring"),
+    ("What should I drink when I watch Indiana Jones?", "Indiana Jones"),
+    ("I'd like to watch the Hellraiser tonight. What should I get from the bar?", "Hellraiser"),
+    ("What would be an interesting whiskey to pair with Star Wars?", "Star Wars"),
+    ("Can you find me a whiskey to pair with Top Gun: Maverick?", "Top Gun: Maverick"),
+    ("What can I drink with Sleepless in Seattle?", "Sleepless in Seattle"),
+    ("What whiskey goes well with Knocked Up?", "Knocked Up"),
+    ("I'm trying to relax for the night with Catch Me if You Can", "Catch Me if You Can"),
+    ("what should I drink with Schindler's List?", "Schindler's list"),
+], max_tokens=16)
+
+"""
+Combined prompt for a free form first message: whether the user is
+asking based on a movie or on tasting notes, and the movie or notes
+themselves, in a single call
+"""
+INTENT = PromptTemplate("intent", [
+    ("What's a good whiskey to pair with The Conjuring series?", "movie | The Conjuring"),
+    ("I'd like something smoky and a little sweet", "taste | smoky, sweet"),
+    ("I'm watching Top Gun: Maverick tonight", "movie | Top Gun: Maverick"),
+    ("You got any whiskey with heavy coffee and cigar flavors?", "taste | coffee, cigar"),
+    ("hey there", "none |"),
+    ("Can you find me a malty whiskey with floral notes?", "taste | malty, floral"),
+    ("what should I drink with Schindler's List?", "movie | Schindler's list"),
+    ("what can you do?", "none |"),
+], max_tokens=24)
+
+
+"""
+Free form messages with fewer words than this, that weren't understood
+locally, aren't worth a GPT-3 round trip
+"""
+MIN_INTENT_WORDS = 3
+
+"""
+Words of greetings and small talk. A message made only of these is
+answered with the help text
+"""
+SMALL_TALK_WORDS = {
+    "hi", "hello", "hey", "heya", "hiya", "yo", "sup", "howdy", "there",
+    "good", "morning", "afternoon", "evening", "thanks", "thank", "you",
+    "ok", "okay", "cool", "bye", "how", "are", "what's", "whats", "up",
+    "barbutler", "bot", "buddy", "friend",
+}
+
+
+def is_small_talk(text:str) -> bool:
+    return all(word in SMALL_TALK_WORDS for word in tokenize(text))
+
+
+def first_line(completion:str) -> str:
+    """
+    the answer, in case the completion runs on past the first line
+    """
+    return completion.strip("\n").split("\n")[0].strip()
+
+
+def parse_notes(completion:str) -> List[str]:
+    return [note.strip() for note in first_line(completion).split(",") if note.strip()]
+
+
+def parse_movie(completion:str) -> str:
+    return first_line(completion)
+
+
+def parse_intent(completion:str) -> Tuple[str, str]:
+    """
+    Returns ("movie", title), ("taste", "note, note") or ("none", "")
+    """
+    intent, _, entity = first_line(completion).partition("|")
+    intent = intent.strip().lower()
+    if intent not in ("movie", "taste") or entity.strip() == "":
+        return "none", ""
+    return intent, entity.strip()
@@ -0,0 +1,220 @@
+import json
+import time
+import random
+import asyncio
+import argparse
+from collections import defaultdict
+
+from typing import Dict, List
+
+import httpx
+from aiohttp import web
+
+from bench import percentile
+from loadtest import stub_upstreams
+
+import bot
+import utils
+import webhook
+
+
+class FakeTelegram:
+    """
+    Local stand-in for the Bot API that the bot can be pointed at with
+    build_application(base_url=...). Every method succeeds, and the
+    messages the bot sends are recorded per chat with the time they
+    arrived.
+    """
+
+    def __init__(self):
+        self.messages = defaultdict(list)
+        self._message_id = 0
+        self._runner = None
+        self.base_url = None
+
+
+    async def handle(self, request:web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "BarButler", "username": "barbutler_bot"}
+        elif method == "sendMessage":
+            chat_id = int(params["chat_id"])
+            self.messages[chat_id].append((time.perf_counter(), params["text"]))
+            self._message_id += 1
+            result = {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params["text"],
+            }
+        else:
+            result = True
+
+        return web.json_response({"ok": True, "result": result})
+
+
+    async def start(self, host:str, port:int) -> None:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self.base_url = f"http://{host}:{port}/bot"
+
+
+    async def stop(self) -> None:
+        await self._runner.cleanup()
+
+
+
+def message_update(update_id:int, chat_id:int, text:str) -> Dict:
+    """
+    the update telegram would post for a private message
+    """
+    entities = [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith("/") else []
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "user"},
+            "text": text,
+            "entities": entities,
+        },
+    }
+
+
+def stub_movie_flow(api_latency:float, cpu_time:float) -> None:
+    """
+    every MOVIE message finds "Up" in the movie index, and mapping its
+    emotion to tasting notes blocks a thread for cpu_time
+    """
+    stub_upstreams(api_latency, cpu_time)
+
+    def find_movie_in_text(text):
+        return {"title": "Up", "original_title": "Up", "emotion": "joy"}
+
+    def tasting_notes_for_emotion(emotion, score_thresh=0.3, top_k=5):
+        time.sleep(cpu_time)
+        return ["sweet", "fruity"]
+
+    utils.find_movie_in_text = find_movie_in_text
+    utils.tasting_notes_for_emotion = tasting_notes_for_emotion
+    utils.embedder_ready.set()
+
+
+async def spike(args:argparse.Namespace) -> Dict:
+    """
+    Every chat starts a conversation, asks for a movie recommendation
+    at the same time as all the others, and waits for the answer. Like
+    telegram, updates answered with 503 are delivered again later.
+    """
+    rng = random.Random(args.seed)
+    telegram = FakeTelegram()
+    await telegram.start("127.0.0.1", args.telegram_port)
+
+    # no real token or state store is needed against the fake server
+    bot.TELEGRAM_API_KEY = "123:fake"
+    bot.STATE_STORE = bot.CACHE_DIR = None
+    application = bot.build_application(polling=False, base_url=telegram.base_url)
+    server = webhook.WebhookServer(application, path="/telegram", queue_size=args.queue_size,
+            num_workers=args.workers, busy_fraction=args.busy_fraction)
+
+    update_ids = iter(range(1, 1_000_000))
+    movie_sent = {}
+    redeliveries = 0
+
+    async def deliver(client:httpx.AsyncClient, chat_id:int, text:str) -> None:
+        nonlocal redeliveries
+        update = message_update(next(update_ids), chat_id, text)
+        while True:
+            r = await client.post(f"http://127.0.0.1:{args.port}/telegram", json=update)
+            if r.status_code != 503:
+                return
+            redeliveries += 1
+            await asyncio.sleep(args.redelivery_delay * (1 + rng.random()))
+
+    async def chat(client:httpx.AsyncClient, chat_id:int) -> None:
+        # sent back to back, so they are only answered in order if the
+        # queue keeps the order of a chat
+        await deliver(client, chat_id, "/start")
+        await deliver(client, chat_id, "movie")
+        while len(telegram.messages[chat_id]) < 2:
+            await asyncio.sleep(0.01)
+
+        movie_sent[chat_id] = time.perf_counter()
+        await deliver(client, chat_id, "what should I drink with Up?")
+
+    def answered(chat_id:int) -> bool:
+        return any(text.startswith(("Alright I got it", webhook.BUSY_TEXT))
+                for _, text in telegram.messages[chat_id])
+
+    async with application:
+        await application.start()
+        await server.start("127.0.0.1", args.port)
+
+        start = time.perf_counter()
+        async with httpx.AsyncClient(timeout=30) as client:
+            await asyncio.gather(*[chat(client, chat_id) for chat_id in range(1, args.chats + 1)])
+        while not all(answered(chat_id) for chat_id in movie_sent):
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - start
+
+        await server.stop()
+        await application.stop()
+    await telegram.stop()
+
+    latencies, out_of_order = [], 0
+    for chat_id, sent in movie_sent.items():
+        texts = [text for _, text in telegram.messages[chat_id]]
+        if not (texts[0].startswith("Welcome") and texts[1].startswith("Perfect")):
+            out_of_order += 1
+        done = [at for at, text in telegram.messages[chat_id] if text.startswith("Alright I got it")]
+        if done:
+            latencies.append(done[0] - sent)
+
+    return {
+        "chats": args.chats,
+        "seconds": elapsed,
+        "recommended": len(latencies),
+        "busy_replies": server.busy_replies,
+        "redeliveries": redeliveries,
+        "out_of_order": out_of_order,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def main() -> None:
+    """
+    Runs the webhook server against a local fake telegram during a
+    traffic spike, with the upstream APIs and models stubbed, and
+    reports how many MOVIE requests were answered or turned away and
+    the latency of the ones that were answered.
+    """
+    parser = argparse.ArgumentParser(description="spike test the webhook against a fake telegram")
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--queue-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--busy-fraction", type=float, default=0.75)
+    parser.add_argument("--api-latency", type=float, default=0.2, help="seconds per upstream API call")
+    parser.add_argument("--cpu-time", type=float, default=0.01, help="seconds of model time per request")
+    parser.add_argument("--redelivery-delay", type=float, default=0.5, help="seconds before a 503 is delivered again")
+    parser.add_argument("--port", type=int, default=8444)
+    parser.add_argument("--telegram-port", type=int, default=8445)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    stub_movie_flow(args.api_latency, args.cpu_time)
+    print(json.dumps(asyncio.run(spike(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
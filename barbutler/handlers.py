@@ -1,4 +1,13 @@
+import time
+import asyncio
+import logging
+import functools
+
 import utils
+import metrics
+import extractor
+import ratelimit
+from constants import ADMIN_USER_IDS
 
 from bot_states import (
     START,
@@ -9,7 +18,7 @@ from bot_states import (
 )
 
 from telegram import ReplyKeyboardMarkup, ReplyKeyboardMarkup, Update
-from telegram.ext import CallbackContext
+from telegram.ext import ContextTypes
 
 reply_keyboard = [
     ["tasting notes", "movie"],
@@ -17,6 +26,8 @@ reply_keyboard = [
 ]
 markup = ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True)
 
+logger = logging.getLogger(__name__)
+
 
 def help_str() -> str:
     """
@@ -26,7 +37,71 @@ def help_str() -> str:
 
 
 
-def start(update:Update, context:CallbackContext) -> int:
+async def timed(timings:dict, stage:str, awaitable):
+    """
+    awaits a stage of a handler and records how long it took, in ms,
+    into timings
+    """
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        timings[stage] = round((time.perf_counter() - start) * 1000, 1)
+
+
+
+async def chat_allowed(update:Update) -> bool:
+    """
+    takes a request off the chat's rate limit, or tells the user to slow
+    down if there is none left
+    """
+    chat = update.effective_chat
+    if ratelimit.allow_chat(chat.id if chat is not None else None):
+        return True
+    await update.message.reply_text("Whoa, that's a lot of questions at once! Give me a few seconds and ask me again.")
+    return False
+
+
+
+def limited(state:int):
+    """
+    Guards a handler that calls the expensive upstreams. A chat that
+    sends requests faster than its rate limit, or a request that would
+    go over the budget of an upstream API, gets a reply asking to try
+    again in a bit and the conversation stays in state.
+
+    The chat limit isn't checked again if allowed=True is passed, i.e.
+    the request was already let through by choosing.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update:Update, context:ContextTypes.DEFAULT_TYPE, *args, allowed:bool=False, **kwargs):
+            if not allowed and not await chat_allowed(update):
+                return state
+
+            try:
+                return await handler(update, context, *args, **kwargs)
+            except ratelimit.BudgetExceeded as e:
+                logger.warning("%s, turning a request away", e)
+                await update.message.reply_text("I'm getting a lot of requests right now, could you ask me again in a minute?")
+                return state
+        return wrapper
+    return decorator
+
+
+
+def warming_up_str() -> str:
+    """
+    Returns a note to append to a reply if the models are still
+    loading in the background, otherwise an empty string
+    """
+    if utils.embedder_ready.is_set():
+        return ""
+    return "\n\n(I just woke up, so my first answer might take a few extra seconds)"
+
+
+
+async def start(update:Update, context:ContextTypes.DEFAULT_TYPE) -> int:
     """
     Entry point for the chatbot. Prints the greeting and the help
     string, then puts the network in the CHOOSING state in which
@@ -35,12 +110,12 @@ def start(update:Update, context:CallbackContext) -> int:
     """
     reply_text = "Welcome, my name is BarButler. I give out whiskey recommendations\n\n" + help_str()
 
-    update.message.reply_text(reply_text, reply_markup=markup)
+    await update.message.reply_text(reply_text, reply_markup=markup)
     return CHOOSING
 
 
 
-def choosing(update:Update, context:CallbackContext) -> int:
+async def choosing(update:Update, context:ContextTypes.DEFAULT_TYPE) -> int:
     """
     Handler for the CHOOSING state. If the user input includes the word
     "movie" then it will put the chatbot in the MOVIE mode from which
@@ -50,40 +125,65 @@ def choosing(update:Update, context:CallbackContext) -> int:
     TASTE state in which the user will be able to describe what kind of
     tasting notes they want from their whiskey
 
-    If neither phrases were entered, then the bot puts itself back in
+    Anything else is taken as a request in itself, e.g. "what goes with
+    the godfather?" or "something smoky", and the movie or tasting notes
+    are extracted along with what the user wants in a single call, see
+    utils.extract_intent
+
+    If neither could be worked out, then the bot puts itself back in
     CHOOSING state until it can undersatnd what the user wants
     """
     choice = CHOOSING
     text = update.message.text.lower()
 
     if "movie" in text:
-        update.message.reply_text("Perfect, what movie are you going to watch today?")
+        await update.message.reply_text("Perfect, what movie are you going to watch today?" + warming_up_str())
         choice = MOVIE
         return choice
 
-    elif "tasting notes" in text:
-        update.message.reply_text("Wonderful, what kind of whiskey are you looking for in terms of taste?")
+    if "tasting notes" in text:
+        await update.message.reply_text("Wonderful, what kind of whiskey are you looking for in terms of taste?" + warming_up_str())
         choice = TASTE
         return choice
 
-    else:
-        update.message.reply_text("Sorry didn't understand that\n\n" + help_str())
+    # "hi" or "thanks" aren't worth a GPT-3 round trip or a request
+    # from the rate limit
+    if extractor.is_small_talk(text):
+        await update.message.reply_text(help_str(), reply_markup=markup)
         return CHOOSING
 
+    if not await chat_allowed(update):
+        return CHOOSING
+
+    try:
+        intent, entity = await utils.extract_intent(update.message.text)
+    except ratelimit.BudgetExceeded:
+        intent, entity = "none", None
 
+    if intent == "movie":
+        return await rec_from_movie(update, context, movie_title=entity, allowed=True)
+    if intent == "taste" and len(entity) > 0:
+        return await rec_from_taste(update, context, notes=entity, allowed=True)
 
-def help(update:Update, context:CallbackContext):
+    await update.message.reply_text("Sorry didn't understand that\n\n" + help_str())
+    return CHOOSING
+
+
+
+async def help(update:Update, context:ContextTypes.DEFAULT_TYPE):
     """
     If the bot is put in the help state, it will send the help string
     then put the bot back in the START position.
     """
     help_text = help_str()
-    update.message.reply_text(help_text, reply_markup=markup)
+    await update.message.reply_text(help_text, reply_markup=markup)
     return START
 
 
 
-def rec_from_movie(update:Update, context:CallbackContext):
+@metrics.timed("handler.rec_from_movie")
+@limited(MOVIE)
+async def rec_from_movie(update:Update, context:ContextTypes.DEFAULT_TYPE, movie_title:str=None):
     """
     This handler is for when the bot is in the MOVIE state. In this
     state, the user is expected to tell the bot what movie the user
@@ -96,67 +196,97 @@ def rec_from_movie(update:Update, context:CallbackContext):
 
     Finally, with that information, it will query the whiskey API
     to find the whiskies with the most similar tasting notes
+
+    Stages that don't depend on each other run concurrently, e.g. the
+    replies to the user are sent while the emotion model and the whiskey
+    API are working. The time each stage took is logged.
+
+    movie_title is passed in when it was already extracted from the
+    message, see choosing
     """
 
     # set the current state so that when the user is asked
     # a followup question, it can know whether to ask for a new movie
     # or new tasting notes
     context.user_data["prev_state"] = MOVIE
+    timings = {}
 
-    # extract the movie title from natural language
-    movie_title = utils.extract_movie_from_str(update.message.text)
-    # if no movie could be found, then ask another time
-    if(movie_title == ""):
-        reply_text = "I didn't find any movie with that title. Could you say that again?"
-        update.message.reply_text(reply_text)
-        return MOVIE
-
-    # if the movie title could be extracted, query the movie database
-    # and search for a movie with that title
-    movie_data = utils.retrieve_movie_from_title(movie_title)
-    # if the movie is not found in the database, then ask for a new
-    # movie title
-    if(movie_data["total_results"] == 0):
-        reply_text = f"Sorry, couldn't find a movie with the title {movie_title}. What were you going to watch again?"
-        update.message.reply_text(reply_text)
-        return MOVIE
+    # popular movies are found in the offline index without any network
+    # calls, and their emotion is already known
+    movie = utils.find_movie_in_text(movie_title or update.message.text)
+    if movie is not None:
+        movie_title = movie["title"]
+    else:
+        # extract the movie title from natural language
+        if movie_title is None:
+            movie_title = await timed(timings, "extract_title",
+                    utils.extract_movie_from_str(update.message.text))
+        # if no movie could be found, then ask another time
+        if(movie_title == ""):
+            reply_text = "I didn't find any movie with that title. Could you say that again?"
+            await update.message.reply_text(reply_text)
+            return MOVIE
+
+        # if the movie title could be extracted, query the movie database
+        # and search for a movie with that title
+        movie_data = await timed(timings, "tmdb", utils.retrieve_movie_from_title(movie_title))
+        # if the movie is not found in the database, then ask for a new
+        # movie title
+        if(movie_data["total_results"] == 0):
+            reply_text = f"Sorry, couldn't find a movie with the title {movie_title}. What were you going to watch again?"
+            await update.message.reply_text(reply_text)
+            return MOVIE
+
+        movie = movie_data["results"][0]
+
+    async def movie_mood():
+        # get the description of the movie then extract the emotion
+        # conveyed by that description
+        emotion, scores = movie.get("emotion"), movie.get("emotion_scores", {})
+        if emotion is None:
+            result = await timed(timings, "emotion",
+                    utils.run_blocking(utils.extract_emotion_scores, movie["overview"]))
+            emotion, scores = result["label"], result["scores"]
+
+        # Then search the embeddings of tasting notes for notes that are
+        # most similar to that particular emotion. There are only six
+        # emotions, so these are precomputed
+
+        # WARN this is where the non-statistically valid thing happens
+        # it is not guaranteed that these two embeddings lie on the same
+        # latent space that we want. I would further finetune a bert
+        # network to do this compression op better if I had more time
+        tasting_notes = await timed(timings, "tasting_notes",
+                utils.run_blocking(utils.tasting_notes_for_emotion, emotion))
+
+        # when the model is torn between two emotions, look for a whiskey
+        # that has a bit of both
+        secondary = utils.secondary_emotion(scores)
+        if secondary is not None:
+            secondary_notes = await utils.run_blocking(utils.tasting_notes_for_emotion, secondary)
+            tasting_notes += [note for note in secondary_notes if note not in tasting_notes][:2]
+            emotion = f"{emotion} with some {secondary}"
+        return emotion, tasting_notes
 
     # if the movie is found, report to the user that the bot
-    # knows about the movie
-    movie = movie_data["results"][0]
+    # knows about the movie while the emotion model runs
     reply_text = f"{movie['original_title']} is a great movie. Let me find a whiskey that matches the mood of this movie!"
-    update.message.reply_text(reply_text)
-
-
-    # get the description of the movie then extract the emotion
-    # conveyed by that description
-    movie_description = movie["overview"]
-    emotion = utils.extract_emotion_from_text(movie_description)
-
-    # Then search the embeddings of tasting notes for notes that are
-    # most similar to that particular emotion
-
-    # WARN this is where the non-statistically valid thing happens
-    # it is not guaranteed that these two embeddings lie on the same
-    # latent space that we want. I would further finetune a bert
-    # network to do this compression op better if I had more time
-    tasting_notes = utils.search_tasting_notes(
-            [emotion],
-            score_thresh=0.3,
-            top_k=5)
-
-    # tasting_notes is a 2d array, so flatten for our purposes
-    tasting_notes = utils.flatten_list(tasting_notes)
+    _, (emotion, tasting_notes) = await asyncio.gather(
+            timed(timings, "reply_found", update.message.reply_text(reply_text)),
+            movie_mood())
 
+    # use the extracted tasting notes to find the right whiskey, while
+    # telling the user what the bot is looking for
     reply_text = f"I sense {emotion} from this movie. I'll try to find you a whiskey that is {', '.join(tasting_notes)}"
-    update.message.reply_text(reply_text)
+    _, whiskey_recs = await asyncio.gather(
+            timed(timings, "reply_mood", update.message.reply_text(reply_text)),
+            timed(timings, "whiskey", utils.retrieve_whiskey_based_on_tags(tasting_notes)))
 
-    # use the extracted tasting notes to find the right whiskey
-    whiskey_recs = utils.retrieve_whiskey_based_on_tags(tasting_notes)
+    logger.info("rec_from_movie stage timings (ms): %s", timings)
 
     if whiskey_recs["count"] == 0:
         reply_text = f"Sorry, there were no whiskies that goes well with  {movie_title}"
-        update.message.reply_text(reply_text)
+        await update.message.reply_text(reply_text)
         return START
 
     reply_text = "Alright I got it! I would recommend the "
@@ -166,13 +296,15 @@ def rec_from_movie(update:Update, context:CallbackContext):
         reply_text += rec["description"] + "\n"
         reply_text += f"The {rec['title']} goes for about {rec['price']} on the market."
 
-    update.message.reply_text(reply_text)
-    update.message.reply_text("Would you like another recommendation?")
+    await update.message.reply_text(reply_text)
+    await update.message.reply_text("Would you like another recommendation?")
     return FOLLOWUP
 
 
 
-def rec_from_taste(update:Update, context:CallbackContext):
+@metrics.timed("handler.rec_from_taste")
+@limited(TASTE)
+async def rec_from_taste(update:Update, context:ContextTypes.DEFAULT_TYPE, notes:list=None):
     """
     When the bot is in TASTE state, it waits for the user to give it a
     natural language description of what the whiskey should taste like.
@@ -182,29 +314,33 @@ def rec_from_taste(update:Update, context:CallbackContext):
     similar tasting note from the ~50 tasting notes we have in the
     database. For more explanations, see the utility function:
     search_tasting_notes().
+
+    notes are passed in when they were already extracted from the
+    message, see choosing
     """
     # set context for followup question
     context.user_data["prev_state"] = TASTE
 
-    notes = utils.extract_tasting_notes_from_str(update.message.text)
+    if notes is None:
+        notes = await utils.extract_tasting_notes_from_str(update.message.text)
 
     if(len(notes) == 0):
         reply_text = "I didn't get any flavor names from your text. Could you say that again?"
-        update.message.reply_text(reply_text)
+        await update.message.reply_text(reply_text)
         return TASTE
 
     # search tasting notes
-    notes_from_db = utils.search_tasting_notes(notes)
+    notes_from_db = await utils.run_blocking(utils.search_tasting_notes, notes)
     notes_from_db = utils.flatten_list(notes_from_db)
 
     reply_text = f"Perfect. Looking for whiskies that are {', '.join(notes_from_db)}. Give me a second"
-    update.message.reply_text(reply_text)
+    await update.message.reply_text(reply_text)
 
     # get the whiskey with the tasting notes closest to the notes given
-    whiskey_recs = utils.retrieve_whiskey_based_on_tags(notes_from_db)
+    whiskey_recs = await utils.retrieve_whiskey_based_on_tags(notes_from_db, query=update.message.text)
     if whiskey_recs["count"] == 0:
         reply_text = "Sorry, there were no whiskies with the flavors you were looking for"
-        update.message.reply_text(reply_text)
+        await update.message.reply_text(reply_text)
         return START
 
     reply_text = "Alright I got it! I would recommend the "
@@ -214,13 +350,14 @@ def rec_from_taste(update:Update, context:CallbackContext):
         reply_text += rec["description"] + "\n"
         reply_text += f"The {rec['title']} goes for about ${rec['price']} on the market."
 
-    update.message.reply_text(reply_text)
-    update.message.reply_text("Would you like another recommendation?")
+    await update.message.reply_text(reply_text)
+    await update.message.reply_text("Would you like another recommendation?")
     return FOLLOWUP
 
 
 
-def followup(update:Update, context:CallbackContext):
+@metrics.timed("handler.followup")
+async def followup(update:Update, context:ContextTypes.DEFAULT_TYPE):
     """
     in the FOLLOWUP state, the bot asks whether the user would want
     another recommendation. If the previous state was TASTE, then
@@ -231,18 +368,49 @@ def followup(update:Update, context:CallbackContext):
 
     # look at yes_or_no_from_text documentation for more info on
     # how this works
-    answer = utils.yes_or_no_from_text(update.message.text)
+    answer = await utils.run_blocking(utils.yes_or_no_from_text, update.message.text)
     if answer and context.user_data["prev_state"] == TASTE:
-        update.message.reply_text("Perfect, enter in another description of a whiskey you want to drink.")
+        await update.message.reply_text("Perfect, enter in another description of a whiskey you want to drink.")
         return TASTE
     if answer and context.user_data["prev_state"] == MOVIE:
-        update.message.reply_text("Perfect, enter in another movie you were going to watch.")
+        await update.message.reply_text("Perfect, enter in another movie you were going to watch.")
         return MOVIE
 
-    update.message.reply_text("Alright, I'll see you later!")
+    await update.message.reply_text("Alright, I'll see you later!")
     return START
 
 
 
-def done(update:Update, context:CallbackContext):
+async def done(update:Update, context:ContextTypes.DEFAULT_TYPE):
     pass
+
+
+
+async def stats(update:Update, context:ContextTypes.DEFAULT_TYPE):
+    """
+    Admin only /stats command. Replies with the latency of every
+    instrumented stage and the cache hit rates. Anyone not listed in
+    BARBUTLER_ADMIN_USER_IDS is ignored.
+    """
+    if update.effective_user is None or update.effective_user.id not in ADMIN_USER_IDS:
+        return
+
+    await update.message.reply_text(metrics.registry.render_summary())
+
+
+
+async def reload_notes(update:Update, context:ContextTypes.DEFAULT_TYPE):
+    """
+    Admin only /reload_notes command. Re-reads tasting_notes.txt after
+    it was edited, see utils.reload_tasting_notes. With worker processes
+    only the worker the admin's chat goes to is reloaded.
+    """
+    if update.effective_user is None or update.effective_user.id not in ADMIN_USER_IDS:
+        return
+
+    changed = await utils.run_blocking(utils.reload_tasting_notes)
+    count = len(utils.tasting_note_index.notes or [])
+    if changed:
+        await update.message.reply_text(f"Reloaded {count} tasting notes.")
+    else:
+        await update.message.reply_text(f"The {count} tasting notes haven't changed.")
@@ -0,0 +1,111 @@
+import time
+import random
+import asyncio
+import logging
+
+import httpx
+
+from constants import HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+
+
+logger = logging.getLogger(__name__)
+
+"""
+Shared async client for every outbound API call (TMDB, the whiskey API).
+The client keeps a pool of keep-alive connections per host, so calls
+after the first one skip the TCP and TLS handshake.
+
+Idempotent GETs are retried a bounded number of times with exponential
+backoff on connection errors and on 429/5xx responses.
+"""
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.3
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+"""
+longest Retry-After we are willing to wait inside a handler, in seconds.
+If the upstream asks for more we give up and hand back its response
+"""
+MAX_RETRY_AFTER = 5
+
+LIMITS = httpx.Limits(
+    max_connections=64,
+    max_keepalive_connections=16,
+    keepalive_expiry=30)
+
+_client = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """
+    returns the shared client, creating it on first use. Must be called
+    from inside the event loop the bot runs in
+    """
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            # pools connections per host and retries connection failures
+            transport=httpx.AsyncHTTPTransport(limits=LIMITS, retries=1))
+    return _client
+
+
+async def close() -> None:
+    """
+    closes the pooled connections, called on shutdown
+    """
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def redact(params:dict) -> dict:
+    """
+    hides API keys so that params can be logged
+    """
+    return {k: ("***" if "key" in k.lower() else v) for k, v in (params or {}).items()}
+
+
+def backoff(attempt:int) -> float:
+    """
+    exponential backoff with a bit of jitter, in seconds
+    """
+    return BACKOFF_FACTOR * (2 ** attempt) * (0.5 + random.random() / 2)
+
+
+async def get(url:str, params:dict=None, timeout=None) -> httpx.Response:
+    """
+    GETs url through the shared client with connect and read timeouts,
+    so that one slow upstream can't hang a handler forever. Transient
+    failures are retried with backoff. The request is logged at debug
+    level.
+    """
+    client = get_client()
+
+    start = time.perf_counter()
+    for attempt in range(MAX_RETRIES + 1):
+        last_attempt = attempt == MAX_RETRIES
+        try:
+            r = await client.get(url, params=params, timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT)
+        except httpx.TransportError:
+            if last_attempt:
+                raise
+            await asyncio.sleep(backoff(attempt))
+            continue
+
+        if r.status_code not in RETRY_STATUSES or last_attempt:
+            break
+
+        # honour Retry-After when the upstream rate limits us, unless it
+        # would hold the handler for longer than MAX_RETRY_AFTER
+        retry_after = r.headers.get("Retry-After", "")
+        if retry_after.isdigit() and float(retry_after) > MAX_RETRY_AFTER:
+            break
+        delay = float(retry_after) if retry_after.isdigit() else backoff(attempt)
+        await asyncio.sleep(delay)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("GET %s params=%s status=%d attempts=%d elapsed_ms=%.1f",
+                url, redact(params), r.status_code, attempt + 1, (time.perf_counter() - start) * 1000)
+    return r
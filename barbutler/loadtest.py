@@ -0,0 +1,115 @@
+import time
+import asyncio
+import itertools
+import argparse
+
+import handlers
+import utils
+
+
+class FakeMessage:
+    """
+    Stands in for telegram.Message, replies are only recorded
+    """
+
+    def __init__(self, text:str, reply_latency:float):
+        self.text = text
+        self.replies = []
+        self.reply_latency = reply_latency
+
+
+    async def reply_text(self, text:str, **kwargs) -> None:
+        await asyncio.sleep(self.reply_latency)
+        self.replies.append(text)
+
+
+
+class FakeChat:
+    def __init__(self, chat_id:int):
+        self.id = chat_id
+
+
+
+class FakeUpdate:
+    # every update is from a different chat, so the per chat rate limit
+    # doesn't kick in
+    chat_ids = itertools.count(1)
+
+    def __init__(self, text:str, reply_latency:float):
+        self.message = FakeMessage(text, reply_latency)
+        self.effective_chat = FakeChat(next(FakeUpdate.chat_ids))
+
+
+
+class FakeContext:
+    def __init__(self):
+        self.user_data = {}
+
+
+
+def stub_upstreams(api_latency:float, cpu_time:float) -> None:
+    """
+    Replaces OpenAI, the whiskey API and the embedder with stand-ins of
+    a fixed latency. API calls sleep on the event loop, the embedder
+    stand-in blocks its thread like real inference would.
+    """
+    async def extract_tasting_notes_from_str(text):
+        await asyncio.sleep(api_latency)
+        return ["smoky", "sweet"]
+
+    async def retrieve_whiskey_based_on_tags(tags, price=None, query=None):
+        await asyncio.sleep(api_latency)
+        return {"count": 1, "results": [{"title": "Test Dram", "description": "", "price": 42}]}
+
+    def search_tasting_notes(queries, score_thresh=0.5, top_k=1):
+        time.sleep(cpu_time)
+        return [[query] for query in queries]
+
+    utils.extract_tasting_notes_from_str = extract_tasting_notes_from_str
+    utils.retrieve_whiskey_based_on_tags = retrieve_whiskey_based_on_tags
+    utils.search_tasting_notes = search_tasting_notes
+
+
+async def run(requests:int, concurrent:bool, reply_latency:float) -> float:
+    """
+    Sends TASTE messages through handlers.rec_from_taste, either one at
+    a time (like the old synchronous dispatcher) or all at once. Returns
+    the throughput in requests per second
+    """
+    updates = [FakeUpdate("something smoky and sweet", reply_latency) for _ in range(requests)]
+
+    start = time.perf_counter()
+    if concurrent:
+        await asyncio.gather(*[handlers.rec_from_taste(update, FakeContext()) for update in updates])
+    else:
+        for update in updates:
+            await handlers.rec_from_taste(update, FakeContext())
+    elapsed = time.perf_counter() - start
+
+    return requests / elapsed
+
+
+def main() -> None:
+    """
+    Shows the throughput difference between handling TASTE requests one
+    after another and handling them concurrently on the event loop, with
+    every upstream stubbed out so no network access or models are needed
+    """
+    parser = argparse.ArgumentParser(description="load test the TASTE handler with stubbed upstreams")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--api-latency", type=float, default=0.2, help="seconds per OpenAI/whiskey API call")
+    parser.add_argument("--reply-latency", type=float, default=0.05, help="seconds per telegram reply")
+    parser.add_argument("--cpu-time", type=float, default=0.01, help="seconds per embedder call")
+    args = parser.parse_args()
+
+    stub_upstreams(args.api_latency, args.cpu_time)
+
+    sequential = asyncio.run(run(args.requests, False, args.reply_latency))
+    concurrent = asyncio.run(run(args.requests, True, args.reply_latency))
+
+    print(f"sequential: {sequential:8.1f} req/s")
+    print(f"concurrent: {concurrent:8.1f} req/s  ({concurrent / sequential:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+import time
+import bisect
+import logging
+import asyncio
+import functools
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from typing import Callable, Dict, List
+
+
+logger = logging.getLogger(__name__)
+
+"""
+Upper bounds of the latency histogram buckets, in seconds. Wide enough
+for a microsecond lexical match and a multi second GPT-3 call
+"""
+BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+
+class Histogram:
+    """
+    Latency histogram of a single stage along with its error count.
+    Recording a sample is a bisect and a few additions under a lock.
+    """
+
+    def __init__(self, buckets:List[float]=BUCKETS, keep_samples:bool=False):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+        # raw samples for exact percentiles, only kept by the benchmarks
+        self.samples = [] if keep_samples else None
+        self._lock = threading.Lock()
+
+
+    def observe(self, seconds:float, error:bool=False) -> None:
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.bucket_counts[i] += 1
+            self.count += 1
+            self.sum += seconds
+            if error:
+                self.errors += 1
+            if self.samples is not None:
+                self.samples.append(seconds)
+
+
+    def quantile(self, q:float) -> float:
+        """
+        estimates a quantile as the upper bound of the bucket it falls in
+        """
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.bucket_counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+
+
+class Registry:
+    """
+    Holds a Histogram per instrumented stage, and collectors: callables
+    returning a dict of numbers (e.g. cache stats) that are read when
+    the metrics are rendered rather than on the hot path.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.collectors = {}
+        self._lock = threading.Lock()
+
+
+    def histogram(self, stage:str) -> Histogram:
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(stage, Histogram())
+        return histogram
+
+
+    def reset(self, keep_samples:bool=False) -> None:
+        """
+        zeroes every histogram in place, so functions that were already
+        decorated keep recording into them
+        """
+        for histogram in self.histograms.values():
+            with histogram._lock:
+                histogram.bucket_counts = [0] * (len(histogram.buckets) + 1)
+                histogram.count = 0
+                histogram.sum = 0.0
+                histogram.errors = 0
+                histogram.samples = [] if keep_samples else None
+
+
+    def register_collector(self, name:str, collect:Callable[[], Dict[str, float]]) -> None:
+        self.collectors[name] = collect
+
+
+    @contextmanager
+    def stage(self, name:str):
+        """
+        context manager that records how long the block took and whether
+        it raised
+        """
+        histogram = self.histogram(name)
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            histogram.observe(time.perf_counter() - start, error=True)
+            raise
+        histogram.observe(time.perf_counter() - start)
+
+
+    def timed(self, name:str) -> Callable:
+        """
+        decorator version of stage that works for both regular and async
+        functions
+        """
+        def decorator(fn):
+            histogram = self.histogram(name)
+
+            if asyncio.iscoroutinefunction(fn):
+                @functools.wraps(fn)
+                async def async_wrapper(*args, **kwargs):
+                    start = time.perf_counter()
+                    try:
+                        result = await fn(*args, **kwargs)
+                    except BaseException:
+                        histogram.observe(time.perf_counter() - start, error=True)
+                        raise
+                    histogram.observe(time.perf_counter() - start)
+                    return result
+                return async_wrapper
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException:
+                    histogram.observe(time.perf_counter() - start, error=True)
+                    raise
+                histogram.observe(time.perf_counter() - start)
+                return result
+            return wrapper
+
+        return decorator
+
+
+    def collect(self) -> Dict[str, Dict[str, float]]:
+        collected = {}
+        for name, collect in self.collectors.items():
+            try:
+                collected[name] = collect()
+            except Exception:
+                logger.exception("collector %s failed", name)
+        return collected
+
+
+    def render_prometheus(self) -> str:
+        """
+        renders every metric in the Prometheus text exposition format
+        """
+        lines = [
+            "# HELP barbutler_stage_seconds Latency of each instrumented stage",
+            "# TYPE barbutler_stage_seconds histogram",
+        ]
+        for stage, histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.bucket_counts):
+                cumulative += count
+                lines.append(f'barbutler_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'barbutler_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+            lines.append(f'barbutler_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'barbutler_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+
+        lines.append("# HELP barbutler_stage_errors_total Exceptions raised by each instrumented stage")
+        lines.append("# TYPE barbutler_stage_errors_total counter")
+        for stage, histogram in sorted(self.histograms.items()):
+            lines.append(f'barbutler_stage_errors_total{{stage="{stage}"}} {histogram.errors}')
+
+        for name, values in sorted(self.collect().items()):
+            for key, value in sorted(values.items()):
+                if isinstance(value, (int, float)):
+                    lines.append(f"barbutler_{name}_{key} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+    def render_summary(self) -> str:
+        """
+        short human readable summary for the /stats command
+        """
+        lines = ["stage: count, errors, p50/p95/p99 ms"]
+        for stage, h in sorted(self.histograms.items()):
+            if h.count == 0:
+                continue
+            p50, p95, p99 = (h.quantile(q) * 1000 for q in (0.5, 0.95, 0.99))
+            lines.append(f"{stage}: {h.count}, {h.errors}, <{p50:g}/<{p95:g}/<{p99:g}")
+
+        for name, values in sorted(self.collect().items()):
+            stats = ", ".join(f"{key}={value:.2f}" if isinstance(value, float) else f"{key}={value}"
+                    for key, value in values.items() if isinstance(value, (int, float)))
+            lines.append(f"{name}: {stats}")
+
+        return "\n".join(lines)
+
+
+
+"""
+Registry shared by the whole bot
+"""
+registry = Registry()
+stage = registry.stage
+timed = registry.timed
+
+
+def serve(port:int, host:str="0.0.0.0") -> ThreadingHTTPServer:
+    """
+    serves registry.render_prometheus() at /metrics from a daemon thread
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("serving metrics on :%d/metrics", port)
+    return server
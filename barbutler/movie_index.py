@@ -0,0 +1,278 @@
+import re
+import gzip
+import difflib
+import json
+import threading
+from os.path import exists
+from collections import defaultdict
+
+from typing import Dict, Iterable, List, Optional, Set
+
+from note_extractor import STOPWORDS, SYNONYMS
+
+
+"""
+Longest title, in words, that is looked for inside a message
+"""
+MAX_TITLE_WORDS = 8
+
+"""
+Words that are also movie titles ("Up", "Her", "Tonight") but are far
+more likely to just be part of the sentence
+"""
+COMMON_WORDS = STOPWORDS | {
+    "up", "her", "him", "us", "them", "watch", "watching", "movie", "movies",
+    "film", "night", "weekend", "family", "friends", "wife", "husband",
+    "pair", "pairing", "goes", "well", "go", "drink", "whiskey", "relax",
+    "trying", "planning", "going", "see", "new", "old", "series", "first",
+}
+
+"""
+Tasting notes people ask for that are also one word titles ("Cherry",
+"Honey", "Smoke"). On top of the vocabulary of tasting_notes.txt, which
+is passed to find_in_text
+"""
+NOTE_WORDS = set(SYNONYMS) | set(SYNONYMS.values())
+
+
+def normalize(text:str) -> str:
+    """
+    lowercases, spells out "&" and strips punctuation so that
+    "Schindler's List" and "schindlers list" look the same
+    """
+    text = text.lower().replace("&", " and ").replace("'", "")
+    return " ".join(re.findall(r"[a-z0-9]+", text))
+
+
+"""
+Spans in double quotes, curly quotes or single quotes, but not the
+apostrophe of "I'd"
+"""
+QUOTED = re.compile(r'"([^"]+)"|\u201c([^\u201d]+)\u201d|(?:^|\s)[\'\u2018]([^\'\u2019]+)[\'\u2019](?!\w)')
+
+
+def quoted_words(text:str) -> Set[str]:
+    """
+    normalized words of the message that are inside quotes
+    """
+    words = set()
+    for groups in QUOTED.findall(text):
+        words.update(normalize(" ".join(groups)).split())
+    return words
+
+
+def capitalised_words(text:str) -> Set[str]:
+    """
+    Normalized words of the message that are capitalised in the middle
+    of a sentence, e.g. "Cherry" in "what goes with Cherry?" but not in
+    "Cherry notes please"
+    """
+    words = set()
+    for sentence in re.split(r"[.!?\n]+", text):
+        tokens = re.findall(r"[A-Za-z0-9&']+", sentence)
+        words.update(normalize(token) for token in tokens[1:] if token[0].isupper())
+    return words
+
+
+def trigrams(text:str) -> Set[str]:
+    padded = f"  {text} "
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+
+class MovieIndex:
+    """
+    Offline index of popular movies built from a TMDB export (see
+    build.py movie-index). Every record has the TMDB id, title, aliases,
+    overview and the emotion the t5 model predicted for the overview, so
+    a MOVIE request that hits the index needs no network I/O and no
+    emotion inference.
+
+    Titles are found inside free text by looking up every word n-gram of
+    the message, longest first, and if that misses, by comparing n-grams
+    word by word with the titles of as many words to catch typos
+    ("shindlers list", "stra wars"). Titles sharing a trigram with the
+    n-gram are the candidates.
+    """
+
+    def __init__(self, path:str, fuzzy_thresh:float=0.8, min_word_similarity:float=0.7):
+        self.path = path
+        self.fuzzy_thresh = fuzzy_thresh
+        self.min_word_similarity = min_word_similarity
+        self.movies = None
+        self.titles = None
+        self.trigram_index = None
+        self._lock = threading.Lock()
+
+
+    @property
+    def available(self) -> bool:
+        return exists(self.path)
+
+
+    def load(self) -> "MovieIndex":
+        """
+        reads the JSON lines index and builds the title lookup tables
+        """
+        movies = []
+        with open(self.path, "r") as index_file:
+            for line in index_file:
+                if line.strip():
+                    movies.append(json.loads(line))
+
+        # the most popular movie wins when titles collide
+        movies.sort(key=lambda movie: -movie.get("popularity", 0))
+
+        titles = {}
+        for movie_id, movie in enumerate(movies):
+            names = [movie.get("title", ""), movie.get("original_title", "")] + movie.get("aliases", [])
+            for name in names:
+                key = normalize(name)
+                if key == "":
+                    continue
+                titles.setdefault(key, movie_id)
+                # people rarely say the leading "the"
+                if key.startswith("the "):
+                    titles.setdefault(key[4:], movie_id)
+
+        trigram_index = defaultdict(list)
+        for key in titles:
+            for gram in trigrams(key):
+                trigram_index[gram].append(key)
+
+        self.movies = movies
+        self.titles = titles
+        self.trigram_index = dict(trigram_index)
+        return self
+
+
+    def ensure_loaded(self) -> "MovieIndex":
+        if self.movies is None:
+            with self._lock:
+                if self.movies is None:
+                    self.load()
+        return self
+
+
+    def lookup(self, title:str) -> Optional[Dict]:
+        """
+        Returns the movie with exactly this (normalized) title, or the
+        closest one by trigram similarity, or None
+        """
+        self.ensure_loaded()
+        key = normalize(title)
+        if key in self.titles:
+            return self.movies[self.titles[key]]
+        return self.fuzzy_lookup(key)
+
+
+    def find_in_text(self, text:str, note_words:Iterable[str]=()) -> Optional[Dict]:
+        """
+        Finds the movie mentioned in a free form message such as "what
+        should I drink with schindler's list?". Returns None if no known
+        title is in the message.
+
+        One word titles are ordinary words too often, so they only count
+        if they are the whole message, or are quoted or capitalised. A
+        tasting note, from NOTE_WORDS or note_words, has to be the whole
+        message or quoted.
+        """
+        self.ensure_loaded()
+        words = normalize(text).split()
+        if len(words) == 1:
+            quoted, capitalised = set(words), set(words)
+        else:
+            quoted, capitalised = quoted_words(text), capitalised_words(text)
+        note_words = NOTE_WORDS.union(note_words)
+
+        # exact match, longest n-gram first
+        for n in range(min(MAX_TITLE_WORDS, len(words)), 0, -1):
+            for i in range(len(words) - n + 1):
+                key = " ".join(words[i:i+n])
+                if n == 1:
+                    if len(key) < 3 or key not in (quoted if key in note_words else quoted | capitalised):
+                        continue
+                if key in self.titles:
+                    return self.movies[self.titles[key]]
+
+        # fuzzy match on multi word n-grams, single words are too noisy
+        best, best_score = None, self.fuzzy_thresh
+        for n in range(min(MAX_TITLE_WORDS, len(words)), 1, -1):
+            for i in range(len(words) - n + 1):
+                ngram = words[i:i+n]
+                # titles are indexed with and without their leading "the"
+                if (ngram[0] in COMMON_WORDS and ngram[0] != "the") or ngram[-1] in COMMON_WORDS:
+                    continue
+                key, score = self.closest_title(" ".join(ngram))
+                if key is not None and score > best_score:
+                    best, best_score = key, score
+
+        return self.movies[self.titles[best]] if best is not None else None
+
+
+    def fuzzy_lookup(self, key:str) -> Optional[Dict]:
+        best, score = self.closest_title(key)
+        if best is None or score < self.fuzzy_thresh:
+            return None
+        return self.movies[self.titles[best]]
+
+
+    def closest_title(self, key:str):
+        """
+        Returns the indexed title of the same number of words that is
+        most similar to key, and that similarity: the mean similarity of
+        the words, each compared with the word in the same place. Titles
+        with a word less than min_word_similarity alike score 0, so a
+        filler word ("sweet at home") doesn't pass for a typo.
+        """
+        words = key.split()
+        candidates = set()
+        for gram in trigrams(key):
+            candidates.update(self.trigram_index.get(gram, []))
+
+        best, best_score = None, 0.0
+        for title in candidates:
+            title_words = title.split()
+            if len(title_words) != len(words):
+                continue
+            similarities = [difflib.SequenceMatcher(None, word, title_word).ratio()
+                    for word, title_word in zip(words, title_words)]
+            if min(similarities) < self.min_word_similarity:
+                continue
+            score = sum(similarities) / len(similarities)
+            if score > best_score:
+                best, best_score = title, score
+        return best, best_score
+
+
+
+def movie_record(details:dict, emotion:str, emotion_scores:Optional[Dict[str, float]]=None) -> Dict:
+    """
+    turns a TMDB /movie/{id} response (with alternative_titles appended)
+    into a line of the index
+    """
+    aliases = [alt["title"] for alt in details.get("alternative_titles", {}).get("titles", [])
+            if alt.get("iso_3166_1") in ("US", "GB")]
+    return {
+        "id": details["id"],
+        "title": details.get("title", ""),
+        "original_title": details.get("original_title", ""),
+        "aliases": aliases,
+        "overview": details.get("overview", ""),
+        "popularity": details.get("popularity", 0),
+        "emotion": emotion,
+        "emotion_scores": emotion_scores or {},
+    }
+
+
+def read_export(path:str, limit:int) -> List[Dict]:
+    """
+    reads a TMDB daily id export (JSON lines, optionally gzipped) and
+    returns the limit most popular non adult movies
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt") as export_file:
+        movies = [json.loads(line) for line in export_file if line.strip()]
+
+    movies = [movie for movie in movies if not movie.get("adult") and not movie.get("video")]
+    movies.sort(key=lambda movie: -movie.get("popularity", 0))
+    return movies[:limit]
@@ -0,0 +1,233 @@
+import re
+import difflib
+
+from typing import Dict, List
+
+
+"""
+Words and phrases that people use for a tasting note, mapped to the
+tasting note in tasting_notes.txt they mean. Notes that aren't in the
+vocabulary are ignored, so this can be kept generous.
+"""
+SYNONYMS = {
+    "apples": "apple",
+    "bananas": "banana",
+    "cherries": "cherry",
+    "citrusy": "citrus",
+    "citrussy": "citrus",
+    "fruit": "fruity",
+    "fruits": "fruity",
+    "fruitiness": "fruity",
+    "dried fruit": "raisins",
+    "raisin": "raisins",
+    "lemons": "lemon",
+    "lemony": "lemon",
+    "oranges": "orange",
+    "orange peel": "orange",
+    "pears": "pear",
+    "zesty": "zest",
+    "balance": "balanced",
+    "complexity": "complex",
+    "earth": "earthy",
+    "lighter": "light",
+    "finish": "lingering",
+    "long finish": "lingering",
+    "mellowed": "mellow",
+    "aged": "old",
+    "smoothness": "smooth",
+    "butter": "buttery",
+    "candied": "candy",
+    "sweets": "candy",
+    "chocolatey": "chocolate",
+    "chocolaty": "chocolate",
+    "dark chocolate": "chocolate",
+    "milk chocolate": "chocolate",
+    "cinammon": "cinnamon",
+    "honeyed": "honey",
+    "cloves": "clove",
+    "espresso": "coffee",
+    "flower": "floral",
+    "flowers": "floral",
+    "flowery": "floral",
+    "anise": "licorice",
+    "liquorice": "licorice",
+    "malt": "malty",
+    "minty": "mint",
+    "peat": "peaty",
+    "peated": "peaty",
+    "pepper": "peppery",
+    "black pepper": "peppery",
+    "rose": "roses",
+    "spice": "spices",
+    "spiced": "spices",
+    "baking spices": "spices",
+    "sugary": "sugar",
+    "brown sugar": "sugar",
+    "cigar": "tobacco",
+    "cigars": "tobacco",
+    "woody": "wood",
+    "sherried": "sherry",
+    "sherry cask": "sherry",
+    "bitterness": "bitter",
+    "briny": "brine",
+    "cream": "creamy",
+    "herb": "herbal",
+    "herbs": "herbal",
+    "grassy": "green",
+    "maple syrup": "maple",
+    "nut": "nutty",
+    "nuts": "nutty",
+    "oaky": "oak",
+    "toasted oak": "oak",
+    "richness": "rich",
+    "salt": "salty",
+    "sea salt": "salty",
+    "smoke": "smokey",
+    "smoky": "smokey",
+    "smoked": "smokey",
+    "sourness": "sour",
+    "spicey": "spicy",
+    "sweetness": "sweet",
+    "sweeter": "sweet",
+    "caramelized": "caramel",
+}
+
+"""
+Words that are never tasting notes, so they are skipped by the fuzzy and
+embedding matchers
+"""
+STOPWORDS = {
+    "a", "an", "the", "and", "or", "but", "with", "without", "that", "this",
+    "is", "it", "its", "it's", "be", "to", "of", "for", "in", "on", "at",
+    "i", "i'm", "im", "me", "my", "you", "your", "we", "any", "some", "very",
+    "really", "little", "bit", "lot", "also", "want", "wanna", "would", "like",
+    "looking", "something", "anything", "what", "which", "whats", "what's",
+    "can", "could", "should", "recommend", "suggest", "suggestions", "give",
+    "find", "get", "have", "has", "good", "great", "nice", "whiskey", "whisky",
+    "whiskies", "whiskeys", "bourbon", "scotch", "rye", "drink", "bottle",
+    "glass", "taste", "tastes", "tasting", "notes", "note", "flavor", "flavors",
+    "flavour", "flavours", "flavored", "hint", "hints", "kind", "sort", "one",
+    "tonight", "today", "please", "thanks", "hey", "hi", "not", "too",
+    "more", "less", "much", "year", "years", "love", "loved", "loves",
+    "bold", "cold", "hold", "told", "teal", "acorn", "okay", "well",
+}
+
+"""
+Phrases that contain a tasting note but don't describe the taste, e.g.
+"12 year old" is an age and not a request for an old whiskey
+"""
+IGNORED_PHRASES = {"year old", "years old", "yr old", "light up", "old fashioned"}
+
+MAX_NGRAM = 3
+
+"""
+Shortest word that is fuzzy matched to a tasting note
+"""
+MIN_FUZZY_LENGTH = 5
+
+
+def read_vocabulary(path:str) -> List[str]:
+    """
+    reads tasting_notes.txt, one tasting note per line
+    """
+    with open(path, "r") as notes_file:
+        return [line.strip() for line in notes_file if line.strip()]
+
+
+def tokenize(text:str) -> List[str]:
+    return re.findall(r"[a-z]+(?:'[a-z]+)?", text.lower())
+
+
+class TastingNoteExtractor:
+    """
+    Pulls tasting notes out of free form text without a round trip to
+    GPT-3. Word n-grams of the text are looked up in a lexicon made of
+    the tasting note vocabulary and SYNONYMS, longest n-gram first, and
+    words that didn't match are fuzzy matched to catch typos such as
+    "carmel" or "vanila".
+
+    Only notes from the vocabulary are ever returned, in the order they
+    appear in the text.
+    """
+
+    def __init__(self, vocabulary:List[str], synonyms:Dict[str, str]=SYNONYMS, fuzzy_cutoff:float=0.85):
+        self.vocabulary = vocabulary
+        self.fuzzy_cutoff = fuzzy_cutoff
+
+        known = set(vocabulary)
+        self.lexicon = {note.lower(): note for note in vocabulary}
+        for phrase, note in synonyms.items():
+            if note in known:
+                self.lexicon.setdefault(phrase, note)
+
+        # ignored phrases match but map to no note
+        for phrase in IGNORED_PHRASES:
+            self.lexicon[phrase] = ""
+
+        # single words only, n-grams are matched exactly
+        self._fuzzy_terms = [term for term in self.lexicon if " " not in term]
+
+
+    def match(self, text:str) -> List[str]:
+        """
+        Returns the tasting notes found in the text
+        """
+        notes, _ = self._match(text)
+        return notes
+
+
+    def leftover_words(self, text:str) -> List[str]:
+        """
+        words that are neither stopwords nor matched tasting notes.
+        These are candidates for the embedding fallback
+        """
+        _, leftover = self._match(text)
+        return leftover
+
+
+    def fuzzy_match(self, token:str):
+        """
+        The lexicon term token is a typo of, or None. Typos keep the
+        first letter and roughly the length ("carmel", "vanila"), while
+        short everyday words are often a letter away from a note
+        ("love" and clove, "teal" and tea), so only words of at least
+        MIN_FUZZY_LENGTH letters are matched, against terms starting
+        with the same letter and at most one letter longer or shorter.
+        """
+        if len(token) < MIN_FUZZY_LENGTH:
+            return None
+        terms = [term for term in self._fuzzy_terms
+                if term[0] == token[0] and abs(len(term) - len(token)) <= 1]
+        close = difflib.get_close_matches(token, terms, n=1, cutoff=self.fuzzy_cutoff)
+        return close[0] if close else None
+
+
+    def _match(self, text:str):
+        tokens = tokenize(text)
+        notes = []
+        leftover = []
+
+        i = 0
+        while i < len(tokens):
+            note = None
+            # longest n-gram first so "dark chocolate" wins over "dark"
+            for n in range(min(MAX_NGRAM, len(tokens) - i), 0, -1):
+                note = self.lexicon.get(" ".join(tokens[i:i+n]))
+                if note is not None:
+                    break
+
+            if note is None:
+                n = 1
+                token = tokens[i]
+                if token not in STOPWORDS and len(token) >= 4:
+                    close = self.fuzzy_match(token)
+                    if close is not None:
+                        note = self.lexicon[close]
+                    else:
+                        leftover.append(token)
+
+            if note and note not in notes:
+                notes.append(note)
+            i += n
+
+        return notes, leftover
@@ -0,0 +1,401 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+
+from typing import Any, Dict, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import BasePersistence, ConversationHandler, PersistenceInput, TypeHandler
+
+
+logger = logging.getLogger(__name__)
+
+"""
+What is kept per namespace of a StateStore:
+   - conversations:<name>: the ConversationHandler state per (chat, user)
+   - user_data: context.user_data (prev_state) per user
+"""
+USER_DATA = "user_data"
+
+
+class StateStore:
+    """
+    Key value store the conversation state is persisted to. Keys are
+    grouped into namespaces and values are anything JSON serializable.
+
+    It maps directly to a Redis hash per namespace: load is HGET,
+    load_all is HGETALL and write_many is a pipelined HSET/HDEL, see
+    RedisStateStore.
+
+    By default a bot instance reads it when it starts, not on every
+    update, so several instances on one store each have to get every
+    update of the chats they own, like the worker processes, which are
+    picked by chat. With a shared StatePersistence every update reads the
+    state of its chat and writes it back, so any instance can take it.
+    """
+
+    def load(self, namespace:str, key:str) -> Optional[Any]:
+        raise NotImplementedError
+
+
+    def load_all(self, namespace:str) -> Dict[str, Any]:
+        raise NotImplementedError
+
+
+    def write_many(self, items:Dict[Tuple[str, str], Any]) -> None:
+        """
+        writes a batch of (namespace, key) -> value in one go. A value of
+        None deletes the key
+        """
+        raise NotImplementedError
+
+
+    def close(self) -> None:
+        pass
+
+
+
+class SQLiteStateStore(StateStore):
+    """
+    StateStore in a local SQLite file. WAL mode lets the worker
+    processes of one host read while another one writes.
+    """
+
+    def __init__(self, path:str):
+        self.path = path
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS state "
+            "(namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "updated_at REAL NOT NULL, PRIMARY KEY (namespace, key))")
+        self._conn.commit()
+
+
+    def load(self, namespace:str, key:str) -> Optional[Any]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM state WHERE namespace = ? AND key = ?",
+                (namespace, key)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+
+    def load_all(self, namespace:str) -> Dict[str, Any]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, value FROM state WHERE namespace = ?", (namespace,)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+
+    def write_many(self, items:Dict[Tuple[str, str], Any]) -> None:
+        now = time.time()
+        upserts = [(namespace, key, json.dumps(value), now)
+                for (namespace, key), value in items.items() if value is not None]
+        deletes = [(namespace, key) for (namespace, key), value in items.items() if value is None]
+
+        # one transaction for the whole batch
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO state (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)",
+                upserts)
+            self._conn.executemany("DELETE FROM state WHERE namespace = ? AND key = ?", deletes)
+
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+
+class RedisStateStore(StateStore):
+    """
+    StateStore on a Redis server, so the state outlives the host the bot
+    runs on. Needs `pip install redis`
+    """
+
+    def __init__(self, url:str, prefix:str="barbutler:"):
+        try:
+            import redis
+        except ImportError as e:
+            raise ImportError("a redis:// state store needs `pip install redis`") from e
+
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+
+
+    def load(self, namespace:str, key:str) -> Optional[Any]:
+        value = self._redis.hget(self.prefix + namespace, key)
+        return json.loads(value) if value is not None else None
+
+
+    def load_all(self, namespace:str) -> Dict[str, Any]:
+        values = self._redis.hgetall(self.prefix + namespace)
+        return {key.decode("utf-8"): json.loads(value) for key, value in values.items()}
+
+
+    def write_many(self, items:Dict[Tuple[str, str], Any]) -> None:
+        pipeline = self._redis.pipeline(transaction=False)
+        for (namespace, key), value in items.items():
+            if value is None:
+                pipeline.hdel(self.prefix + namespace, key)
+            else:
+                pipeline.hset(self.prefix + namespace, key, json.dumps(value))
+        pipeline.execute()
+
+
+    def close(self) -> None:
+        self._redis.close()
+
+
+
+def open_store(location:str) -> StateStore:
+    """
+    redis://... opens a RedisStateStore, anything else is the path of a
+    SQLite file
+    """
+    if location.startswith(("redis://", "rediss://")):
+        return RedisStateStore(location)
+    return SQLiteStateStore(location)
+
+
+def conversation_key(key:Tuple[int, ...]) -> str:
+    return json.dumps(list(key))
+
+
+class StatePersistence(BasePersistence):
+    """
+    Persists the conversation states and user_data to a StateStore so
+    that a restart doesn't drop conversations in progress.
+
+    Writes are behind: the Application already only hands over what
+    changed, every update_interval seconds, and those changes are
+    coalesced per key and written to the store in one batch, so a chatty
+    user costs at most one write per key per interval.
+
+    user_data is loaded lazily, the first time an update of a user comes
+    in, rather than all of it at startup. Conversation states are a
+    single small int per chat and are read in full when the
+    ConversationHandler starts. Neither is read again afterwards, so
+    changes another instance makes to the same chat aren't seen.
+
+    Unless shared is set: then the state of the chat and the user_data
+    of the user are read from the store before every update and written
+    to it as soon as the update is handled, see shared_handlers. That
+    costs a read and a write per update, but lets instances behind a
+    load balancer that doesn't route by chat take turns on a chat.
+    """
+
+    def __init__(self, store:StateStore, update_interval:float=5, write_delay:float=0.5, shared:bool=False):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval)
+        self.store = store
+        self.write_delay = write_delay
+        self.shared = shared
+        self.writes = 0
+        self.batches = 0
+        self._pending = {}
+        self._loaded_users = set()
+        self._writer = None
+
+
+    def _queue(self, namespace:str, key:str, value:Any) -> None:
+        self._pending[(namespace, key)] = value
+        if self._writer is None:
+            self._writer = asyncio.get_running_loop().create_task(self._write_behind())
+
+
+    async def _write_behind(self) -> None:
+        # let the rest of this persistence cycle land in the same batch
+        await asyncio.sleep(self.write_delay)
+        self._writer = None
+        await self.write_pending()
+
+
+    async def write_pending(self) -> None:
+        """
+        writes the pending changes now, off the event loop
+        """
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+        pending, self._pending = self._pending, {}
+        if not await asyncio.get_running_loop().run_in_executor(None, self._write, pending):
+            # keep them for the next batch, unless newer values came in
+            for key, value in pending.items():
+                self._pending.setdefault(key, value)
+
+
+    async def _load(self, namespace:str, key:str) -> Optional[Any]:
+        # a change that is still waiting to be written is newer than
+        # what the store has
+        if (namespace, key) in self._pending:
+            return self._pending[(namespace, key)]
+        return await asyncio.get_running_loop().run_in_executor(None, self.store.load, namespace, key)
+
+
+    def _write(self, pending:Dict[Tuple[str, str], Any]) -> bool:
+        if len(pending) == 0:
+            return True
+        try:
+            self.store.write_many(pending)
+        except Exception:
+            logger.exception("failed to write %d conversation state entries", len(pending))
+            return False
+        self.writes += len(pending)
+        self.batches += 1
+        return True
+
+
+    def stats(self) -> dict:
+        return {
+            "writes": self.writes,
+            "batches": self.batches,
+            "pending": len(self._pending),
+            "loaded_users": len(self._loaded_users),
+        }
+
+
+    async def get_conversations(self, name:str) -> Dict:
+        stored = await asyncio.get_running_loop().run_in_executor(
+                None, self.store.load_all, f"conversations:{name}")
+        return {tuple(json.loads(key)): state for key, state in stored.items()}
+
+
+    async def update_conversation(self, name:str, key:Tuple[int, ...], new_state:Optional[object]) -> None:
+        self._queue(f"conversations:{name}", conversation_key(key), new_state)
+
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        # filled in per user by refresh_user_data
+        return {}
+
+
+    async def refresh_user_data(self, user_id:int, user_data:dict) -> None:
+        """
+        called before every update of the user is handled, loads what the
+        store has for them the first time round, or every time if shared
+        """
+        if user_id in self._loaded_users and not self.shared:
+            return
+        self._loaded_users.add(user_id)
+        stored = await self._load(USER_DATA, str(user_id))
+        if self.shared:
+            # another instance may have changed or dropped it since
+            user_data.clear()
+            user_data.update(stored or {})
+        elif stored:
+            for key, value in stored.items():
+                user_data.setdefault(key, value)
+
+
+    async def update_user_data(self, user_id:int, data:dict) -> None:
+        self._queue(USER_DATA, str(user_id), dict(data))
+
+
+    async def drop_user_data(self, user_id:int) -> None:
+        self._loaded_users.discard(user_id)
+        self._queue(USER_DATA, str(user_id), None)
+
+
+    async def load_conversation(self, conversation:ConversationHandler, update:Update) -> None:
+        """
+        replaces the state conversation has for the chat of update with
+        the one in the store, which another instance may have moved on
+        """
+        try:
+            key = conversation._get_key(update)
+        except RuntimeError:
+            # e.g. a channel post, which has no user
+            return
+        state = await self._load(f"conversations:{conversation.name}", conversation_key(key))
+        # without tracking, so that only states the handlers change are
+        # written back
+        if state is None:
+            conversation._conversations.data.pop(key, None)
+        else:
+            conversation._conversations.update_no_track({key: state})
+
+
+    async def save_update(self, application, update:Update) -> None:
+        """
+        writes the conversation state and user_data the update left
+        behind straight away, so the next update of the chat sees them
+        on whichever instance it lands
+        """
+        if update.effective_user is not None:
+            # the Application only marks the user once every handler group is done
+            application.mark_data_for_update_persistence(user_ids=update.effective_user.id)
+        await application.update_persistence()
+        await self.write_pending()
+
+
+    def shared_handlers(self, conversation:ConversationHandler) -> Dict[int, TypeHandler]:
+        """
+        Handlers to add to the Application, by group, when the state is
+        shared: one that runs before the conversation and loads the
+        state of the chat, and one that runs after it and saves it
+        """
+        async def load(update:Update, context) -> None:
+            await self.load_conversation(conversation, update)
+
+        async def save(update:Update, context) -> None:
+            await self.save_update(context.application, update)
+
+        return {-1: TypeHandler(Update, load), 1: TypeHandler(Update, save)}
+
+
+    async def flush(self) -> None:
+        """
+        writes whatever is still pending, called on shutdown
+        """
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+        pending, self._pending = self._pending, {}
+        self._write(pending)
+        self.store.close()
+
+
+    # only the conversation states and user_data are persisted
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+
+    async def get_callback_data(self) -> None:
+        return None
+
+
+    async def update_chat_data(self, chat_id:int, data:dict) -> None:
+        pass
+
+
+    async def update_bot_data(self, data:dict) -> None:
+        pass
+
+
+    async def update_callback_data(self, data:Any) -> None:
+        pass
+
+
+    async def drop_chat_data(self, chat_id:int) -> None:
+        pass
+
+
+    async def refresh_chat_data(self, chat_id:int, chat_data:dict) -> None:
+        pass
+
+
+    async def refresh_bot_data(self, bot_data:dict) -> None:
+        pass
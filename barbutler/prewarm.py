@@ -0,0 +1,49 @@
+import sys
+import asyncio
+import logging
+import argparse
+
+from constants import CACHE_DIR
+
+import utils
+import http_client
+
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def prewarm(titles:list) -> dict:
+    try:
+        return await utils.prewarm_emotion_cache(titles)
+    finally:
+        await http_client.close()
+
+
+def main() -> None:
+    """
+    Classifies the emotion of a list of popular movies ahead of time so
+    that MOVIE requests for them skip the t5 model. Takes a file with one
+    title per line, or reads the titles from stdin.
+
+    BARBUTLER_CACHE_DIR has to be set for the results to be persisted.
+    """
+    parser = argparse.ArgumentParser(description="pre-warm the movie emotion cache")
+    parser.add_argument("titles", nargs="?", type=argparse.FileType("r"), default=sys.stdin,
+            help="file with one movie title per line")
+    args = parser.parse_args()
+
+    if not CACHE_DIR:
+        logger.warning("BARBUTLER_CACHE_DIR is not set, nothing will be persisted")
+
+    titles = [line.strip() for line in args.titles if line.strip()]
+    emotions = asyncio.run(prewarm(titles))
+
+    for title, emotion in emotions.items():
+        print(f"{title}\t{emotion if emotion is not None else '-'}")
+
+
+if __name__ == "__main__":
+    main()
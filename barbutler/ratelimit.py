@@ -0,0 +1,173 @@
+import time
+import threading
+from collections import OrderedDict
+
+from typing import Dict, Hashable, Optional
+
+from constants import (
+    CHAT_REQUESTS_PER_MINUTE,
+    CHAT_BURST,
+    OPENAI_PER_MINUTE,
+    TMDB_PER_MINUTE,
+    WHISKEY_API_PER_MINUTE,
+)
+
+
+class TokenBucket:
+    """
+    Holds up to capacity tokens and refills at rate tokens per second.
+    Every request takes a token, and is turned away if there is none
+    left, so bursts of up to capacity go through and anything faster
+    than rate is throttled.
+    """
+
+    def __init__(self, rate:float, capacity:float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def _refill(self, now:float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+
+    def try_acquire(self, cost:float=1) -> bool:
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens < cost:
+                return False
+            self.tokens -= cost
+            return True
+
+
+    def available(self) -> float:
+        with self._lock:
+            self._refill(time.monotonic())
+            return self.tokens
+
+
+
+class ChatLimiter:
+    """
+    A TokenBucket per chat. Only the most recently seen max_chats chats
+    are kept, a chat that was evicted was idle long enough to have a
+    full bucket again anyway.
+    """
+
+    def __init__(self, rate:float, capacity:float, max_chats:int=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_chats = max_chats
+        self.limited = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def allow(self, chat_id:Hashable) -> bool:
+        with self._lock:
+            bucket = self._buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._buckets[chat_id] = TokenBucket(self.rate, self.capacity)
+                if len(self._buckets) > self.max_chats:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(chat_id)
+
+        if bucket.try_acquire():
+            return True
+        self.limited += 1
+        return False
+
+
+    def stats(self) -> Dict[str, float]:
+        return {"chats": len(self._buckets), "limited": self.limited}
+
+
+
+class BudgetExceeded(Exception):
+    """
+    raised instead of calling an upstream API whose budget is used up
+    """
+
+    def __init__(self, upstream:str):
+        super().__init__(f"the {upstream} budget is used up")
+        self.upstream = upstream
+
+
+
+class Budgets:
+    """
+    Global per minute budgets of calls to each upstream API, shared by
+    every chat. Upstreams without a budget are unlimited.
+    """
+
+    def __init__(self, per_minute:Dict[str, float]):
+        self.per_minute = dict(per_minute)
+        # a minute's worth of calls can be made in a burst
+        self.buckets = {upstream: TokenBucket(limit / 60, limit)
+                for upstream, limit in per_minute.items() if limit > 0}
+        self.spent = {upstream: 0 for upstream in self.buckets}
+        self.rejected = {upstream: 0 for upstream in self.buckets}
+
+
+    def spend(self, upstream:str, cost:float=1) -> None:
+        """
+        takes cost from the budget of upstream, or raises BudgetExceeded
+        """
+        bucket = self.buckets.get(upstream)
+        if bucket is None:
+            return
+        if not bucket.try_acquire(cost):
+            self.rejected[upstream] += 1
+            raise BudgetExceeded(upstream)
+        self.spent[upstream] += cost
+
+
+    def split(self, parts:int) -> "Budgets":
+        """
+        a budget for one of parts processes that spend side by side, so
+        that together they stay within this one
+        """
+        return Budgets({upstream: limit / parts for upstream, limit in self.per_minute.items()})
+
+
+    def stats(self) -> Dict[str, float]:
+        stats = {}
+        for upstream, bucket in self.buckets.items():
+            stats[f"{upstream}_spent"] = self.spent[upstream]
+            stats[f"{upstream}_rejected"] = self.rejected[upstream]
+            stats[f"{upstream}_available"] = bucket.available()
+        return stats
+
+
+
+"""
+Shared by the whole bot. chat_limiter is None if chats aren't limited
+"""
+chat_limiter = (ChatLimiter(CHAT_REQUESTS_PER_MINUTE / 60, CHAT_BURST)
+        if CHAT_REQUESTS_PER_MINUTE > 0 else None)
+
+budgets = Budgets({
+    "openai": OPENAI_PER_MINUTE,
+    "tmdb": TMDB_PER_MINUTE,
+    "whiskey": WHISKEY_API_PER_MINUTE,
+})
+
+
+def allow_chat(chat_id:Optional[Hashable]) -> bool:
+    """
+    whether the chat may make another expensive request right now
+    """
+    if chat_limiter is None or chat_id is None:
+        return True
+    return chat_limiter.allow(chat_id)
+
+
+def stats() -> Dict[str, float]:
+    stats = budgets.stats()
+    if chat_limiter is not None:
+        stats.update(chat_limiter.stats())
+    return stats
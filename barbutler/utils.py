@@ -1,27 +1,417 @@
 import openai
 
-import requests
-import pickle
-from os.path import exists
+import json
+import hashlib
+import functools
+from os.path import exists, join, dirname, abspath
 
-from typing import List
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import Any, Callable, List, NamedTuple
 
 import torch
-from sentence_transformers import SentenceTransformer, util
-from transformers import AutoTokenizer, AutoModelWithLMHead
-from constants import TMDB3_API_KEY, OPENAI_API_KEY
+import numpy as np
+from sentence_transformers import util
+from transformers import AutoTokenizer
+from constants import (
+    TMDB3_API_KEY,
+    OPENAI_API_KEY,
+    CACHE_DIR,
+    WHISKEY_DATASET,
+    WHISKEY_RANKING,
+    MOVIE_INDEX,
+    EMOTION_BATCH_SIZE,
+    EMOTION_BATCH_WAIT_MS,
+    EMOTION_SCORING,
+    EMOTION_MAX_TOKENS,
+    INFERENCE_WORKERS,
+    GPT_CACHE_ENABLED,
+    GPT_CACHE_SIZE,
+    GPT_CACHE_TTL,
+    LOCAL_NOTE_EXTRACTION,
+    GPT_STREAMING,
+    INFERENCE_BACKEND,
+    ARTIFACTS_DIR,
+)
+from artifacts import ArtifactBundle, text_hash, write_bundle
+from cache import MISSING, TTLCache, SQLiteCache, TieredCache, SingleFlight
+from batching import MicroBatcher
+import backends
+import http_client
+import extractor
+import metrics
+import ratelimit
+from whiskey_catalog import WhiskeyCatalog
+from note_extractor import TastingNoteExtractor, read_vocabulary
+from movie_index import MovieIndex, movie_record, read_export, quoted_words, normalize as movie_key
 
 openai.api_key = OPENAI_API_KEY
 
+logger = logging.getLogger(__name__)
+
+# directory that holds tasting_notes.txt
+ROOT_DIR = abspath(join(dirname(__file__), ".."))
+
+
+
+class LazyModel:
+    """
+    Handle to a model that is only loaded the first time it is used.
+    Attribute access is forwarded to the loaded model, so a handle can
+    be used exactly like the model itself (e.g. embedder.encode(...)).
+
+    Loading is guarded by a lock so that a background warm up thread and
+    a request handler never load the same weights twice.
+    """
+
+    def __init__(self, loader:Callable[[], Any]):
+        self._loader = loader
+        self._model = None
+        self._lock = threading.Lock()
+
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+
+    def get(self) -> Any:
+        """
+        returns the underlying model, loading it if needed
+        """
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = self._loader()
+        return self._model
+
+
+    def reset(self) -> None:
+        """
+        drops the loaded model, the next use loads it again
+        """
+        with self._lock:
+            self._model = None
+
+
+    def __getattr__(self, name:str) -> Any:
+        return getattr(self.get(), name)
+
+
+    # special methods are looked up on the type, not through __getattr__,
+    # so calling a handle (tokenizer(...), model(...)) needs its own
+    def __call__(self, *args, **kwargs) -> Any:
+        return self.get()(*args, **kwargs)
+
+
+"""
+Model inference is CPU bound and would block the event loop, so the
+async handlers run it on this bounded pool instead
+"""
+inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="inference")
+
+
+async def run_blocking(fn:Callable, *args, **kwargs) -> Any:
+    """
+    runs a blocking function on inference_executor and waits for it
+    without blocking the event loop
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(inference_executor, functools.partial(fn, *args, **kwargs))
+
+
+"""
+Handles for the finetuned models for text/sentence embedding and
+predictor for emotion classification. Nothing is loaded at import time,
+see warm_up_models()
+"""
+EMBEDDER_NAME = "all-MiniLM-L6-v2"
+EMOTION_MODEL_NAME = "mrm8488/t5-base-finetuned-emotion"
+
+# where exported models (e.g. ONNX) are kept
+MODEL_DIR = join(ROOT_DIR, "models")
+
+embedder = LazyModel(lambda: backends.load_embedder(EMBEDDER_NAME, INFERENCE_BACKEND, MODEL_DIR))
+tokenizer = LazyModel(lambda: AutoTokenizer.from_pretrained(EMOTION_MODEL_NAME))
+model = LazyModel(lambda: backends.load_emotion_model(EMOTION_MODEL_NAME, INFERENCE_BACKEND, MODEL_DIR))
+
+# set once the embedder and everything derived from it is in memory
+embedder_ready = threading.Event()
+
+"""
+Precomputed tasting note embeddings, yes/no anchors and emotion label
+token ids, see artifacts.py and `build.py artifacts`. Anything missing
+or out of date in the bundle is computed at runtime instead
+"""
+artifact_bundle = ArtifactBundle(ARTIFACTS_DIR or join(ROOT_DIR, "artifacts"))
+
+
+def embedder_inputs() -> dict:
+    return {"model": EMBEDDER_NAME, "backend": INFERENCE_BACKEND}
+
+
+class NoteSnapshot(NamedTuple):
+    """
+    one consistent version of the tasting notes, swapped in as a whole on
+    reload so readers never pair new notes with old embeddings
+    """
+    notes: List[str]
+    embeddings: torch.Tensor
+    content_hash: str
+
+
+EMPTY_SNAPSHOT = NoteSnapshot(None, None, None)
+
+
+class TastingNoteIndex:
+    """
+    Holds the plain text tasting notes and their L2 normalized
+    embeddings in memory so that they only have to be read from disk
+    once, instead of on every TASTE and MOVIE request.
+
+    The embeddings come from the artifact bundle, which records the
+    sha256 hash of the tasting notes txt file they were built from. If
+    the txt file is edited, the hash no longer matches and the notes are
+    embedded again instead of silently serving stale vectors. The same
+    goes for a change of the embedder or its inference backend.
+    """
+
+    def __init__(self, notes_path:str=None, bundle:ArtifactBundle=None):
+        # resolve the path once relative to the repository root rather
+        # than probing the current working directory on every call
+        self.notes_path = notes_path or join(ROOT_DIR, "tasting_notes.txt")
+        self.bundle = bundle or artifact_bundle
+
+        self.snapshot = EMPTY_SNAPSHOT
+        self._lock = threading.Lock()
+
+
+    @property
+    def notes(self) -> List[str]:
+        return self.snapshot.notes
+
+
+    @property
+    def embeddings(self) -> torch.Tensor:
+        return self.snapshot.embeddings
+
+
+    @property
+    def content_hash(self) -> str:
+        return self.snapshot.content_hash
+
+
+    def read_notes(self):
+        """
+        returns the tasting notes, one per line skipping blank lines, and
+        the sha256 hash of the file
+        """
+        with open(self.notes_path, "rb") as notes_file:
+            raw = notes_file.read()
+        notes = [line.strip() for line in raw.decode("utf-8").splitlines() if line.strip()]
+        return notes, hashlib.sha256(raw).hexdigest()
+
+
+    def embedding_inputs(self, content_hash:str) -> dict:
+        return {**embedder_inputs(), "tasting_notes_hash": content_hash}
+
+
+    def load(self) -> "TastingNoteIndex":
+        """
+        Reads the tasting notes txt file and maps their embeddings from
+        the artifact bundle if they were built from the same content,
+        otherwise embeds the notes.
+        """
+        if not exists(self.notes_path):
+            return self
+
+        notes, content_hash = self.read_notes()
+
+        if self.bundle.matches("tasting_notes", **self.embedding_inputs(content_hash)):
+            embeddings = torch.from_numpy(self.bundle.array("tasting_notes"))
+        else:
+            logger.info("no up to date tasting note embeddings in %s, embedding them now "
+                    "(`build.py artifacts` saves this at startup)", self.bundle.path)
+            embeddings = embed_tasting_notes(notes)
+
+        # a single assignment, so a concurrent search sees either the old
+        # snapshot or the new one
+        self.snapshot = NoteSnapshot(notes, embeddings, content_hash)
+        return self
+
+
+    def ensure_loaded(self) -> "TastingNoteIndex":
+        """
+        loads the index on first use, subsequent calls are free
+        """
+        if self.notes is None:
+            with self._lock:
+                if self.notes is None:
+                    self.load()
+        return self
+
+
+    def reload(self) -> bool:
+        """
+        Re-reads the tasting notes from disk. Returns True if the
+        contents had changed since the last load.
+        """
+        previous_hash = self.content_hash
+        with self._lock:
+            self.load()
+        return self.content_hash != previous_hash
+
+
+def embed_tasting_notes(notes:List[str]) -> torch.Tensor:
+    embeddings = embedder.encode(notes, convert_to_tensor=True)
+    return util.normalize_embeddings(embeddings)
+
+
+# shared by all handlers, loaded once on first use or by warm_up_models()
+tasting_note_index = TastingNoteIndex()
+
+
+def warm_up_models(include_emotion:bool=False, background:bool=True) -> threading.Thread:
+    """
+    Loads the sentence embedder, the tasting note index and the yes/no
+    anchors so that the first TASTE or FOLLOWUP request doesn't pay for
+    it. The t5 emotion model is only needed for MOVIE requests, so it is
+    left to load on first use unless include_emotion is set.
+
+    By default this runs in a daemon thread so the bot can start polling
+    right away. embedder_ready is set once it is done.
+    """
+    def warm_up():
+        logger.info("loading %s", EMBEDDER_NAME)
+        embedder.get()
+        tasting_note_index.ensure_loaded()
+        get_yes_no_anchors()
+        precompute_emotion_notes()
+        embedder_ready.set()
+        logger.info("%s is ready", EMBEDDER_NAME)
+
+        if include_emotion:
+            logger.info("loading %s", EMOTION_MODEL_NAME)
+            tokenizer.get()
+            model.get()
+            emotion_label_ids()
+            logger.info("%s is ready", EMOTION_MODEL_NAME)
+
+    thread = threading.Thread(target=warm_up, name="model-warm-up", daemon=True)
+    if background:
+        thread.start()
+    else:
+        thread.run()
+    return thread
+
+
+def after_fork() -> None:
+    """
+    called in a worker process forked from a parent that already loaded
+    the models (see workers.py). The models are shared copy-on-write and
+    need nothing, but the on disk caches need their own connections
+    """
+    for cache in (tmdb_cache, emotion_cache):
+        if cache.disk is not None:
+            cache.disk.reopen()
+
+
 """
-Load all the finetuned models for text/sentence embedding and
-predictor for emotion classification
+Replies to the "would you like another recommendation" question that can
+be answered without running the sentence embedder at all
 """
-embedder = SentenceTransformer("all-MiniLM-L6-v2")
-tokenizer = AutoTokenizer.from_pretrained("mrm8488/t5-base-finetuned-emotion")
-model = AutoModelWithLMHead.from_pretrained("mrm8488/t5-base-finetuned-emotion")
+YES_WORDS = {"yes", "yeah", "yea", "yep", "yup", "ya", "y", "sure", "ok",
+             "okay", "absolutely", "definitely", "certainly", "please",
+             "another", "more"}
+NO_WORDS = {"no", "nope", "nah", "n", "not", "never", "done", "stop",
+            "bye", "goodbye", "later"}
+YES_PHRASES = {"of course", "why not", "go ahead", "go for it", "sounds good",
+               "let's go", "lets go", "one more"}
+NO_PHRASES = {"no thanks", "no thank you", "i'm good", "im good", "i'm done",
+              "im done", "not now", "not really", "that's all", "thats all"}
+
+# paraphrases that are embedded and averaged into one anchor per class
+YES_ANCHOR_TEXTS = ["yes", "sure", "yes please", "I would like another one"]
+NO_ANCHOR_TEXTS = ["no", "nope", "no thanks", "I'm done for now"]
+
+_yes_no_anchors = None
+
+
+def anchor_inputs() -> dict:
+    return {**embedder_inputs(), "anchor_texts_hash": text_hash([YES_ANCHOR_TEXTS, NO_ANCHOR_TEXTS])}
+
+
+def embed_yes_no_anchors() -> torch.Tensor:
+    anchors = []
+    for texts in (YES_ANCHOR_TEXTS, NO_ANCHOR_TEXTS):
+        emb = embedder.encode(texts, convert_to_tensor=True, normalize_embeddings=True)
+        anchors.append(emb.mean(dim=0))
+    return util.normalize_embeddings(torch.stack(anchors))
+
+
+def get_yes_no_anchors() -> torch.Tensor:
+    """
+    Returns a (2 x embedding dim) matrix holding the normalized centroid
+    of the yes paraphrases in the first row and the no paraphrases in
+    the second. These are constant, so they are read from the artifact
+    bundle, or only embedded once.
+    """
+    global _yes_no_anchors
+    if _yes_no_anchors is None:
+        if artifact_bundle.matches("yes_no_anchors", **anchor_inputs()):
+            _yes_no_anchors = torch.from_numpy(artifact_bundle.array("yes_no_anchors"))
+        else:
+            _yes_no_anchors = embed_yes_no_anchors()
+    return _yes_no_anchors
+
+
+def normalize_reply(text:str) -> str:
+    """
+    lowercases the reply, strips punctuation and collapses whitespace so
+    "Yes!!" and "  yes " are treated the same
+    """
+    text = "".join(c if c.isalnum() or c in " '" else " " for c in text.lower())
+    return " ".join(text.split())
+
+
+def lexical_yes_or_no(text:str):
+    """
+    Fast path for yes_or_no_from_text. Returns True or False for replies
+    that are unambiguous from their wording alone, and None if the
+    sentence embedder has to decide.
+    """
+    if text in YES_PHRASES: return True
+    if text in NO_PHRASES: return False
+
+    words = set(text.split())
+    said_yes = len(words & YES_WORDS) > 0
+    said_no = len(words & NO_WORDS) > 0
+    # a reply like "not sure" hits both, so leave it to the embedder
+    if said_yes != said_no:
+        return said_yes
+    return None
+
+
+@functools.lru_cache(maxsize=1024)
+def _classify_reply(text:str) -> bool:
+    """
+    memoized on the normalized reply, see yes_or_no_from_text
+    """
+    answer = lexical_yes_or_no(text)
+    if answer is not None:
+        return answer
+
+    emb = embedder.encode([text], convert_to_tensor=True, normalize_embeddings=True)
+    anchors = get_yes_no_anchors().to(emb.device)
+    approval_score, disapproval_score = (emb @ anchors.T)[0]
+
+    return (approval_score > disapproval_score).item()
 
 
+@metrics.timed("yes_or_no")
 def yes_or_no_from_text(text:str, score_thresh=0.4) -> bool:
     """
     given a text prompt, it measures the cosine distance from the
@@ -29,26 +419,40 @@ def yes_or_no_from_text(text:str, score_thresh=0.4) -> bool:
     a sentence embedder all-MiniLM-L6-v2. Whichever one it is closer to
     is taken as a yes or a no.
 
+    Common replies such as "sure" or "no thanks" are answered from a
+    word list without touching the embedder, and the "yes"/"no" anchors
+    are centroids of a few paraphrases that are only embedded once.
+    Recent replies are memoized.
+
     Returns a boolean - True: yes, False : no
     """
-    approval_emb = embedder.encode(["yes"], convert_to_tensor=True)
-    disapproval_emb = embedder.encode(["no"], convert_to_tensor=True)
+    return _classify_reply(normalize_reply(text))
 
-    emb = embedder.encode([text ], convert_to_tensor=True)
 
-    approval_score = util.cos_sim(emb, approval_emb)[0]
-    disapproval_score = util.cos_sim(emb, disapproval_emb)[0]
 
-    return (approval_score[0] > disapproval_score[0]).item()
+"""
+Cache of emotion labels keyed on a hash of the movie overview. The
+overview of a movie never changes, so the entries don't expire in
+practice, and the on disk store lives next to the TMDB cache
+"""
+EMOTION_CACHE_TTL = 365*24*60*60
 
+emotion_cache = TieredCache(
+    TTLCache(maxsize=4096, ttl=EMOTION_CACHE_TTL),
+    SQLiteCache(join(CACHE_DIR, "tmdb.sqlite"), table="emotions", ttl=EMOTION_CACHE_TTL)
+        if CACHE_DIR else None)
 
 
+@metrics.timed("emotion")
 def extract_emotion_from_text(description:str) -> str:
     """
     Given a discription of a movie, it extracts the emotional content
     of the description. This uses a base t5 model finetuned for emotion
     classification
 
+    Labels are memoized in emotion_cache, so a movie that was already
+    recommended doesn't go through the t5 model again.
+
     Returns an emotion string which is one of the below five:
        - sadness
        - joy
@@ -57,40 +461,356 @@ def extract_emotion_from_text(description:str) -> str:
        - fear
        - surprise
     """
-    input_ids = tokenizer.encode(description+'</s>', return_tensors='pt')
-    output = model.generate(input_ids=input_ids,
-               max_length=2)
+    return extract_emotion_scores(description)["label"]
+
+
+def extract_emotion_scores(description:str) -> dict:
+    """
+    same as extract_emotion_from_text, but returns the label along with
+    the probability of every emotion: {"label": "joy", "scores": {"joy":
+    0.91, ...}}. scores is empty when the label came from generate
+    """
+    key = hashlib.sha1(description.encode("utf-8")).hexdigest()
+    result = emotion_cache.get(key)
+    # entries written before the scores were kept are plain labels
+    if isinstance(result, str):
+        return {"label": result, "scores": {}}
+    if result is not MISSING:
+        return result
+
+    result = infer_emotion(description)
+    emotion_cache.set(key, result)
+    return result
+
+
+def encode_overviews(descriptions:List[str]) -> dict:
+    """
+    tokenizes a batch of overviews for the t5 model, padded to the same
+    length and truncated to EMOTION_MAX_TOKENS
+    """
+    return tokenizer([description+'</s>' for description in descriptions],
+            return_tensors='pt',
+            padding=True,
+            truncation=True,
+            max_length=EMOTION_MAX_TOKENS)
+
+
+def infer_emotions(descriptions:List[str], emotion_model:Any=None) -> List[str]:
+    """
+    runs the t5 emotion model on a batch of descriptions at once,
+    uncached. The descriptions are padded to the same length and go
+    through a single generate call.
+
+    emotion_model defaults to the shared model, it is only passed in to
+    compare inference backends
+    """
+    emotion_model = emotion_model or model
+    inputs = encode_overviews(descriptions)
+
+    with torch.inference_mode():
+        output = emotion_model.generate(input_ids=inputs["input_ids"],
+                   attention_mask=inputs["attention_mask"],
+                   max_length=2)
 
     dec = [tokenizer.decode(ids) for ids in output]
-    label = dec[0].replace("<pad>", "").strip()
+    return [label.replace("<pad>", "").strip() for label in dec]
+
+
+def label_inputs() -> dict:
+    return {"model": EMOTION_MODEL_NAME, "labels_hash": text_hash(EMOTIONS)}
+
+
+@functools.lru_cache(maxsize=None)
+def emotion_label_ids() -> List[int]:
+    """
+    token id of every label in EMOTIONS, from the artifact bundle or
+    the tokenizer
+    """
+    if artifact_bundle.matches("emotion_label_ids", **label_inputs()):
+        return artifact_bundle.array("emotion_label_ids").tolist()
+    return tokenize_emotion_labels()
+
+
+def tokenize_emotion_labels() -> List[int]:
+    """
+    The model was finetuned to answer with the label as the first
+    decoded token, which is what max_length=2 relied on, so every label
+    has to be a single token
+    """
+    ids = [tokenizer(label, add_special_tokens=False)["input_ids"] for label in EMOTIONS]
+    for label, label_ids in zip(EMOTIONS, ids):
+        if len(label_ids) != 1:
+            raise ValueError(f"emotion label {label} is not a single token: {label_ids}")
+    return [label_ids[0] for label_ids in ids]
 
-    return label
 
+def score_emotions(descriptions:List[str], emotion_model:Any=None) -> List[dict]:
+    """
+    Scores a batch of descriptions against the six labels directly: the
+    encoder runs once and the decoder a single step from the start
+    token, and the logits of the label tokens are turned into a
+    probability distribution. No generation loop and no decoding.
 
-def retrieve_whiskey_based_on_tags(tags:List[str], price:str=None) -> dict:
+    Returns a {"label", "scores"} dict per description
+    """
+    emotion_model = emotion_model or model
+    inputs = encode_overviews(descriptions)
+    decoder_start = emotion_model.config.decoder_start_token_id
+    decoder_input_ids = torch.full((len(descriptions), 1), decoder_start, dtype=torch.long)
+
+    with torch.inference_mode():
+        logits = emotion_model(input_ids=inputs["input_ids"],
+                attention_mask=inputs["attention_mask"],
+                decoder_input_ids=decoder_input_ids).logits
+
+    probs = torch.softmax(logits[:, 0, emotion_label_ids()].float(), dim=-1)
+    results = []
+    for row in probs.tolist():
+        scores = dict(zip(EMOTIONS, row))
+        results.append({"label": max(scores, key=scores.get), "scores": scores})
+    return results
+
+
+@metrics.timed("emotion_model")
+def classify_emotions(descriptions:List[str], emotion_model:Any=None) -> List[dict]:
+    """
+    runs the batch through score_emotions, or through the old generate
+    path if BARBUTLER_EMOTION_SCORING=generate. emotion_model is only
+    passed in to compare inference backends
+    """
+    if EMOTION_SCORING == "generate":
+        return [{"label": label, "scores": {}} for label in infer_emotions(descriptions, emotion_model)]
+    return score_emotions(descriptions, emotion_model)
+
+
+"""
+Concurrent MOVIE requests are batched together before they hit the t5
+model. See batching.MicroBatcher
+"""
+emotion_batcher = MicroBatcher(classify_emotions,
+        max_batch_size=EMOTION_BATCH_SIZE,
+        max_wait=EMOTION_BATCH_WAIT_MS/1000,
+        name="emotion-batcher")
+
+
+def infer_emotion(description:str) -> dict:
+    """
+    runs the t5 emotion model on the description, uncached. Waits for
+    the batch the description was put in, see emotion_batcher
+    """
+    return emotion_batcher(description)
+
+
+async def prewarm_emotion_cache(titles:List[str]) -> dict:
+    """
+    Looks up each title on TMDB and classifies the overview of the top
+    result, filling both tmdb_cache and emotion_cache. Meant to be run
+    offline over a list of popular titles, see prewarm.py
+
+    Returns a dict from title to emotion, or None if it wasn't found
+    """
+    emotions = {}
+    for title in titles:
+        movie_data = await retrieve_movie_from_title(title)
+        if movie_data.get("total_results", 0) == 0:
+            emotions[title] = None
+            continue
+
+        emotions[title] = await run_blocking(extract_emotion_from_text, movie_data["results"][0]["overview"])
+    return emotions
+
+
+# local copy of the whiskey-api dataset, loaded on first use
+whiskey_catalog = WhiskeyCatalog(WHISKEY_DATASET or join(ROOT_DIR, "whiskies.csv"),
+        embedding_inputs=embedder_inputs())
+
+
+@metrics.timed("whiskey")
+async def retrieve_whiskey_based_on_tags(tags:List[str], price:str=None, query:str=None) -> dict:
     """
     Given a list of tasting notes and an optional price, it queries the
     Whiskey API to find spirits that most resemble the description.
 
+    If the whiskey-api dataset is available locally, the search is done
+    in process by whiskey_catalog instead, which also applies the price
+    range ("max" or "min-max"). With WHISKEY_RANKING set to "vector" the
+    whiskies are ranked by embedding similarity to query, the user's own
+    words, along with the tags rather than by exact tag overlap, so
+    whiskies that are tagged differently but described alike still
+    match.
+
     returns the raw JSON response, which is unchecked.
     """
+    if whiskey_catalog.available:
+        if WHISKEY_RANKING == "vector" and whiskey_catalog.has_embeddings:
+            text = ", ".join(tags) if query is None else f"{query}. {', '.join(tags)}"
+            try:
+                return await run_blocking(rank_whiskies_by_similarity, text, price=price)
+            except ValueError:
+                # has_embeddings is False from now on, so this is only logged once
+                logger.exception("can't rank whiskies by embedding, falling back to tag search")
+        return whiskey_catalog.search(tags, price=price)
+
     url = "https://evening-citadel-85778.herokuapp.com:443/shoot/"
     params = {
         "tags": ",".join([tag.strip() for tag in tags]),
     }
-    print(params)
-    r = requests.get(url=url, params=params)
+    ratelimit.budgets.spend("whiskey")
+    r = await http_client.get(url, params=params)
     data = r.json()
 
     return data
 
 
-def retrieve_movie_from_title(title:str) -> dict:
+@metrics.timed("whiskey_vector")
+def rank_whiskies_by_similarity(text:str, price:str=None, top_k:int=5) -> dict:
+    """
+    Embeds the text with the same sentence embedder used for the
+    whiskies and scores it against all of them in one matrix product.
+    Returns the top_k whiskies in the same shape as the whiskey API.
+    """
+    query_emb = embedder.encode(text, normalize_embeddings=True)
+    return whiskey_catalog.rank_by_embedding(query_emb, price=price, top_k=top_k)
+
+
+def build_whiskey_embeddings():
+    """
+    offline job that embeds every whiskey in the local catalog, see
+    WhiskeyCatalog.build_embeddings
+    """
+    return whiskey_catalog.build_embeddings(
+            lambda texts: embedder.encode(texts, batch_size=64, normalize_embeddings=True))
+
+
+def build_artifacts() -> dict:
+    """
+    offline job that computes the tasting note embeddings, the yes/no
+    anchors and the emotion label token ids and writes them to the
+    artifact bundle. Returns the manifest
+    """
+    notes, content_hash = tasting_note_index.read_notes()
+    arrays = {
+        "tasting_notes": embed_tasting_notes(notes).cpu().numpy().astype(np.float32),
+        "yes_no_anchors": embed_yes_no_anchors().cpu().numpy().astype(np.float32),
+        "emotion_label_ids": np.array(tokenize_emotion_labels(), dtype=np.int64),
+    }
+    inputs = {
+        "tasting_notes": tasting_note_index.embedding_inputs(content_hash),
+        "yes_no_anchors": anchor_inputs(),
+        "emotion_label_ids": label_inputs(),
+    }
+    manifest = write_bundle(artifact_bundle.path, arrays, inputs)
+    artifact_bundle.reset()
+    return manifest
+
+
+"""
+Cache for TMDB search results keyed on the normalized title. Titles that
+were not found are cached too, but for a shorter time
+"""
+TMDB_CACHE_TTL = 7*24*60*60
+TMDB_NEGATIVE_CACHE_TTL = 60*60
+
+tmdb_cache = TieredCache(
+    TTLCache(maxsize=2048, ttl=TMDB_CACHE_TTL),
+    SQLiteCache(join(CACHE_DIR, "tmdb.sqlite"), table="tmdb_search", ttl=TMDB_CACHE_TTL)
+        if CACHE_DIR else None)
+
+
+# offline index of popular movies, see build.py movie-index
+movie_index = MovieIndex(MOVIE_INDEX or join(ROOT_DIR, "movies.jsonl"))
+
+
+@metrics.timed("movie_index")
+def find_movie_in_text(text:str) -> dict:
+    """
+    Looks for a known movie title inside a free form message using the
+    offline movie_index. Returns the movie in the same shape as a TMDB
+    search result (plus a precomputed "emotion"), or None if there is
+    no index or no title was found.
+    """
+    if not movie_index.available:
+        return None
+    # "cherry" in a message is a tasting note, not the movie Cherry
+    note_words = note_extractor.lexicon if exists(tasting_note_index.notes_path) else ()
+    return movie_index.find_in_text(text, note_words=note_words)
+
+
+async def retrieve_movie_details(movie_id:int) -> dict:
+    """
+    Fetches a movie by TMDB id along with its alternative titles, used
+    to build the offline movie index
+    """
+    url = f"https://api.themoviedb.org/3/movie/{movie_id}"
+    params = {
+        "api_key": TMDB3_API_KEY,
+        "language": "en-US",
+        "append_to_response": "alternative_titles",
+    }
+
+    r = await http_client.get(url, params=params)
+    r.raise_for_status()
+    return r.json()
+
+
+async def build_movie_index(export_path:str, limit:int=5000, batch_size:int=32) -> int:
+    """
+    offline job that takes the most popular movies of a TMDB id export,
+    fetches their details, classifies the emotion of every overview and
+    writes the result to movie_index.path. Returns how many movies were
+    written
+    """
+    movies = read_export(export_path, limit)
+    written = 0
+
+    with open(movie_index.path, "w") as index_file:
+        for start in range(0, len(movies), batch_size):
+            batch = movies[start:start+batch_size]
+            details = await asyncio.gather(*[retrieve_movie_details(movie["id"]) for movie in batch],
+                    return_exceptions=True)
+            details = [d for d in details if isinstance(d, dict) and d.get("overview")]
+            if len(details) == 0:
+                continue
+
+            emotions = await run_blocking(classify_emotions, [d["overview"] for d in details])
+            for d, emotion in zip(details, emotions):
+                index_file.write(json.dumps(movie_record(d, emotion["label"], emotion["scores"])) + "\n")
+            written += len(details)
+            logger.info("indexed %d/%d movies", written, len(movies))
+
+    return written
+
+
+def normalize_title(title:str) -> str:
+    """
+    lowercases and collapses whitespace so that "Star  Wars" and
+    "star wars" share a cache entry
+    """
+    return " ".join(title.lower().split())
+
+
+@metrics.timed("tmdb")
+async def retrieve_movie_from_title(title:str) -> dict:
     """
     Queries the movie API with the title to retrieve metadata about the
     movie. The description of the movie is then used to extract emotional
     content of the description
+
+    Titles in the offline movie_index are answered from it, and other
+    responses are cached in tmdb_cache, so popular titles don't go over
+    the network every time.
     """
+    # the offline movie index answers most titles without the network
+    if movie_index.available:
+        movie = movie_index.lookup(title)
+        if movie is not None:
+            return {"total_results": 1, "results": [movie]}
+
+    key = normalize_title(title)
+    data = tmdb_cache.get(key)
+    if data is not MISSING:
+        return data
+
     url = "https://api.themoviedb.org/3/search/movie"
     params = {
         "api_key": TMDB3_API_KEY,
@@ -100,9 +820,15 @@ def retrieve_movie_from_title(title:str) -> dict:
         "include_adult": True
     }
 
-    r = requests.get(url=url, params=params)
+    ratelimit.budgets.spend("tmdb")
+    r = await http_client.get(url, params=params)
     data = r.json()
 
+    # only cache real answers, not errors such as rate limiting
+    if r.is_success and "total_results" in data:
+        ttl = TMDB_NEGATIVE_CACHE_TTL if data["total_results"] == 0 else TMDB_CACHE_TTL
+        tmdb_cache.set(key, data, ttl)
+
     return data
 
 
@@ -118,7 +844,79 @@ def flatten_list(some_list:List[List[str]]) -> List[str]:
     return outlist
 
 
-def search_tasting_notes(queries:List[str], score_thresh=0.5, top_k=1) -> List[List[str]]:
+"""
+The labels the t5 emotion model can return, see extract_emotion_from_text
+"""
+EMOTIONS = ["sadness", "joy", "love", "anger", "fear", "surprise"]
+
+def reload_tasting_notes() -> bool:
+    """
+    Re-reads tasting_notes.txt after it was edited, without restarting
+    the bot: the index is re-embedded and the lexicon and the notes per
+    emotion are rebuilt if the contents changed. Returns whether they had
+    """
+    changed = tasting_note_index.reload()
+    if changed:
+        note_extractor.reset()
+        precompute_emotion_notes()
+    return changed
+
+
+# tasting notes per emotion, keyed on (tasting notes hash, emotion) so
+# that reloading the tasting notes invalidates them
+_emotion_notes = {}
+
+
+def precompute_emotion_notes(score_thresh=0.3, top_k=5) -> None:
+    """
+    There are only six emotions, so the tasting notes closest to each of
+    them are searched once in a single batch, ahead of any MOVIE request
+    """
+    snapshot = tasting_note_index.ensure_loaded().snapshot
+    notes = search_tasting_notes(EMOTIONS, score_thresh=score_thresh, top_k=top_k, snapshot=snapshot)
+    if notes is None:
+        return
+    for emotion, emotion_notes in zip(EMOTIONS, notes):
+        _emotion_notes[(snapshot.content_hash, emotion, score_thresh, top_k)] = emotion_notes
+
+
+"""
+Below this probability for the top emotion, the movie is treated as a
+mix of its top two emotions
+"""
+MIXED_EMOTION_THRESH = 0.6
+
+
+def secondary_emotion(scores:dict) -> str:
+    """
+    returns the runner up emotion if the model wasn't confident in the
+    top one, otherwise None. scores is the distribution from
+    extract_emotion_scores, and is empty when there is no distribution
+    """
+    if len(scores) < 2:
+        return None
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    if scores[ranked[0]] >= MIXED_EMOTION_THRESH:
+        return None
+    return ranked[1]
+
+
+def tasting_notes_for_emotion(emotion:str, score_thresh=0.3, top_k=5) -> List[str]:
+    """
+    Returns the tasting notes most similar to an emotion label, the same
+    as a flattened search_tasting_notes([emotion]) but precomputed for
+    the known labels.
+    """
+    snapshot = tasting_note_index.ensure_loaded().snapshot
+    key = (snapshot.content_hash, emotion, score_thresh, top_k)
+    if key not in _emotion_notes:
+        notes = search_tasting_notes([emotion], score_thresh=score_thresh, top_k=top_k, snapshot=snapshot)
+        _emotion_notes[key] = flatten_list(notes or [])
+    return list(_emotion_notes[key])
+
+
+@metrics.timed("tasting_notes")
+def search_tasting_notes(queries:List[str], score_thresh=0.5, top_k=1, snapshot:NoteSnapshot=None) -> List[List[str]]:
     """
     Given a list of unsanitized, free form tasting notes, this utility
     function tries to get the closest tasting note to the one given
@@ -135,195 +933,242 @@ def search_tasting_notes(queries:List[str], score_thresh=0.5, top_k=1) -> List[L
 
     top_k determines how many similar tasting notes to add per free form
     input word.
+
+    snapshot pins the version of the tasting notes to search, by default
+    whichever one is current.
     """
     global embedder
 
-    # first we must retrieve the word embeddings of the tasting notes
-    tasting_notes_emb = None
-    # check all possible paths
-    possible_emb_paths = ["tasting_notes.pkl", "../tasting_notes.pkl"]
-    for path in possible_emb_paths:
-        # if the path exists
-        if(exists(path)):
-            # then lead the embeddings pickle file
-            with open(path, "rb") as notes_emb_file:
-                tasting_notes_emb = pickle.load(notes_emb_file)
-
-    # second, we must retrieve the plain text values of the tasting notes
-    tasting_notes = None
-    possible_paths = ["tasting_notes.txt", "../tasting_notes.txt"]
-    # similar structure as above
-    for path in possible_paths:
-        if exists(path):
-            # open the tasting notes txt file and convert each line to
-            # an element in the tasting notes array
-            tasting_notes = []
-            with open(path, "r") as notes_file:
-                for line in notes_file:
-                    tasting_notes.append(line.strip())
-
-    # if the tasting notes embeddings do not exist
-    if tasting_notes_emb is None:
-        # create an embedding from the tasting notes plaintext
-        tasting_notes_emb = embedder.encode(tasting_notes, convert_to_tensor=True)
-        with open(possible_emb_paths[0], "wb") as file:
-            pickle.dump(tasting_notes_emb, file)
+    # the notes and their embeddings are resident in memory, see
+    # TastingNoteIndex for how they are loaded. They are read from one
+    # snapshot so that a reload halfway through can't mix versions
+    if snapshot is None:
+        snapshot = tasting_note_index.ensure_loaded().snapshot
+    tasting_notes, tasting_notes_emb = snapshot.notes, snapshot.embeddings
 
     if(tasting_notes is None or tasting_notes_emb is None): return None
 
-    most_sim_notes = []
-    # go through each input tasting note
-    for query in queries:
-        query_embedding = embedder.encode(query, convert_to_tensor=True)
+    if len(queries) == 0: return []
 
-        # find the most similar ones from the database words
-        cos_scores = util.cos_sim(query_embedding, tasting_notes_emb)[0]
-        # retrieve the score and index of the highest scoring one
-        top_results  = torch.topk(cos_scores, top_k)
+    # encode every query in a single batched forward pass. Both sides
+    # are L2 normalized so the cosine similarity is just a dot product
+    query_emb = embedder.encode(queries,
+            convert_to_tensor=True,
+            normalize_embeddings=True)
+    query_emb = query_emb.to(tasting_notes_emb.device)
 
-        top_notes = []
-        for score, idx in zip(top_results[0], top_results[1]):
-            if(score >= score_thresh):
-                top_notes.append(tasting_notes[idx])
+    # (num queries x num tasting notes) similarity matrix in one matmul
+    cos_scores = query_emb @ tasting_notes_emb.T
+    # retrieve the score and index of the highest scoring ones per query
+    top_scores, top_idxs = torch.topk(cos_scores, min(top_k, len(tasting_notes)), dim=1)
+    keep = top_scores >= score_thresh
+
+    most_sim_notes = []
+    for idxs, mask in zip(top_idxs.tolist(), keep.tolist()):
+        most_sim_notes.append([tasting_notes[idx] for idx, ok in zip(idxs, mask) if ok])
 
-        most_sim_notes.append(top_notes)
     return most_sim_notes
 
 
-def extract_movie_from_str(text:str) -> str:
+"""
+Cache for GPT-3 completions keyed on the kind of extraction and the
+normalized user message. While caching is on, completions are requested
+at temperature 0 so the cached answer is the one the model would give
+anyway.
+"""
+gpt_cache = TTLCache(maxsize=GPT_CACHE_SIZE, ttl=GPT_CACHE_TTL)
+gpt_inflight = SingleFlight()
+gpt_saved_tokens = 0
+
+
+@metrics.timed("openai")
+async def create_completion(prompt:str, temperature:float, max_tokens:int=256, stop:List[str]=None) -> dict:
     """
-    Leverages the Open AI GPT-3 model & API in order to extract the name
-    of a movie from a free form text.
+    sends a few-shot prompt to the GPT-3 Ada model. Raises
+    ratelimit.BudgetExceeded if the OpenAI budget is used up
 
-    Example input: I want to watch the Twilight series tonight
-    Example output: Twilight
+    With GPT_STREAMING the completion is streamed and returned as soon
+    as its first line is complete, in the same shape but without usage
     """
-    prepended_prompt = create_movie_prompt(text)
-    response = openai.Completion.create(
+    ratelimit.budgets.spend("openai")
+    params = dict(
           model="text-ada-001",
-          prompt=prepended_prompt,
-          temperature=0.7,
-          max_tokens=256,
+          prompt=prompt,
+          temperature=temperature,
+          max_tokens=max_tokens,
+          stop=stop,
           top_p=1.0,
           frequency_penalty=0.0,
           presence_penalty=0.0,
           best_of=1
     )
-    response_text = response["choices"][0]["text"]
-    if(response_text == ""):
-        return ""
+    if not GPT_STREAMING:
+        return await openai.Completion.acreate(**params)
 
-    # in case many movies are returned by accident
-    response_text = response_text.split("\n")[0]
-    return response_text.strip()
+    text = ""
+    stream = await openai.Completion.acreate(stream=True, **params)
+    async for chunk in stream:
+        text += chunk["choices"][0]["text"]
+        # every extractor only reads the first line
+        if "\n" in text.lstrip("\n"):
+            await stream.aclose()
+            break
+    return {"choices": [{"text": text}], "usage": {}}
 
 
+async def complete_cached(kind:str, text:str, template:extractor.PromptTemplate) -> str:
+    """
+    Returns the completion text for template.render(text). Identical
+    messages (after normalize_reply) are answered from gpt_cache, and
+    concurrent identical messages share a single upstream call.
+    """
+    global gpt_saved_tokens
+
+    if not GPT_CACHE_ENABLED:
+        response = await create_completion(template.render(text), temperature=0.7,
+                max_tokens=template.max_tokens, stop=template.stop)
+        return response["choices"][0]["text"]
+
+    key = f"{kind}:{normalize_reply(text)}"
+    cached = gpt_cache.get(key)
+    if cached is not MISSING:
+        response_text, tokens = cached
+        gpt_saved_tokens += tokens
+        return response_text
+
+    async def call():
+        response = await create_completion(template.render(text), temperature=0,
+                max_tokens=template.max_tokens, stop=template.stop)
+        entry = (response["choices"][0]["text"], response.get("usage", {}).get("total_tokens", 0))
+        gpt_cache.set(key, entry)
+        return entry
+
+    (response_text, tokens), shared = await gpt_inflight.do(key, call)
+    if shared:
+        gpt_saved_tokens += tokens
+    return response_text
+
+
+def gpt_cache_stats() -> dict:
+    """
+    hit rate of the GPT-3 cache, how many calls were coalesced with one
+    already in flight, and how many tokens both saved
+    """
+    stats = gpt_cache.stats()
+    stats["coalesced"] = gpt_inflight.coalesced
+    stats["saved_tokens"] = gpt_saved_tokens
+    return stats
 
 
-def extract_tasting_notes_from_str(text:str) -> List[str]:
+@metrics.timed("extract_movie")
+async def extract_movie_from_str(text:str) -> str:
     """
-    Leverages the OpenAI GPT-3 model & API to extract tasting notes
-    from free form text.
+    Leverages the Open AI GPT-3 model & API in order to extract the name
+    of a movie from a free form text.
 
-    Exmple input: Can you recommend a light whiskey that is flowery and complex?
-    Example output: light, flowery, complex
-    """
-    prepended_prompt= create_taste_prompt(text)
-    response = openai.Completion.create(
-          model="text-ada-001",
-          prompt=prepended_prompt,
-          temperature=0.7,
-          max_tokens=256,
-          top_p=1.0,
-          frequency_penalty=0.0,
-          presence_penalty=0.0,
-          best_of=1
-    )
+    Example input: I want to watch the Twilight series tonight
+    Example output: Twilight
 
-    response_text = response["choices"][0]["text"]
-    if(response_text == ""):
-        return []
+    Completions are cached, see complete_cached
+    """
+    response_text = await complete_cached("movie", text, extractor.MOVIE)
+    return extractor.parse_movie(response_text)
 
-    response_text = response_text.split("\n")[0]
-    notes = [ note.strip() for note in response_text.split(",") ]
 
-    return notes
+@metrics.timed("extract_intent")
+async def extract_intent(text:str):
+    """
+    Works out from a free form first message whether the user wants a
+    recommendation based on a movie or on tasting notes, along with the
+    movie or the notes, so the CHOOSING step and the extraction from the
+    next message become a single round trip.
 
+    Known movie titles and tasting notes are found locally, and the
+    combined extractor.INTENT prompt is only sent to GPT-3 if neither is
+    in the message and it is at least extractor.MIN_INTENT_WORDS long.
 
-def create_taste_prompt(user_prompt:str) -> str:
+    Returns ("movie", title), ("taste", [notes]) or ("none", None)
     """
-    The model is not finetuned and is doing few-shot inferences
-    so we need to provide example entries to prompt the algo
-    """
-
-    prompt = """
-user: Hey I'm looking for a whiskey that's airy, light, and very fruity, what would you recommend?
-tasting notes: airy, light, fruity
+    notes = note_extractor.match(text) if LOCAL_NOTE_EXTRACTION else []
+    movie = find_movie_in_text(text)
+    # a movie wins over the notes that are only part of its title, e.g.
+    # "sweet" in The Sweet Hereafter. A title that is itself a tasting
+    # note has to be quoted, "cherry" on its own is a tasting note
+    title = movie_key(movie["title"]) if movie is not None else None
+    if movie is not None and (title not in note_extractor.lexicon or set(title.split()) <= quoted_words(text)):
+        title_notes = note_extractor.match(movie["title"])
+        if all(note in title_notes for note in notes):
+            return "movie", movie["title"]
 
-user: I'm interested in a dense whiskey that is well balanced and citrusy
-tasting notes: dense, balanced, citrusy
+    if len(notes) > 0:
+        return "taste", notes
 
-user: You got any whiskey with heavy coffee and cigar flavors?
-tasting notes: coffee, cigar
+    if len(text.split()) < extractor.MIN_INTENT_WORDS:
+        return "none", None
 
-user: what sweet whiskey would you recommend?
-tasting notes: sweet
+    intent, entity = extractor.parse_intent(await complete_cached("intent", text, extractor.INTENT))
+    if intent == "movie":
+        return "movie", entity
+    if intent == "taste":
+        return "taste", extractor.parse_notes(entity)
+    return "none", None
 
-user: Can you find me a malty whiskey with floral notes and smells a little bit like chocolate?
-tasting notes: malty, floral, chocolate
 
-user: what is a whiskey that's mellow and has butterscotch flavors?
-tasting notes: mellow, butterscotch
 
-user: Any idea what whiskey is smooth and apple flavored?
-tasting notes: smooth, apple
 
-user: I'm trying to relax for the night, any suggestions for bourbon that's smokey, bitter, but also amber?
-tasting notes: smokey, bitter, amber
+# lexicon built from the same tasting_notes.txt as tasting_note_index,
+# but without needing the embedder
+note_extractor = LazyModel(lambda: TastingNoteExtractor(read_vocabulary(tasting_note_index.notes_path)))
 
-user: """
-    prompt += user_prompt
-    prompt += "\ntasting notes:"
-    return prompt
 
-def create_movie_prompt(user_prompt:str) -> str:
+@metrics.timed("notes_embedding_fallback")
+def embed_tasting_notes_from_str(text:str, score_thresh=0.6) -> List[str]:
     """
-    The model is not finetuned and is doing few-shot inferences
-    so we need to provide example entries to prompt the algo
+    Fallback for words the lexicon doesn't know, e.g. "sophisticated".
+    Each leftover word is embedded and kept if it is close enough to a
+    tasting note. The threshold is higher than search_tasting_notes'
+    since the words weren't picked out as tasting notes by anyone.
     """
-    prompt = """
-user: What's a good whiskey to pair with The Conjuring series?
-movie name: The Conjuring
-
-user: What should I drink when I watch Indiana Jones?
-movie name: Indiana Jones
-
-user: I'd like to watch the Hellraiser tonight. What should I get from the bar?
-movie name: Hellraiser
-
-user: What would be an interesting whiskey to pair with Star Wars?
-movie name: Star Wars
-
-user: Can you find me a whiskey to pair with Top Gun: Maverick?
-movie name: Top Gun: Maverick
-
-user: What can I drink with Sleepless in Seattle?
-movie name: Sleepless in Seattle
+    words = note_extractor.leftover_words(text)
+    if len(words) == 0:
+        return []
 
-user: What whiskey goes well with Knocked Up?
-movie name: Knocked Up
+    notes = []
+    for note in flatten_list(search_tasting_notes(words, score_thresh=score_thresh) or []):
+        if note not in notes:
+            notes.append(note)
+    return notes
 
-user: I'm trying to relax for the night with Catch Me if You Can
-movie name: Catch Me if You Can
 
-user: what should I drink with Schindler's List?
-movie name: Schindler's list
+@metrics.timed("extract_notes")
+async def extract_tasting_notes_from_str(text:str) -> List[str]:
+    """
+    Leverages the OpenAI GPT-3 model & API to extract tasting notes
+    from free form text.
 
-user: """
-    prompt += user_prompt
-    prompt += "\nmovie name:"
+    Exmple input: Can you recommend a light whiskey that is flowery and complex?
+    Example output: light, flowery, complex
 
-    return prompt
+    Most messages are handled locally, by the note_extractor lexicon or
+    else embed_tasting_notes_from_str, and GPT-3 is only asked when both
+    find nothing. Completions are cached, see complete_cached
+    """
+    if LOCAL_NOTE_EXTRACTION:
+        notes = note_extractor.match(text)
+        if len(notes) == 0:
+            notes = await run_blocking(embed_tasting_notes_from_str, text)
+        if len(notes) > 0:
+            return notes
 
+    response_text = await complete_cached("taste", text, extractor.TASTE)
+    return extractor.parse_notes(response_text)
 
 
+"""
+Cache statistics exposed next to the stage latencies, see metrics.py
+"""
+metrics.registry.register_collector("tmdb_cache", tmdb_cache.stats)
+metrics.registry.register_collector("emotion_cache", emotion_cache.stats)
+metrics.registry.register_collector("gpt_cache", gpt_cache_stats)
+metrics.registry.register_collector("ratelimit", ratelimit.stats)
+metrics.registry.register_collector("yes_or_no_memo", lambda: _classify_reply.cache_info()._asdict())
@@ -0,0 +1,246 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from urllib.parse import urlsplit
+
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+from aiohttp import web
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import Application, ConversationHandler
+
+from bot_states import MOVIE
+from constants import (
+    WEBHOOK_URL,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    UPDATE_QUEUE_SIZE,
+    UPDATE_WORKERS,
+    BUSY_QUEUE_FRACTION,
+)
+from workers import chat_key
+
+import metrics
+import utils
+
+
+logger = logging.getLogger(__name__)
+
+"""
+Conversation states whose requests are expensive enough to be turned
+away with BUSY_TEXT once the queue is filling up
+"""
+HEAVY_STATES = {MOVIE}
+BUSY_TEXT = "I'm a bit busy right now, one moment! Could you send that again in a minute?"
+
+
+class UpdateQueue:
+    """
+    Bounded queue of updates handled by a fixed number of worker tasks.
+
+    Updates are queued per chat, and a chat is only ever handled by one
+    worker at a time, so the updates of a chat are handled in the order
+    they arrived while different chats run concurrently. A chat waiting
+    on a slow MOVIE request doesn't hold up the other chats.
+    """
+
+    def __init__(self, process:Callable[[Any], Awaitable], maxsize:int, num_workers:int):
+        self.process = process
+        self.maxsize = maxsize
+        self.num_workers = num_workers
+        # number of updates waiting, not counting the ones being handled
+        self.size = 0
+        self.processed = 0
+        self.failed = 0
+        self._chats = {}
+        self._ready = asyncio.Queue()
+        self._workers = []
+        self._wait = metrics.registry.histogram("webhook.queue_wait")
+
+
+    def start(self) -> None:
+        self._workers = [asyncio.create_task(self._work(), name=f"update-worker-{i}")
+                for i in range(self.num_workers)]
+
+
+    async def stop(self) -> None:
+        """
+        waits for the queued updates to be handled, then stops the workers
+        """
+        # a chat is only removed once its last update was handled
+        while len(self._chats) > 0:
+            await asyncio.sleep(0.05)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+
+    def put_nowait(self, key:Hashable, item:Any) -> bool:
+        """
+        queues item behind the other updates of its chat. Returns False
+        without queueing it if the queue is full
+        """
+        if self.size >= self.maxsize:
+            return False
+
+        chat = self._chats.get(key)
+        if chat is None:
+            chat = self._chats[key] = deque()
+            self._ready.put_nowait(key)
+        chat.append((time.perf_counter(), item))
+        self.size += 1
+        return True
+
+
+    async def _work(self) -> None:
+        while True:
+            key = await self._ready.get()
+            chat = self._chats[key]
+            while len(chat) > 0:
+                queued_at, item = chat.popleft()
+                self.size -= 1
+                self._wait.observe(time.perf_counter() - queued_at)
+                try:
+                    await self.process(item)
+                except Exception:
+                    self.failed += 1
+                    logger.exception("failed to handle update")
+                self.processed += 1
+            # nothing was awaited since the chat ran dry, so no update
+            # can have been queued for it in the meantime
+            del self._chats[key]
+
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "size": self.size,
+            "maxsize": self.maxsize,
+            "chats": len(self._chats),
+            "processed": self.processed,
+            "failed": self.failed,
+        }
+
+
+
+class WebhookServer:
+    """
+    Receives telegram updates on a webhook and puts them on an
+    UpdateQueue. When the queue fills up, load is shed in two steps:
+       - past busy_fraction of the queue, requests in HEAVY_STATES are
+         answered with BUSY_TEXT instead of being queued
+       - once it is full, the webhook answers 503 and telegram delivers
+         the update again later
+    so the requests that are queued are handled with a predictable
+    delay instead of everything slowing down during a spike.
+    """
+
+    def __init__(self, application:Application, path:str="/telegram", secret:str=None,
+            queue_size:int=UPDATE_QUEUE_SIZE, num_workers:int=UPDATE_WORKERS,
+            busy_fraction:float=BUSY_QUEUE_FRACTION):
+        self.application = application
+        self.path = path
+        self.secret = secret
+        self.busy_at = int(queue_size * busy_fraction)
+        self.queue = UpdateQueue(application.process_update, queue_size, num_workers)
+        self.busy_replies = 0
+        self.rejected = 0
+        self._runner = None
+        # keeps the busy reply tasks from being garbage collected
+        self._replies = set()
+        self._conversation = next(handler for handler in application.handlers[0]
+                if isinstance(handler, ConversationHandler))
+
+
+    def is_heavy(self, update:Update) -> bool:
+        """
+        whether the conversation of this update is in one of HEAVY_STATES
+        """
+        check = self._conversation.check_update(update)
+        return check is not None and check[0] in HEAVY_STATES
+
+
+    async def handle(self, request:web.Request) -> web.Response:
+        if self.secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret:
+            return web.Response(status=403)
+
+        update = Update.de_json(await request.json(), self.application.bot)
+
+        if self.queue.size >= self.busy_at and self.is_heavy(update):
+            self.busy_replies += 1
+            task = asyncio.create_task(self.reply_busy(update))
+            self._replies.add(task)
+            task.add_done_callback(self._replies.discard)
+            return web.Response()
+
+        if not self.queue.put_nowait(chat_key(update), update):
+            self.rejected += 1
+            return web.Response(status=503)
+        return web.Response()
+
+
+    async def reply_busy(self, update:Update) -> None:
+        try:
+            await self.application.bot.send_message(update.effective_chat.id, BUSY_TEXT)
+        except TelegramError:
+            logger.exception("failed to send busy reply")
+
+
+    async def start(self, host:str, port:int) -> None:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self.queue.start()
+        logger.info("listening for updates on %s:%d%s", host, port, self.path)
+
+
+    async def stop(self) -> None:
+        """
+        stops accepting updates and waits for the queued ones
+        """
+        await self._runner.cleanup()
+        await self.queue.stop()
+
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            **self.queue.stats(),
+            "busy_replies": self.busy_replies,
+            "rejected": self.rejected,
+        }
+
+
+
+async def run(build_application:Callable[..., Application], url:str=WEBHOOK_URL,
+        host:str="0.0.0.0", port:int=WEBHOOK_PORT) -> None:
+    application = build_application(polling=False)
+    server = WebhookServer(application, path=urlsplit(url).path or "/", secret=WEBHOOK_SECRET)
+    metrics.registry.register_collector("webhook", server.stats)
+
+    async with application:
+        await application.start()
+        await server.start(host, port)
+        await application.bot.set_webhook(url, secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES, max_connections=100)
+        try:
+            # until the process is stopped
+            await asyncio.Event().wait()
+        finally:
+            await server.stop()
+            await application.stop()
+
+
+def serve(build_application:Callable[..., Application]) -> None:
+    """
+    serves the bot on a webhook at WEBHOOK_URL instead of polling
+    """
+    # load the models in the background so that the bot can start
+    # answering /start and CHOOSING messages immediately
+    utils.warm_up_models()
+    try:
+        asyncio.run(run(build_application))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,300 @@
+import re
+import csv
+import json
+import hashlib
+import threading
+from os.path import exists, splitext
+from collections import defaultdict
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class WhiskeyCatalog:
+    """
+    Local replacement for the /shoot/ endpoint of the whiskey API. The
+    whiskey-api dataset is loaded once from a CSV or JSON file, and an
+    inverted index maps every tasting tag to the whiskies that have it.
+
+    A search scores each whiskey by how many of the requested tags it
+    shares (only touching whiskies that share at least one), and returns
+    the same {"count", "results": [{title, description, price}]} shape
+    as the remote API.
+
+    Optionally, every whiskey can also be embedded ahead of time (see
+    build_embeddings) into a float32 matrix saved next to the dataset.
+    rank_by_embedding then scores a query embedding against all of the
+    whiskies with a single matrix product.
+
+    A JSON manifest next to the matrix records the sha256 hash of the
+    dataset and embedding_inputs (the embedder and its backend) it was
+    built from. If either changed since, the matrix is stale: its rows
+    are for other whiskies or in another embedding space.
+    """
+
+    def __init__(self, path:str, embeddings_path:str=None, embedding_inputs:Dict=None):
+        self.path = path
+        self.embeddings_path = embeddings_path or splitext(path)[0] + ".npy"
+        self.manifest_path = self.embeddings_path + ".json"
+        self.embedding_inputs = embedding_inputs or {}
+        self.content_hash = None
+        self.whiskies = None
+        self.tag_index = None
+        self.prices = None
+        self.embeddings = None
+        # set when the embeddings on disk don't match the dataset
+        self.embeddings_stale = False
+        self._lock = threading.Lock()
+
+
+    @property
+    def available(self) -> bool:
+        """
+        whether the dataset file exists, if not the remote API is used
+        """
+        return exists(self.path)
+
+
+    def load(self) -> "WhiskeyCatalog":
+        """
+        reads the dataset and builds the tag -> whiskey id index
+        """
+        with open(self.path, "rb") as dataset_file:
+            content_hash = hashlib.sha256(dataset_file.read()).hexdigest()
+
+        whiskies = []
+        for row in read_dataset(self.path):
+            whiskies.append({
+                "title": row.get("title", "").strip(),
+                "description": row.get("description", "").strip(),
+                "price": row.get("price", ""),
+                "tags": parse_tags(row.get("tags", "")),
+            })
+
+        tag_index = defaultdict(list)
+        for whiskey_id, whiskey in enumerate(whiskies):
+            for tag in whiskey["tags"]:
+                tag_index[tag].append(whiskey_id)
+
+        self.content_hash = content_hash
+        self.whiskies = whiskies
+        self.tag_index = dict(tag_index)
+        # numeric prices for vectorized price filtering, nan if unknown
+        self.prices = np.array([parse_price(whiskey["price"]) for whiskey in whiskies], dtype=np.float64)
+        return self
+
+
+    def ensure_loaded(self) -> "WhiskeyCatalog":
+        if self.whiskies is None:
+            with self._lock:
+                if self.whiskies is None:
+                    self.load()
+        return self
+
+
+    @property
+    def has_embeddings(self) -> bool:
+        return exists(self.embeddings_path) and not self.embeddings_stale
+
+
+    def embedding_manifest(self) -> Dict:
+        """
+        what the embeddings of the dataset as it is now are built from
+        """
+        self.ensure_loaded()
+        return {"dataset_hash": self.content_hash, "rows": len(self.whiskies), **self.embedding_inputs}
+
+
+    def embedding_texts(self) -> List[str]:
+        """
+        the text that represents each whiskey in embedding space, its
+        tags followed by its description
+        """
+        self.ensure_loaded()
+        return [f"{', '.join(whiskey['tags'])}. {whiskey['description']}" for whiskey in self.whiskies]
+
+
+    def build_embeddings(self, encode:Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        """
+        Embeds every whiskey with encode, which should return L2
+        normalized vectors, and saves them as a contiguous float32 .npy
+        matrix at embeddings_path. Meant to be run offline, see build.py
+        """
+        embeddings = np.ascontiguousarray(encode(self.embedding_texts()), dtype=np.float32)
+        np.save(self.embeddings_path, embeddings)
+        with open(self.manifest_path, "w") as manifest_file:
+            json.dump(self.embedding_manifest(), manifest_file, indent=2)
+        self.embeddings = embeddings
+        self.embeddings_stale = False
+        return embeddings
+
+
+    def load_embeddings(self) -> np.ndarray:
+        """
+        memory maps the whiskey embeddings, so they are shared between
+        processes and only paged in when used. Raises ValueError and
+        marks them stale if they weren't built from the dataset and
+        embedder as they are now
+        """
+        self.ensure_loaded()
+        if self.embeddings is None:
+            with self._lock:
+                if self.embeddings is None:
+                    manifest = None
+                    if exists(self.manifest_path):
+                        with open(self.manifest_path, "r") as manifest_file:
+                            manifest = json.load(manifest_file)
+                    embeddings = np.load(self.embeddings_path, mmap_mode="r")
+                    expected = self.embedding_manifest()
+                    if manifest != expected or embeddings.shape[0] != len(self.whiskies):
+                        self.embeddings_stale = True
+                        raise ValueError(f"{self.embeddings_path} was built from {manifest}, not from "
+                                f"{expected}, rebuild it")
+                    self.embeddings = embeddings
+        return self.embeddings
+
+
+    def rank_by_embedding(self, query_emb:np.ndarray, price:str=None, top_k:int=5) -> dict:
+        """
+        Scores a normalized query embedding against every whiskey with
+        one matrix-vector product and returns the top_k most similar
+        whiskies within the optional price range, in the same shape as
+        search.
+        """
+        embeddings = self.load_embeddings()
+        scores = embeddings @ np.asarray(query_emb, dtype=np.float32).reshape(-1)
+
+        price_range = parse_price_range(price)
+        if price_range is not None:
+            scores = np.where(self.price_mask(price_range), scores, -np.inf)
+
+        candidates = int(np.isfinite(scores).sum())
+        top_k = min(top_k, candidates)
+        if top_k == 0:
+            return {"count": 0, "results": []}
+
+        # partial sort, only the top_k are ordered
+        top_idxs = np.argpartition(-scores, top_k - 1)[:top_k]
+        top_idxs = top_idxs[np.argsort(-scores[top_idxs])]
+
+        results = []
+        for whiskey_id in top_idxs:
+            whiskey = self.whiskies[whiskey_id]
+            results.append({
+                "title": whiskey["title"],
+                "description": whiskey["description"],
+                "price": whiskey["price"],
+                "tags": whiskey["tags"],
+                "score": float(scores[whiskey_id]),
+            })
+
+        return {"count": len(results), "results": results}
+
+
+    def price_mask(self, price_range:Tuple[float, float]) -> np.ndarray:
+        """
+        boolean array of which whiskies fall in the price range
+        """
+        # comparisons with nan are False, so unknown prices are excluded
+        return (self.prices >= price_range[0]) & (self.prices <= price_range[1])
+
+
+    def search(self, tags:List[str], price:str=None, limit:int=None) -> dict:
+        """
+        Returns the whiskies that share at least one tag with tags,
+        ranked by the number of shared tags. Ties keep dataset order.
+
+        price is an optional "max" or "min-max" price range string,
+        e.g. "50" or "30-60".
+        """
+        self.ensure_loaded()
+
+        # count the overlap for every whiskey that shares a tag
+        overlap = defaultdict(int)
+        for tag in set(normalize_tag(tag) for tag in tags):
+            for whiskey_id in self.tag_index.get(tag, []):
+                overlap[whiskey_id] += 1
+
+        price_range = parse_price_range(price)
+        ranked = sorted(overlap.items(), key=lambda item: (-item[1], item[0]))
+
+        results = []
+        for whiskey_id, score in ranked:
+            whiskey = self.whiskies[whiskey_id]
+            if price_range is not None and not in_price_range(whiskey["price"], price_range):
+                continue
+
+            results.append({
+                "title": whiskey["title"],
+                "description": whiskey["description"],
+                "price": whiskey["price"],
+                "tags": whiskey["tags"],
+                "score": score,
+            })
+            if limit is not None and len(results) >= limit:
+                break
+
+        return {"count": len(results), "results": results}
+
+
+
+def read_dataset(path:str) -> List[Dict]:
+    """
+    reads the whiskey-api dataset as a list of rows, either from a CSV
+    file with a header row or a JSON list of objects
+    """
+    if splitext(path)[1].lower() == ".json":
+        with open(path, "r") as dataset_file:
+            data = json.load(dataset_file)
+        # some dumps wrap the list like the API response does
+        if isinstance(data, dict):
+            data = data.get("results", [])
+        return data
+
+    with open(path, "r", newline="") as dataset_file:
+        return list(csv.DictReader(dataset_file))
+
+
+def normalize_tag(tag:str) -> str:
+    return tag.strip().lower()
+
+
+def parse_tags(tags) -> List[str]:
+    """
+    tags are either a list already or a comma/pipe separated string
+    """
+    if isinstance(tags, str):
+        tags = re.split(r"[,|;]", tags)
+    return [normalize_tag(tag) for tag in tags if tag.strip()]
+
+
+def parse_price(price) -> Optional[float]:
+    """
+    pulls the number out of prices such as "$45", "45.99" or "1,200"
+    """
+    if isinstance(price, (int, float)):
+        return float(price)
+    match = re.search(r"\d+(?:\.\d+)?", str(price).replace(",", ""))
+    return float(match.group()) if match else None
+
+
+def parse_price_range(price:str) -> Optional[Tuple[float, float]]:
+    """
+    "50" -> (0, 50), "30-60" -> (30, 60), None -> None
+    """
+    if price is None or str(price).strip() == "":
+        return None
+
+    bounds = [parse_price(bound) for bound in str(price).split("-")]
+    bounds = [bound for bound in bounds if bound is not None]
+    if len(bounds) == 0:
+        return None
+    if len(bounds) == 1:
+        return (0.0, bounds[0])
+    return (min(bounds), max(bounds))
+
+
+def in_price_range(price, price_range:Tuple[float, float]) -> bool:
+    value = parse_price(price)
+    return value is not None and price_range[0] <= value <= price_range[1]
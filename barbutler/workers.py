@@ -0,0 +1,206 @@
+import gc
+import os
+import signal
+import asyncio
+import logging
+import multiprocessing
+
+from typing import Any, Awaitable, Callable, List
+
+from telegram import Bot, Update
+from telegram.error import TelegramError
+from telegram.ext import Application, BaseUpdateProcessor
+
+from constants import TELEGRAM_API_KEY, METRICS_PORT
+
+import http_client
+import metrics
+import ratelimit
+import utils
+
+
+logger = logging.getLogger(__name__)
+
+"""
+Seconds a getUpdates long poll waits for new updates
+"""
+POLL_TIMEOUT = 30
+
+
+def chat_key(update:Update) -> int:
+    """
+    the chat an update belongs to, or the user or the update itself if
+    it has no chat
+    """
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return update.update_id
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Handles up to max_concurrent_updates updates at the same time, but
+    the updates of a chat one at a time and in the order they arrived.
+    The ConversationHandler only moves a chat to its next state once the
+    handler returns, so a second message handled concurrently would run
+    against the old state, e.g. two rec_from_movie for the same chat
+    mixing their replies.
+
+    Updates waiting behind another update of their chat don't take one
+    of the max_concurrent_updates slots, so a chat sending many messages
+    doesn't hold up the others. At most max_waiting of them are held.
+    """
+
+    def __init__(self, max_concurrent_updates:int, max_waiting:int=1000):
+        super().__init__(max_concurrent_updates + max_waiting)
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        # chat -> [lock, number of updates holding or waiting on it]
+        self._chats = {}
+
+
+    async def do_process_update(self, update:object, coroutine:Awaitable[Any]) -> None:
+        key = chat_key(update) if isinstance(update, Update) else id(update)
+        chat = self._chats.get(key)
+        if chat is None:
+            chat = self._chats[key] = [asyncio.Lock(), 0]
+        chat[1] += 1
+        try:
+            # asyncio locks are handed out in the order they were asked
+            # for, and updates reach here in the order they arrived
+            async with chat[0]:
+                async with self._running:
+                    await coroutine
+        finally:
+            chat[1] -= 1
+            if chat[1] == 0:
+                del self._chats[key]
+
+
+    async def initialize(self) -> None:
+        pass
+
+
+    async def shutdown(self) -> None:
+        pass
+
+
+
+def worker_for(update:Update, num_workers:int) -> int:
+    """
+    Picks the worker an update goes to. The conversation state lives in
+    the worker's ConversationHandler, so every update of a chat has to
+    go to the same worker
+    """
+    return chat_key(update) % num_workers
+
+
+def run_worker(index:int, num_workers:int, queue:multiprocessing.Queue,
+        build_application:Callable[..., Application]) -> None:
+    """
+    Entry point of a forked worker. It handles the updates the parent
+    puts on its queue with its own Application, which has no updater
+    since only the parent talks to getUpdates.
+    """
+    # the parent handles ctrl-c and stops the workers through the queue
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    utils.after_fork()
+    # split the cores between the workers instead of every worker
+    # starting a torch thread per core
+    utils.torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_workers))
+    # every worker spends from its own buckets, so each gets its share
+    # of the upstream budgets. The chat limits stay whole, as a chat
+    # always goes to the same worker
+    ratelimit.budgets = ratelimit.budgets.split(num_workers)
+
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT + index)
+
+    async def work():
+        application = build_application(polling=False)
+        loop = asyncio.get_running_loop()
+        async with application:
+            await application.start()
+            while True:
+                data = await loop.run_in_executor(None, queue.get)
+                if data is None:
+                    break
+                await application.update_queue.put(Update.de_json(data, application.bot))
+            await application.stop()
+        await http_client.close()
+
+    logger.info("worker %d started", index)
+    asyncio.run(work())
+
+
+async def poll(queues:List[multiprocessing.Queue], workers:List[multiprocessing.Process],
+        spawn:Callable[[int], multiprocessing.Process]) -> None:
+    """
+    long polls telegram for updates and hands every update to its
+    worker, restarting workers that died
+    """
+    async with Bot(TELEGRAM_API_KEY) as bot:
+        await bot.delete_webhook()
+        offset = None
+        while True:
+            for i, worker in enumerate(workers):
+                if not worker.is_alive():
+                    logger.error("worker %d exited with %s, restarting it", i, worker.exitcode)
+                    workers[i] = spawn(i)
+
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT,
+                        allowed_updates=Update.ALL_TYPES)
+            except TelegramError:
+                logger.exception("getUpdates failed, retrying")
+                await asyncio.sleep(1)
+                continue
+
+            for update in updates:
+                offset = update.update_id + 1
+                queues[worker_for(update, len(queues))].put(update.to_dict())
+
+
+def load_shared_state() -> None:
+    """
+    loads everything the workers share before they are forked
+    """
+    utils.warm_up_models(include_emotion=True, background=False)
+
+    # move everything allocated so far out of the garbage collector's
+    # reach, otherwise its bookkeeping writes to every object and
+    # defeats copy-on-write
+    gc.freeze()
+
+
+def serve(build_application:Callable[..., Application], num_workers:int) -> None:
+    """
+    Loads the models and the tasting note matrix once in this process,
+    then forks num_workers workers. The weights are never written to
+    after loading, so the workers share them copy-on-write and the box
+    needs roughly one model's worth of RAM whatever the worker count.
+    This process polls telegram and spreads the updates over the
+    workers by chat.
+    """
+    load_shared_state()
+
+    context = multiprocessing.get_context("fork")
+    queues = [context.Queue() for _ in range(num_workers)]
+
+    def spawn(i:int) -> multiprocessing.Process:
+        worker = context.Process(target=run_worker, name=f"worker-{i}",
+                args=(i, num_workers, queues[i], build_application), daemon=True)
+        worker.start()
+        return worker
+
+    workers = [spawn(i) for i in range(num_workers)]
+    try:
+        asyncio.run(poll(queues, workers, spawn))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            worker.join(timeout=10)
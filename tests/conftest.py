@@ -0,0 +1,112 @@
+import sys
+from os.path import abspath, dirname, join
+from types import SimpleNamespace
+
+import pytest
+
+# the bot's modules import each other flat, as when run from barbutler/
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), "barbutler"))
+
+
+"""
+Token id of every emotion label in the stub vocabulary
+"""
+LABEL_IDS = {"sadness": 10, "joy": 11, "love": 12, "anger": 13, "fear": 14, "surprise": 15}
+VOCAB_SIZE = 20
+
+
+class StubTokenizer:
+    """
+    Stands in for the t5 tokenizer: every label is a single token, and
+    an overview is encoded as the id of the first label it mentions
+    """
+
+    def __init__(self):
+        self.calls = []
+
+
+    def __call__(self, text, add_special_tokens=True, **kwargs):
+        import torch
+
+        self.calls.append(kwargs)
+        if isinstance(text, str):
+            return {"input_ids": [LABEL_IDS[text]]}
+
+        ids = [[next((i for label, i in LABEL_IDS.items() if label in t), LABEL_IDS["joy"])] for t in text]
+        return {"input_ids": torch.tensor(ids, dtype=torch.long),
+                "attention_mask": torch.full((len(text), 1), 1, dtype=torch.long)}
+
+
+    def decode(self, ids) -> str:
+        labels = {i: label for label, i in LABEL_IDS.items()}
+        return " ".join(labels.get(int(i), "<pad>") for i in ids)
+
+
+
+class StubEmotionModel:
+    """
+    Stands in for the t5 emotion model: answers with the label token
+    the overview was encoded as
+    """
+
+    config = SimpleNamespace(decoder_start_token_id=0)
+
+
+    def __call__(self, input_ids, attention_mask, decoder_input_ids):
+        import torch
+
+        logits = [[[5.0 if v == int(row[0]) else 0.0 for v in range(VOCAB_SIZE)]] for row in input_ids.tolist()]
+        return SimpleNamespace(logits=torch.tensor(logits, dtype=torch.float32))
+
+
+    def generate(self, input_ids, attention_mask, max_length):
+        return [[0, int(row[0])] for row in input_ids.tolist()]
+
+
+
+class StubEmbedder:
+    """
+    Stands in for the sentence embedder: a fixed pseudo random vector
+    per text
+    """
+
+    def encode(self, texts, convert_to_tensor=False, normalize_embeddings=False, **kwargs):
+        import zlib
+        import numpy as np
+        import torch
+
+        single = isinstance(texts, str)
+        texts = [texts] if single else texts
+        emb = np.stack([np.random.RandomState(zlib.crc32(t.encode())).rand(8).astype(np.float32) for t in texts])
+        if normalize_embeddings:
+            emb = emb / np.linalg.norm(emb, axis=1, keepdims=True)
+        emb = emb[0] if single else emb
+        return torch.from_numpy(emb) if convert_to_tensor else emb
+
+
+
+@pytest.fixture
+def stub_models(monkeypatch, tmp_path):
+    """
+    Replaces the models of utils with the stubs, wrapped in LazyModel
+    handles like the real ones, and points the artifact bundle at an
+    empty directory. Yields the utils module
+    """
+    pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    pytest.importorskip("sentence_transformers")
+    import utils
+    from artifacts import ArtifactBundle
+
+    monkeypatch.setattr(utils, "tokenizer", utils.LazyModel(StubTokenizer))
+    monkeypatch.setattr(utils, "model", utils.LazyModel(StubEmotionModel))
+    monkeypatch.setattr(utils, "embedder", utils.LazyModel(StubEmbedder))
+    monkeypatch.setattr(utils, "artifact_bundle", ArtifactBundle(str(tmp_path / "artifacts")))
+    # state derived from the models, so nothing a test loads leaks out
+    monkeypatch.setattr(utils, "tasting_note_index", utils.TastingNoteIndex())
+    monkeypatch.setattr(utils, "_yes_no_anchors", None)
+    monkeypatch.setattr(utils, "_emotion_notes", {})
+    monkeypatch.setattr(utils, "embedder_ready", utils.threading.Event())
+    utils.emotion_label_ids.cache_clear()
+    yield utils
+    utils.emotion_label_ids.cache_clear()
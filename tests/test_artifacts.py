@@ -0,0 +1,40 @@
+import argparse
+
+import numpy as np
+import pytest
+
+
+def test_bundle_round_trip(tmp_path):
+    from artifacts import ArtifactBundle, write_bundle
+
+    write_bundle(str(tmp_path), {"x": np.arange(6, dtype=np.float32).reshape(2, 3)}, {"x": {"model": "m"}})
+    bundle = ArtifactBundle(str(tmp_path))
+
+    assert bundle.matches("x", model="m")
+    assert not bundle.matches("x", model="other")
+    array = bundle.array("x")
+    array[0, 0] = 9
+    # copy-on-write, the file is unchanged
+    assert ArtifactBundle(str(tmp_path)).array("x")[0, 0] == 0
+
+
+def test_build_artifacts_is_loaded(stub_models, monkeypatch):
+    import build
+
+    build.artifacts(argparse.Namespace())
+    bundle = stub_models.artifact_bundle
+    assert bundle.available
+    assert set(bundle.load()["arrays"]) == {"tasting_notes", "yes_no_anchors", "emotion_label_ids"}
+
+    # everything comes from the bundle now, nothing is computed
+    def fail(*args, **kwargs):
+        raise AssertionError("computed instead of loaded from the bundle")
+    monkeypatch.setattr(stub_models, "embed_tasting_notes", fail)
+    monkeypatch.setattr(stub_models, "embed_yes_no_anchors", fail)
+    monkeypatch.setattr(stub_models, "tokenize_emotion_labels", fail)
+    stub_models.emotion_label_ids.cache_clear()
+
+    index = stub_models.TastingNoteIndex().load()
+    assert index.embeddings.shape[0] == len(index.notes)
+    assert stub_models.get_yes_no_anchors().shape[0] == 2
+    assert len(stub_models.emotion_label_ids()) == len(stub_models.EMOTIONS)
@@ -0,0 +1,26 @@
+import asyncio
+import argparse
+import json
+
+
+def test_bench_reports_every_phase(stub_models, monkeypatch):
+    import bench
+    import ratelimit
+
+    with open(bench.FIXTURES_PATH, "r") as fixtures_file:
+        fixtures = json.load(fixtures_file)
+
+    # what main() sets up before a run
+    monkeypatch.setattr(stub_models.tmdb_cache, "disk", None)
+    monkeypatch.setattr(stub_models.emotion_cache, "disk", None)
+    monkeypatch.setattr(ratelimit.budgets, "buckets", {})
+
+    args = argparse.Namespace(requests=6, concurrency=2, api_latency=0.0, jitter=0.0, reply_latency=0.0,
+            seed=0, keep_caches=False, phase=None)
+    report = asyncio.run(bench.bench(args, fixtures))
+
+    assert set(report["phases"]) == {"taste", "movie", "followup"}
+    for result in report["phases"].values():
+        assert result["latency"]["count"] == args.requests
+        assert result["latency"]["p99_ms"] >= result["latency"]["p50_ms"] > 0
+    bench.print_report(report)
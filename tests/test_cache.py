@@ -0,0 +1,18 @@
+from cache import SQLiteCache
+
+
+def test_expired_entries_are_purged(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = SQLiteCache(path, ttl=60, purge_every=3)
+    cache.set("old", 1, ttl=-1)
+    cache.set("new", 2)
+    assert cache.purged == 0
+
+    # the third write purges
+    cache.set("older", 3, ttl=-1)
+    assert cache.purged == 2
+    assert cache.get("new") == 2
+
+    # and so does opening the file again
+    cache.set("oldest", 4, ttl=-1)
+    assert SQLiteCache(path).stats()["purged"] == 1
@@ -0,0 +1,65 @@
+from conftest import LABEL_IDS
+
+
+def test_lazy_model_is_callable():
+    import pytest
+    utils = pytest.importorskip("utils")
+
+    loads = []
+    handle = utils.LazyModel(lambda: loads.append(1) or (lambda x: x + 1))
+    assert handle(1) == 2
+    assert handle(2) == 3
+    assert loads == [1]
+
+
+def test_infer_emotions(stub_models):
+    labels = stub_models.infer_emotions(["a story of love", "pure fear", "nothing much"])
+    assert labels == ["love", "fear", "joy"]
+
+
+def test_score_emotions(stub_models):
+    results = stub_models.score_emotions(["a story of love", "so much anger"])
+
+    assert [r["label"] for r in results] == ["love", "anger"]
+    for result in results:
+        assert set(result["scores"]) == set(LABEL_IDS)
+        assert abs(sum(result["scores"].values()) - 1) < 1e-5
+
+
+def test_encode_overviews_truncates(stub_models):
+    inputs = stub_models.encode_overviews(["a story of love", "pure fear"])
+
+    assert inputs["input_ids"].shape[0] == 2
+    kwargs = stub_models.tokenizer.calls[-1]
+    assert kwargs["padding"] is True
+    assert kwargs["truncation"] is True
+    assert kwargs["max_length"] == stub_models.EMOTION_MAX_TOKENS
+
+
+def test_extract_emotion_scores(stub_models):
+    # through the emotion cache and batcher, like a MOVIE request that
+    # misses the offline index
+    result = stub_models.extract_emotion_scores("test_extract_emotion_scores: a tale of fear")
+    assert result["label"] == "fear"
+    assert stub_models.extract_emotion_from_text("test_extract_emotion_scores: a tale of fear") == "fear"
+
+
+def test_tokenize_emotion_labels(stub_models):
+    assert stub_models.tokenize_emotion_labels() == [LABEL_IDS[label] for label in stub_models.EMOTIONS]
+    assert stub_models.emotion_label_ids() == stub_models.tokenize_emotion_labels()
+
+
+def test_check_backend(stub_models, monkeypatch, capsys):
+    import argparse
+    import backends
+    import build
+    from conftest import StubEmbedder, StubEmotionModel
+
+    monkeypatch.setattr(backends, "load_emotion_model", lambda *args: StubEmotionModel())
+    monkeypatch.setattr(backends, "load_embedder", lambda *args: StubEmbedder())
+
+    build.check_backend(argparse.Namespace(backend="int8", fixtures=build.FIXTURES_PATH, top_k=5))
+
+    out = capsys.readouterr().out
+    assert "emotion labels: 100.0%" in out
+    assert "total variation distance 0.000" in out
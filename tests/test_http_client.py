@@ -0,0 +1,32 @@
+import asyncio
+
+import httpx
+
+
+def test_long_retry_after_is_not_slept_on(monkeypatch):
+    import http_client
+
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(429, headers={"Retry-After": "3600"})
+
+    slept = []
+
+    async def sleep(delay):
+        slept.append(delay)
+
+    async def run():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        monkeypatch.setattr(http_client, "_client", client)
+        monkeypatch.setattr(http_client.asyncio, "sleep", sleep)
+        try:
+            return await http_client.get("https://example.invalid/")
+        finally:
+            await client.aclose()
+
+    r = asyncio.run(run())
+    assert r.status_code == 429
+    assert len(calls) == 1
+    assert not slept
@@ -0,0 +1,13 @@
+import asyncio
+
+import pytest
+
+
+@pytest.mark.parametrize("text,intent", [
+    ('something like "Cherry"', ("movie", "Cherry")),
+    ("something with cherry", ("taste", ["cherry"])),
+])
+def test_title_that_is_a_note_needs_quotes(stub_models, monkeypatch, text, intent):
+    monkeypatch.setattr(stub_models, "find_movie_in_text", lambda text: {"title": "Cherry"})
+
+    assert asyncio.run(stub_models.extract_intent(text)) == intent
@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+from movie_index import MovieIndex
+
+
+TITLES = ["The Godfather", "Star Wars", "Sweet Home", "Smooth Talk", "Schindler's List", "Cherry", "Her",
+        "The Sweet Hereafter"]
+
+
+@pytest.fixture(scope="module")
+def index(tmp_path_factory):
+    path = tmp_path_factory.mktemp("movies") / "movies.jsonl"
+    with open(path, "w") as index_file:
+        for movie_id, title in enumerate(TITLES):
+            index_file.write(json.dumps({"id": movie_id, "title": title, "popularity": 10 - movie_id}) + "\n")
+    return MovieIndex(str(path))
+
+
+def title(movie):
+    return movie["title"] if movie is not None else None
+
+
+@pytest.mark.parametrize("text,expected", [
+    ("what goes with the godfahter?", "The Godfather"),
+    ("watching stra wars tonight", "Star Wars"),
+    ("I'm watching shindlers list", "Schindler's List"),
+    ("something sweet at home", None),
+    ("something smooth to talk over", None),
+])
+def test_fuzzy_titles(index, text, expected):
+    assert title(index.find_in_text(text)) == expected
+
+
+@pytest.mark.parametrize("text,expected", [
+    ("Cherry", "Cherry"),
+    ("I'd like something with cherry and honey notes", None),
+    ("what goes with 'Cherry'?", "Cherry"),
+    ("I'm watching Her tonight", "Her"),
+    ("i'm watching her tonight", None),
+    ("the sweet hereafter", "The Sweet Hereafter"),
+])
+def test_one_word_titles(index, text, expected):
+    assert title(index.find_in_text(text, note_words=["cherry", "honey"])) == expected
+
+
+def test_lookup_typo(index):
+    assert title(index.lookup("Star Wras")) == "Star Wars"
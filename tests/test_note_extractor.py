@@ -0,0 +1,29 @@
+from os.path import abspath, dirname, join
+
+import pytest
+
+from note_extractor import TastingNoteExtractor, read_vocabulary
+
+
+@pytest.fixture(scope="module")
+def extractor():
+    return TastingNoteExtractor(read_vocabulary(join(dirname(dirname(abspath(__file__))), "tasting_notes.txt")))
+
+
+@pytest.mark.parametrize("text", [
+    "I love bold whiskies",
+    "something for a cold night",
+    "a teal bottle",
+    "an acorn",
+    "hold on, I was told it's good",
+])
+def test_everyday_words_are_not_notes(extractor, text):
+    assert extractor.match(text) == []
+
+
+def test_typos_are_matched(extractor):
+    assert extractor.match("carmel and vanila please") == ["caramel", "vanilla"]
+
+
+def test_exact_and_synonyms(extractor):
+    assert extractor.match("something smoky with cherries") == ["smokey", "cherry"]
@@ -0,0 +1,60 @@
+import asyncio
+from datetime import datetime
+
+from telegram import Chat, Message, Update, User
+from telegram.ext import ConversationHandler
+from telegram.ext._utils.trackingdict import TrackingDict
+
+from persistence import SQLiteStateStore, StatePersistence
+
+
+def message_update(chat_id:int, user_id:int) -> Update:
+    user = User(user_id, "someone", False)
+    return Update(1, message=Message(1, datetime.now(), Chat(chat_id, "private"), from_user=user, text="hi"))
+
+
+def test_shared_state_is_read_on_every_update(tmp_path):
+    store = SQLiteStateStore(str(tmp_path / "state.sqlite"))
+    first = StatePersistence(store, shared=True)
+    second = StatePersistence(store, shared=True)
+    conversation = ConversationHandler([], {}, [], name="chat", persistent=True)
+    # what the Application swaps in when it loads a persistent conversation
+    conversation._conversations = TrackingDict()
+
+    async def run():
+        user_data = {"prev_state": 1}
+        await second.refresh_user_data(2, user_data)
+        await second.load_conversation(conversation, message_update(1, 2))
+        assert user_data == {}
+        assert (1, 2) not in conversation._conversations
+
+        # the first instance handles the next update of the chat
+        await first.update_conversation("chat", (1, 2), 3)
+        await first.update_user_data(2, {"prev_state": 3})
+        await first.write_pending()
+
+        await second.refresh_user_data(2, user_data)
+        await second.load_conversation(conversation, message_update(1, 2))
+        assert user_data == {"prev_state": 3}
+        assert conversation._conversations[(1, 2)] == 3
+        # loaded, not changed, so not written back
+        assert conversation._conversations.pop_accessed_write_items() == []
+
+    asyncio.run(run())
+    store.close()
+
+
+def test_unshared_user_data_is_read_once(tmp_path):
+    store = SQLiteStateStore(str(tmp_path / "state.sqlite"))
+    store.write_many({("user_data", "2"): {"prev_state": 3}})
+    persistence = StatePersistence(store)
+
+    async def run():
+        user_data = {}
+        await persistence.refresh_user_data(2, user_data)
+        store.write_many({("user_data", "2"): {"prev_state": 4}})
+        await persistence.refresh_user_data(2, user_data)
+        return user_data
+
+    assert asyncio.run(run()) == {"prev_state": 3}
+    store.close()
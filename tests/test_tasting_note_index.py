@@ -0,0 +1,15 @@
+def test_reload_swaps_in_a_new_snapshot(stub_models, tmp_path):
+    notes_path = tmp_path / "tasting_notes.txt"
+    notes_path.write_text("cherry\nvanilla\n")
+    index = stub_models.TastingNoteIndex(str(notes_path)).load()
+    before = index.snapshot
+
+    notes_path.write_text("smoke\npeat\noak\n")
+    assert index.reload()
+
+    # the old snapshot is untouched, so a search that started on it
+    # still pairs its notes with its own embeddings
+    assert before.notes == ["cherry", "vanilla"] and len(before.embeddings) == 2
+    assert index.notes == ["smoke", "peat", "oak"] and len(index.embeddings) == 3
+    assert index.content_hash != before.content_hash
+    assert stub_models.search_tasting_notes(["vanilla"], score_thresh=0.99, snapshot=before) == [["vanilla"]]
@@ -0,0 +1,53 @@
+import csv
+
+import numpy as np
+import pytest
+
+from whiskey_catalog import WhiskeyCatalog
+
+
+INPUTS = {"model": "all-MiniLM-L6-v2", "backend": "torch"}
+
+
+def write_dataset(path, rows):
+    with open(path, "w", newline="") as dataset_file:
+        writer = csv.writer(dataset_file)
+        writer.writerow(["title", "description", "price", "tags"])
+        writer.writerows(rows)
+
+
+def encode(texts):
+    emb = np.random.RandomState(0).rand(len(texts), 4)
+    return emb / np.linalg.norm(emb, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    path = tmp_path / "whiskies.csv"
+    write_dataset(path, [["A", "smoky dram", "40", "smoky"], ["B", "sweet dram", "50", "sweet"]])
+    WhiskeyCatalog(str(path), embedding_inputs=INPUTS).build_embeddings(encode)
+    return path
+
+
+def test_embeddings_match(dataset):
+    catalog = WhiskeyCatalog(str(dataset), embedding_inputs=INPUTS)
+    assert catalog.has_embeddings
+    assert catalog.load_embeddings().shape == (2, 4)
+
+
+def test_edited_dataset_is_stale(dataset):
+    # same number of rows, so only the hash tells
+    write_dataset(dataset, [["B", "sweet dram", "50", "sweet"], ["A", "smoky dram", "40", "smoky"]])
+    catalog = WhiskeyCatalog(str(dataset), embedding_inputs=INPUTS)
+    with pytest.raises(ValueError):
+        catalog.load_embeddings()
+    assert not catalog.has_embeddings
+
+
+def test_other_backend_is_stale(dataset):
+    catalog = WhiskeyCatalog(str(dataset), embedding_inputs={**INPUTS, "backend": "onnx"})
+    with pytest.raises(ValueError):
+        catalog.load_embeddings()
+    assert not catalog.has_embeddings
+    # tag search still works
+    assert catalog.search(["smoky"])["count"] == 1
@@ -0,0 +1,26 @@
+import gc
+
+
+def test_load_shared_state(stub_models):
+    import workers
+
+    try:
+        workers.load_shared_state()
+    finally:
+        gc.unfreeze()
+
+    assert stub_models.embedder_ready.is_set()
+    assert stub_models.tasting_note_index.notes
+    assert stub_models.tokenizer.loaded and stub_models.model.loaded
+    assert len(stub_models.emotion_label_ids()) == len(stub_models.EMOTIONS)
+    assert stub_models.tasting_notes_for_emotion("joy")
+
+
+def test_budgets_split_between_workers():
+    from ratelimit import Budgets
+
+    share = Budgets({"openai": 60, "tmdb": 0}).split(4)
+
+    assert share.per_minute == {"openai": 15, "tmdb": 0}
+    assert set(share.buckets) == {"openai"}
+    assert share.buckets["openai"].available() == 15